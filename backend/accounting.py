@@ -0,0 +1,149 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, Optional
+
+from metrics import metrics
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.accounting", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/accounting.log")
+
+# Events every search reports, so per-search means include the searches where they were zero
+EVENTS = {"analysis_cache_hits", "structured_prunes", "ranking_skips"}
+
+metrics.describe("search_llm_calls", "LLM calls per trial search")
+metrics.describe("search_tokens", "LLM tokens per trial search by kind")
+metrics.describe("search_cost_usd", "Estimated LLM cost per trial search")
+metrics.describe("search_events", "Per-search counts of cache hits, structured prunes and ranking skips")
+metrics.describe("search_stage_seconds", "Wall time per workflow stage of a trial search")
+
+
+@dataclass
+class LlmUsage:
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    cost_usd: float = 0.0
+
+
+@dataclass
+class RequestAccount:
+    """LLM usage, cost and stage timings collected over one workflow run.
+
+    Filled in through the module-level record functions while the account is
+    active (see `track`); tasks spawned during the run share it.
+    """
+    patient_id: str = ""
+    llm: Dict[str, LlmUsage] = field(default_factory=dict)  # by source, e.g. "agent:TrialAnalyzerAgent", "analysis:strong"
+    events: Dict[str, int] = field(default_factory=dict)
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    _stage: Optional[str] = None
+    _stage_started: float = 0.0
+    _started: float = field(default_factory=time.perf_counter)
+    total_seconds: Optional[float] = None
+
+    def mark_stage(self, stage: Optional[str]) -> None:
+        """Close the running stage and start `stage` (None just closes it)."""
+        now = time.perf_counter()
+        if self._stage is not None:
+            self.stage_seconds[self._stage] = self.stage_seconds.get(self._stage, 0.0) + now - self._stage_started
+        self._stage, self._stage_started = stage, now
+
+    def totals(self) -> LlmUsage:
+        total = LlmUsage()
+        for usage in self.llm.values():
+            total.calls += usage.calls
+            total.prompt_tokens += usage.prompt_tokens
+            total.completion_tokens += usage.completion_tokens
+            total.cached_prompt_tokens += usage.cached_prompt_tokens
+            total.cost_usd += usage.cost_usd
+        return total
+
+    def close(self) -> None:
+        """End the run: close the last stage and add the run to the aggregate metrics."""
+        if self.total_seconds is not None:
+            return
+        self.mark_stage(None)
+        self.total_seconds = time.perf_counter() - self._started
+        total = self.totals()
+        metrics.observe("search_llm_calls", total.calls)
+        metrics.observe("search_tokens", total.prompt_tokens, kind="prompt")
+        metrics.observe("search_tokens", total.completion_tokens, kind="completion")
+        metrics.observe("search_tokens", total.cached_prompt_tokens, kind="cached_prompt")
+        metrics.observe("search_cost_usd", total.cost_usd)
+        for name in sorted(EVENTS | self.events.keys()):
+            metrics.observe("search_events", self.events.get(name, 0), event=name)
+        for stage, seconds in self.stage_seconds.items():
+            metrics.observe("search_stage_seconds", seconds, stage=stage)
+        metrics.observe("search_stage_seconds", self.total_seconds, stage="total")
+        logger.info(f"Search for patient {self.patient_id}: {total.calls} LLM calls, "
+                    f"{total.prompt_tokens}+{total.completion_tokens} tokens ({total.cached_prompt_tokens} cached), "
+                    f"${total.cost_usd:.5f}, events {self.events}, {self.total_seconds:.2f}s")
+
+    def to_diagnostics(self) -> Dict[str, Any]:
+        """Shape used for the SearchDiagnostics response model."""
+        total = self.totals()
+        return {
+            "llmCalls": total.calls,
+            "promptTokens": total.prompt_tokens,
+            "completionTokens": total.completion_tokens,
+            "cachedPromptTokens": total.cached_prompt_tokens,
+            "costUsd": round(total.cost_usd, 6),
+            "bySource": {
+                source: {"calls": u.calls, "promptTokens": u.prompt_tokens, "completionTokens": u.completion_tokens,
+                         "costUsd": round(u.cost_usd, 6)}
+                for source, u in sorted(self.llm.items())
+            },
+            "analysisCacheHits": self.events.get("analysis_cache_hits", 0),
+            "structuredPrunes": self.events.get("structured_prunes", 0),
+            "rankingSkips": self.events.get("ranking_skips", 0),
+            "stageSeconds": {stage: round(seconds, 4) for stage, seconds in self.stage_seconds.items()},
+            "totalSeconds": round(self.total_seconds if self.total_seconds is not None else time.perf_counter() - self._started, 4),
+        }
+
+
+_current_account: contextvars.ContextVar[Optional[RequestAccount]] = contextvars.ContextVar("request_account", default=None)
+
+
+@contextmanager
+def track(account: RequestAccount) -> Iterator[RequestAccount]:
+    """Make `account` the active one for the block, closing it on exit."""
+    token = _current_account.set(account)
+    try:
+        yield account
+    finally:
+        _current_account.reset(token)
+        account.close()
+
+
+def current_account() -> Optional[RequestAccount]:
+    return _current_account.get()
+
+
+# --- Record functions; no-ops outside a tracked run (warm-up, reverse matching, re-matching) ---
+def record_llm_call(source: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                    cached_prompt_tokens: int = 0, cost_usd: float = 0.0, calls: int = 1) -> None:
+    account = _current_account.get()
+    if account is None:
+        return
+    usage = account.llm.setdefault(source, LlmUsage())
+    usage.calls += calls
+    usage.prompt_tokens += prompt_tokens
+    usage.completion_tokens += completion_tokens
+    usage.cached_prompt_tokens += cached_prompt_tokens
+    usage.cost_usd += cost_usd
+
+
+def record_event(name: str, count: int = 1) -> None:
+    account = _current_account.get()
+    if account is not None:
+        account.events[name] = account.events.get(name, 0) + count
+
+
+def mark_stage(stage: Optional[str]) -> None:
+    account = _current_account.get()
+    if account is not None:
+        account.mark_stage(stage)
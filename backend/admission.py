@@ -0,0 +1,154 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Optional
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.admission", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/admission.log")
+
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "8"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_MAX_QUEUED_PER_CLINICIAN = int(os.getenv("ADMISSION_MAX_QUEUED_PER_CLINICIAN", "8"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+ADMISSION_DEFAULT_RETRY_AFTER_SECONDS = float(os.getenv("ADMISSION_DEFAULT_RETRY_AFTER_SECONDS", "5"))
+
+ANONYMOUS_CLINICIAN = "anonymous"
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; carries a Retry-After hint in whole seconds."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounds in-flight work with a fair, bounded wait queue.
+
+    At most `max_in_flight` holders run at once. Others wait up to `queue_timeout`
+    seconds in per-clinician queues that are served round-robin, so a burst from
+    one clinician cannot starve everyone else. When the queue (or a clinician's
+    share of it) is full, requests are rejected immediately rather than piling up.
+    """
+
+    def __init__(self, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_queue: int = ADMISSION_MAX_QUEUE,
+                 max_queued_per_clinician: int = ADMISSION_MAX_QUEUED_PER_CLINICIAN,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_queued_per_clinician = max_queued_per_clinician
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {}
+        self._round_robin: Deque[str] = deque()
+        # Exponentially weighted mean time a slot is held, used for Retry-After
+        self._mean_hold_seconds: Optional[float] = None
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inFlight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "meanHoldSeconds": round(self._mean_hold_seconds, 3) if self._mean_hold_seconds is not None else None,
+        }
+
+    def _retry_after(self) -> int:
+        if self._mean_hold_seconds is None:
+            return math.ceil(ADMISSION_DEFAULT_RETRY_AFTER_SECONDS)
+        # Time for the current backlog to drain through the available slots
+        return max(1, math.ceil(self._mean_hold_seconds * (self.queued + 1) / self.max_in_flight))
+
+    def _reject(self, reason: str, clinician_id: str) -> AdmissionRejected:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        retry_after = self._retry_after()
+        logger.warning(f"Shedding request from clinician {clinician_id}: {reason} "
+                       f"(in flight {self.in_flight}, queued {self.queued}, retry after {retry_after}s)")
+        return AdmissionRejected(reason, retry_after)
+
+    def _remove_waiter(self, clinician_id: str, waiter: asyncio.Future) -> None:
+        queue = self._waiters.get(clinician_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.queued -= 1
+        if not queue:
+            del self._waiters[clinician_id]
+            self._round_robin.remove(clinician_id)
+
+    def _grant_next(self) -> None:
+        while self.in_flight < self.max_in_flight and self._round_robin:
+            clinician_id = self._round_robin.popleft()
+            queue = self._waiters[clinician_id]
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self._round_robin.append(clinician_id)
+            else:
+                del self._waiters[clinician_id]
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(True)
+
+    async def _acquire(self, clinician_id: str) -> None:
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            return
+        if self.queued >= self.max_queue:
+            raise self._reject("queue_full", clinician_id)
+        queue = self._waiters.get(clinician_id)
+        if queue is not None and len(queue) >= self.max_queued_per_clinician:
+            raise self._reject("clinician_queue_full", clinician_id)
+
+        waiter = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._waiters[clinician_id] = deque()
+            self._round_robin.append(clinician_id)
+        queue.append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            # Caller went away while queued; hand back a slot granted in the meantime
+            if waiter.done():
+                self._release()
+            else:
+                waiter.cancel()
+                self._remove_waiter(clinician_id, waiter)
+            raise
+        if not waiter.done():
+            waiter.cancel()
+            self._remove_waiter(clinician_id, waiter)
+            raise self._reject("queue_timeout", clinician_id)
+
+    def _release(self, held_seconds: Optional[float] = None) -> None:
+        self.in_flight -= 1
+        if held_seconds is not None:
+            self._mean_hold_seconds = held_seconds if self._mean_hold_seconds is None else (
+                0.8 * self._mean_hold_seconds + 0.2 * held_seconds)
+        self._grant_next()
+
+    @asynccontextmanager
+    async def slot(self, clinician_id: Optional[str] = None):
+        """Hold one in-flight slot for the duration of the block.
+
+        Raises:
+            AdmissionRejected: if the service is saturated or the wait timed out.
+        """
+        clinician_id = clinician_id or ANONYMOUS_CLINICIAN
+        await self._acquire(clinician_id)
+        self.admitted += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - started)
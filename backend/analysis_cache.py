@@ -0,0 +1,301 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+from models import LLMAnalysisResult, TrialMatch
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.analysis_cache", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/analysis_cache.log")
+
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "50000"))
+ANALYSIS_CACHE_TTL_SECONDS = float(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", "86400"))
+# memory: per-process LRU. sqlite: WAL database shared by every worker on the host.
+# redis: shared across hosts (needs the optional `redis` package).
+ANALYSIS_CACHE_BACKEND = os.getenv("ANALYSIS_CACHE_BACKEND", "memory").lower()
+ANALYSIS_CACHE_PATH = os.getenv("ANALYSIS_CACHE_PATH", "data/analysis_cache.db")
+ANALYSIS_CACHE_REDIS_URL = os.getenv("ANALYSIS_CACHE_REDIS_URL", "redis://localhost:6379/0")
+# How long one worker may hold an analysis before others stop waiting for it
+ANALYSIS_CACHE_CLAIM_SECONDS = float(os.getenv("ANALYSIS_CACHE_CLAIM_SECONDS", "120"))
+ANALYSIS_CACHE_POLL_SECONDS = float(os.getenv("ANALYSIS_CACHE_POLL_SECONDS", "0.25"))
+
+# Result fields holding Pydantic models, rebuilt when a shared backend decodes a result
+_MODEL_FIELDS = {"match_data": TrialMatch, "llm_analysis": LLMAnalysisResult}
+
+
+def analysis_cache_key(patient_id: str, trial_id: str, analysis_inputs: Dict[str, Any]) -> str:
+    """Key a patient/trial analysis by its ids plus a digest of everything the LLM sees."""
+    digest = hashlib.sha1(json.dumps(analysis_inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"{patient_id}:{trial_id}:{digest}"
+
+
+def encode_result(result: Dict[str, Any]) -> str:
+    return json.dumps({k: v.model_dump() if isinstance(v, BaseModel) else v for k, v in result.items()})
+
+
+def decode_result(text: str) -> Dict[str, Any]:
+    result = json.loads(text)
+    for field, model in _MODEL_FIELDS.items():
+        if result.get(field) is not None:
+            result[field] = model.model_validate(result[field])
+    return result
+
+
+class AnalysisCache:
+    """Bounded LRU cache of patient/trial analysis results with a TTL.
+
+    Claims mark an analysis as in progress so concurrent requests wait for one LLM
+    call instead of making their own. claim() returns a token and release() only
+    drops the claim while that token still holds it, so a holder whose lease expired
+    cannot release a claim another worker has since taken.
+
+    Async callers use the a* methods: shared backends do blocking I/O and run it on a
+    worker thread there, keeping the event loop free.
+    """
+
+    backend = "memory"
+    blocking = False
+
+    def __init__(self, max_entries: int = ANALYSIS_CACHE_MAX_ENTRIES, ttl_seconds: float = ANALYSIS_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._claims: Dict[str, Tuple[float, str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def claim(self, key: str, lease_seconds: float = ANALYSIS_CACHE_CLAIM_SECONDS) -> Optional[str]:
+        """Mark an analysis as in progress; returns the claim token, or None if someone else holds it."""
+        now = time.monotonic()
+        if self._claims.get(key, (0.0, ""))[0] > now:
+            return None
+        token = uuid.uuid4().hex
+        self._claims[key] = (now + lease_seconds, token)
+        return token
+
+    def is_claimed(self, key: str) -> bool:
+        return self._claims.get(key, (0.0, ""))[0] > time.monotonic()
+
+    def release(self, key: str, token: str) -> None:
+        if self._claims.get(key, (0.0, ""))[1] == token:
+            del self._claims[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self) -> None:
+        """Release the backend's connection; the in-process cache holds none."""
+
+    # --- Async access ---
+    async def _call(self, method: Callable[..., Any], *args: Any) -> Any:
+        if self.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return await self._call(self.get, key)
+
+    async def aset(self, key: str, value: Any) -> None:
+        await self._call(self.set, key, value)
+
+    async def aclaim(self, key: str, lease_seconds: float = ANALYSIS_CACHE_CLAIM_SECONDS) -> Optional[str]:
+        return await self._call(self.claim, key, lease_seconds)
+
+    async def ais_claimed(self, key: str) -> bool:
+        return await self._call(self.is_claimed, key)
+
+    async def arelease(self, key: str, token: str) -> None:
+        await self._call(self.release, key, token)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_cache_stored_at ON analysis_cache (stored_at);
+CREATE TABLE IF NOT EXISTS analysis_claims (
+    key TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL,
+    token TEXT
+);
+"""
+
+
+class SqliteAnalysisCache(AnalysisCache):
+    """AnalysisCache kept in a WAL-mode SQLite file, so every worker process shares hits and claims.
+
+    TTL uses wall-clock time because entries outlive the process that wrote them. The
+    file is opened on first use, not on construction.
+    """
+
+    backend = "sqlite"
+    blocking = True
+    _PRUNE_EVERY = 500  # sets between size checks
+
+    def __init__(self, path: str = ANALYSIS_CACHE_PATH, max_entries: int = ANALYSIS_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = ANALYSIS_CACHE_TTL_SECONDS):
+        super().__init__(max_entries, ttl_seconds)
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._sets_since_prune = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Callers hold self._lock
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SQLITE_SCHEMA)
+            # Files created before claims carried a token
+            if "token" not in {row[1] for row in conn.execute("PRAGMA table_info(analysis_claims)")}:
+                conn.execute("ALTER TABLE analysis_claims ADD COLUMN token TEXT")
+            self._conn = conn
+            logger.info(f"Shared analysis cache opened at {self.path}")
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._connection().execute("SELECT value FROM analysis_cache WHERE key = ? AND stored_at > ?",
+                                     (key, time.time() - self.ttl_seconds)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decode_result(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        encoded = encode_result(value)
+        with self._lock, self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO analysis_cache (key, value, stored_at) VALUES (?, ?, ?)",
+                               (key, encoded, time.time()))
+            self._sets_since_prune += 1
+            if self._sets_since_prune >= self._PRUNE_EVERY:
+                self._sets_since_prune = 0
+                self._prune(conn)
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        # Oldest-first eviction: approximate LRU without a write on every hit
+        conn.execute("DELETE FROM analysis_cache WHERE stored_at <= ?", (time.time() - self.ttl_seconds,))
+        conn.execute(
+            "DELETE FROM analysis_cache WHERE key IN (SELECT key FROM analysis_cache ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def claim(self, key: str, lease_seconds: float = ANALYSIS_CACHE_CLAIM_SECONDS) -> Optional[str]:
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._lock, self._connection() as conn:
+            conn.execute("DELETE FROM analysis_claims WHERE key = ? AND expires_at <= ?", (key, now))
+            inserted = conn.execute("INSERT OR IGNORE INTO analysis_claims (key, expires_at, token) VALUES (?, ?, ?)",
+                                          (key, now + lease_seconds, token)).rowcount == 1
+        return token if inserted else None
+
+    def is_claimed(self, key: str) -> bool:
+        with self._lock:
+            return self._connection().execute("SELECT 1 FROM analysis_claims WHERE key = ? AND expires_at > ?",
+                                      (key, time.time())).fetchone() is not None
+
+    def release(self, key: str, token: str) -> None:
+        with self._lock, self._connection() as conn:
+            conn.execute("DELETE FROM analysis_claims WHERE key = ? AND token = ?", (key, token))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+
+
+class RedisAnalysisCache(AnalysisCache):
+    """AnalysisCache in Redis (or any Redis-protocol server), for workers spread over several hosts."""
+
+    backend = "redis"
+    blocking = True
+    _PREFIX = "trial_matcher:analysis:"
+    _CLAIM_PREFIX = "trial_matcher:analysis_claim:"
+    # Delete the claim only if it still holds our token, atomically on the server
+    _RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url: str = ANALYSIS_CACHE_REDIS_URL, ttl_seconds: float = ANALYSIS_CACHE_TTL_SECONDS):
+        super().__init__(ttl_seconds=ttl_seconds)
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("ANALYSIS_CACHE_BACKEND=redis needs the `redis` package (pip install redis)") from e
+        self._redis = redis.Redis.from_url(url)
+        self._release = self._redis.register_script(self._RELEASE_SCRIPT)
+        logger.info(f"Shared analysis cache using Redis at {url}")
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._redis.get(self._PREFIX + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decode_result(value)
+
+    def set(self, key: str, value: Any) -> None:
+        # Size is bounded by the TTL and the server's maxmemory policy rather than max_entries
+        self._redis.set(self._PREFIX + key, encode_result(value), ex=int(self.ttl_seconds))
+
+    def claim(self, key: str, lease_seconds: float = ANALYSIS_CACHE_CLAIM_SECONDS) -> Optional[str]:
+        token = uuid.uuid4().hex
+        claimed = self._redis.set(self._CLAIM_PREFIX + key, token, nx=True, ex=max(1, int(lease_seconds)))
+        return token if claimed else None
+
+    def is_claimed(self, key: str) -> bool:
+        return bool(self._redis.exists(self._CLAIM_PREFIX + key))
+
+    def release(self, key: str, token: str) -> None:
+        self._release(keys=[self._CLAIM_PREFIX + key], args=[token])
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self._redis.scan_iter(match=self._PREFIX + "*", count=1000))
+
+    def close(self) -> None:
+        self._redis.close()
+
+
+def _build_analysis_cache() -> AnalysisCache:
+    if ANALYSIS_CACHE_BACKEND == "sqlite":
+        return SqliteAnalysisCache()
+    if ANALYSIS_CACHE_BACKEND == "redis":
+        return RedisAnalysisCache()
+    return AnalysisCache()
+
+
+analysis_cache = _build_analysis_cache()
@@ -0,0 +1,48 @@
+"""Cold-start import cost of the API module, with a budget check for CI.
+
+Run from the backend directory:
+    python -m benchmarks.bench_import_time [module]
+
+Imports the module in a fresh interpreter under `-X importtime`, prints the slowest
+direct imports and exits non-zero if the total exceeds IMPORT_TIME_BUDGET_MS.
+"""
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1000"))
+
+
+def measure(module: str) -> Tuple[float, List[Tuple[float, str]]]:
+    """Return (total ms for `module`, [(cumulative ms, name)] for the modules it imports directly)."""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+    )
+    total_ms = 0.0
+    children: List[Tuple[float, str]] = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, raw_name = line.split("|")
+        depth = (len(raw_name) - len(raw_name.lstrip()) - 1) // 2
+        ms = int(cumulative) / 1000
+        # Children are reported before their parent, so collect depth-1 entries until the module itself
+        if depth == 1:
+            children.append((ms, raw_name.strip()))
+        elif depth == 0:
+            if raw_name.strip() == module:
+                total_ms = ms
+                break
+            children = []
+    return total_ms, sorted(children, reverse=True)
+
+
+if __name__ == "__main__":
+    module = sys.argv[1] if len(sys.argv) > 1 else "main"
+    total_ms, direct_imports = measure(module)
+    for ms, name in direct_imports[:10]:
+        print(f"{ms:10.1f} ms  {name}")
+    print(f"import {module}: {total_ms:.1f} ms (budget {IMPORT_TIME_BUDGET_MS:.0f} ms)")
+    sys.exit(0 if total_ms <= IMPORT_TIME_BUDGET_MS else 1)
@@ -0,0 +1,97 @@
+"""Parse and validation cost per trial for LLM JSON output, and how malformed outputs fare.
+
+Run from the backend directory:
+    python -m benchmarks.bench_llm_parsing [iterations]
+
+Times the old json.loads + LLMAnalysisResult(**...) path, model_validate_json and
+LlmJsonParser on well-formed analyzer output and on the agent's nested
+TrialAnalysisResponse, then runs each common malformation through the parser.
+"""
+import json
+import sys
+import time
+
+from llm_output import LlmJsonParser
+from models import LLMAnalysisResult, TrialAnalysisResponse
+
+_ANALYSIS = {
+    "decision": "Potential Match",
+    "reasoning_steps": [f"Step {i}: compared the patient's history against criterion {i}." for i in range(8)],
+    "match_rationale": ["Diagnosis matches the trial condition", "Stage IV disease", "ECOG 1 within 0-1"],
+    "flags": ["Requires confirmation: no prior EGFR TKI", "Brain metastases status not documented"],
+}
+_AGENT_RESPONSE = {
+    "status": "success",
+    "match_data": {
+        "id": "NCT05933044", "title": "Lung Cancer Trial A (EGFR+)", "status": "Recruiting", "phase": "Phase 3",
+        "condition": "Non-Small Cell Lung Cancer", "locations": ["Location Pending API"],
+        "matchRationale": _ANALYSIS["match_rationale"], "flags": _ANALYSIS["flags"],
+        "detailsUrl": "https://clinicaltrials.gov/study/NCT05933044", "contactInfo": "Contact Pending API", "rank_score": 0.82,
+    },
+    "llm_analysis": _ANALYSIS,
+}
+
+_WELL_FORMED = json.dumps(_ANALYSIS)
+_MALFORMED = {
+    "code fence": f"```json\n{json.dumps(_ANALYSIS, indent=2)}\n```",
+    "surrounding prose": f"Here is my analysis:\n{_WELL_FORMED}\nLet me know if you need more.",
+    "trailing commas": _WELL_FORMED.replace('"]', '",]').replace("]}", "],}"),
+    "raw newline in string": _WELL_FORMED.replace("Step 3: ", "Step 3:\n"),
+    "truncated array": _WELL_FORMED[:_WELL_FORMED.index("Step 5")],
+    "truncated after key": _WELL_FORMED[:_WELL_FORMED.index('"flags"') + len('"flags":')],
+    "truncated decision": _WELL_FORMED[:20],
+}
+
+
+def _time(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_well_formed(iterations: int) -> None:
+    analysis_parser = LlmJsonParser(LLMAnalysisResult)
+    agent_parser = LlmJsonParser(TrialAnalysisResponse)
+    agent_json = json.dumps(_AGENT_RESPONSE)
+    rows = (
+        ("analysis json.loads + **", lambda: LLMAnalysisResult(**json.loads(_WELL_FORMED))),
+        ("analysis model_validate_json", lambda: LLMAnalysisResult.model_validate_json(_WELL_FORMED)),
+        ("analysis LlmJsonParser", lambda: analysis_parser.parse(_WELL_FORMED)),
+        ("agent json.loads + **", lambda: TrialAnalysisResponse(**json.loads(agent_json))),
+        ("agent LlmJsonParser", lambda: agent_parser.parse(agent_json)),
+    )
+    for name, fn in rows:
+        print(f"{name:32} {_time(fn, iterations) * 1e6:9.1f} us per trial")
+
+
+def bench_malformed(iterations: int) -> None:
+    parser = LlmJsonParser(LLMAnalysisResult)
+    for name, text in _MALFORMED.items():
+        try:
+            json.loads(text)
+            legacy = "ok"
+        except ValueError:
+            legacy = "hard error"
+        try:
+            value, repaired = parser.parse_with_repair_flag(text)
+            outcome = f"{'repaired' if repaired else 'ok'} ({len(value.reasoning_steps)} steps, {len(value.flags)} flags)"
+            elapsed = _time(lambda: parser.parse(text), iterations)
+        except ValueError:
+            outcome, elapsed = "failed", _time(lambda: _failing_parse(parser, text), iterations)
+        print(f"{name:24} legacy: {legacy:10} parser: {outcome:32} {elapsed * 1e6:9.1f} us")
+
+
+def _failing_parse(parser: LlmJsonParser, text: str) -> None:
+    try:
+        parser.parse(text)
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"{iterations} iterations, mean per parse:")
+    bench_well_formed(iterations)
+    print("\nMalformed analyzer output:")
+    bench_malformed(max(1, iterations // 10))
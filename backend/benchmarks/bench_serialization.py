@@ -0,0 +1,89 @@
+"""Response serialization cost for large match lists: the old dict + stdlib json path vs model_dump_json.
+
+Run from the backend directory:
+    python -m benchmarks.bench_serialization [matches] [iterations]
+
+Also times building the analyzer agent's input, which used to round-trip the
+profile and trial through model_dump and json.dumps for every trial.
+"""
+import json
+import sys
+import time
+from datetime import datetime, timezone
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from models import PatientProfile, TrialData, TrialMatch, TrialSearchResponse
+
+
+def _matches(count: int) -> list:
+    return [
+        TrialMatch(
+            id=f"NCT{i:08d}", title=f"Trial {i} for Advanced Widgetitis", status="Recruiting", phase="Phase 3",
+            condition="Widgetitis", locations=["City Hospital", "Regional Clinic"],
+            matchRationale=["Matches diagnosis: Widgetitis Stage IV", "Meets age criteria (55)", "ECOG 1 within 0-2"],
+            flags=["Requires confirmation: eGFR > 60"], detailsUrl=f"https://clinicaltrials.gov/study/NCT{i:08d}",
+            contactInfo="Contact Pending API", rank_score=0.9,
+        )
+        for i in range(count)
+    ]
+
+
+def _time(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_response(matches: list, iterations: int) -> None:
+    timestamp = datetime.now(timezone.utc).isoformat()
+    match_dicts = [match.model_dump() for match in matches]
+
+    def legacy():
+        # Workflow returned dicts; the endpoint re-validated them and dumped through stdlib json
+        JSONResponse(content=TrialSearchResponse(matches=match_dicts, searchTimestamp=timestamp).model_dump())
+
+    def orjson_dict():
+        ORJSONResponse(content=TrialSearchResponse(matches=matches, searchTimestamp=timestamp).model_dump())
+
+    def model_dump_json():
+        TrialSearchResponse(matches=matches, searchTimestamp=timestamp).model_dump_json()
+
+    legacy_s = _time(legacy, iterations)
+    print(f"{'dict + json (legacy)':28} {legacy_s * 1e3:9.3f} ms")
+    for name, fn in (("model_dump + orjson", orjson_dict), ("model_dump_json", model_dump_json)):
+        elapsed = _time(fn, iterations)
+        print(f"{name:28} {elapsed * 1e3:9.3f} ms  ({legacy_s / elapsed:.1f}x)")
+
+
+def bench_analyzer_input(trial_count: int, iterations: int) -> None:
+    profile = PatientProfile(patientId="PATIENT_001", condition="Non-Small Cell Lung Cancer", age=62, stage="IV",
+                             priorTherapies=["Chemotherapy"], biomarkers=["EGFR Exon 19 Deletion"], notes="ECOG 1")
+    trials = [
+        TrialData(id=f"NCT{i:08d}", title=f"Trial {i}", condition="Non-Small Cell Lung Cancer", phase="3",
+                  status="Recruiting", min_age=18, required_markers=["EGFR"], inclusions=["ECOG 0-1"] * 5,
+                  exclusions=["Prior EGFR TKI"] * 5, eligibility_text="Adults with advanced NSCLC. " * 20)
+        for i in range(trial_count)
+    ]
+
+    def legacy():
+        for trial in trials:
+            json.dumps({"patient_profile": profile.model_dump(), "trial": trial.model_dump()})
+
+    def current():
+        profile_json = profile.model_dump_json()
+        for trial in trials:
+            f'{{"patient_profile": {profile_json}, "trial": {trial.model_dump_json()}}}'
+
+    legacy_s, current_s = _time(legacy, iterations), _time(current, iterations)
+    print(f"{'analyzer input (legacy)':28} {legacy_s * 1e3:9.3f} ms")
+    print(f"{'analyzer input (current)':28} {current_s * 1e3:9.3f} ms  ({legacy_s / current_s:.1f}x)")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print(f"{count} matches, {iterations} iterations, mean per call:")
+    bench_response(_matches(count), iterations)
+    bench_analyzer_input(count, iterations)
@@ -0,0 +1,43 @@
+"""Per-request orchestration overhead: building a workflow per call vs leasing from the pool.
+
+Run from the backend directory:
+    python -m benchmarks.bench_workflow_pool [iterations]
+
+No LLM calls are made; only object construction and tool schema generation are timed.
+"""
+import sys
+import time
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import services
+from workflow import ClinicalTrialMatchingWorkflow
+
+
+def bench_rebuild(iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        workflow = ClinicalTrialMatchingWorkflow()
+        # Tool schemas are generated on an agent's first run; include that cost
+        workflow.prebuild_tool_schemas()
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_pool(iterations: int) -> float:
+    pool = services.WorkflowPool(size=1)
+    pool.warm()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with pool.lease():
+            pass
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rebuild = bench_rebuild(iterations)
+    pooled = bench_pool(iterations)
+    print(f"rebuild per request: {rebuild * 1e6:10.1f} us")
+    print(f"pooled per request:  {pooled * 1e6:10.1f} us")
+    print(f"speedup:             {rebuild / pooled:10.1f}x")
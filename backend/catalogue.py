@@ -0,0 +1,49 @@
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+from models import TrialData
+from criteria import extract_structured_criteria
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.catalogue", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/catalogue.log")
+
+
+class TrialCatalogue:
+    """In-memory trial catalogue. Structured criteria are parsed once, at ingest time."""
+
+    def __init__(self, trials: Iterable[Dict[str, Any]] = ()):
+        self._trials: Dict[str, TrialData] = {}
+        self.version = 0
+        for trial_dict in trials:
+            self._ingest(trial_dict)
+        logger.info(f"Trial catalogue loaded with {len(self._trials)} trials")
+
+    def _ingest(self, trial_dict: Dict[str, Any]) -> Optional[TrialData]:
+        try:
+            trial = TrialData(**trial_dict)
+        except Exception as e:
+            logger.warning(f"Could not parse trial dict into TrialData model: {trial_dict}. Error: {e}")
+            return None
+        trial.structured_criteria = extract_structured_criteria(trial)
+        self._trials[trial.id] = trial
+        return trial
+
+    def upsert(self, trial_dict: Dict[str, Any]) -> Optional[TrialData]:
+        trial = self._ingest(trial_dict)
+        if trial:
+            self.version += 1
+        return trial
+
+    def get(self, trial_id: str) -> Optional[TrialData]:
+        return self._trials.get(trial_id)
+
+    def all(self) -> List[TrialData]:
+        return list(self._trials.values())
+
+    def __len__(self) -> int:
+        return len(self._trials)
+
+    def search(self, condition: str, status: str = "Recruiting") -> List[TrialData]:
+        condition = condition.lower()
+        # Iterate a copy: searches may run in an offload thread while upserts land on the event loop
+        return [t for t in self.all() if condition in t.condition.lower() and t.status == status]
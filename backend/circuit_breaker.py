@@ -0,0 +1,186 @@
+import asyncio
+import contextvars
+import os
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, Awaitable, Deque, Dict, Optional, Tuple, TypeVar
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.circuit_breaker", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/circuit_breaker.log")
+
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "5"))
+LLM_BREAKER_FAILURE_RATE = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5"))
+# Calls slower than this count as failures; calls are cancelled after LLM_BREAKER_CALL_TIMEOUT_SECONDS
+LLM_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("LLM_BREAKER_SLOW_CALL_SECONDS", "20"))
+LLM_BREAKER_CALL_TIMEOUT_SECONDS = float(os.getenv("LLM_BREAKER_CALL_TIMEOUT_SECONDS", "60"))
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+LLM_BREAKER_HALF_OPEN_PROBES = int(os.getenv("LLM_BREAKER_HALF_OPEN_PROBES", "1"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+T = TypeVar("T")
+
+# Set while a guarded call runs, so calls nested inside it are recorded but not gated
+# a second time.
+_inside_guarded_call: contextvars.ContextVar[bool] = contextvars.ContextVar("inside_guarded_call", default=False)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the LLM while the breaker is open."""
+
+
+class CircuitBreaker:
+    """Failure-rate and slow-call circuit breaker for the LLM backend.
+
+    Outcomes of the last `window` calls are kept. Once at least `min_calls` are in
+    the window and the share of failed or slow calls reaches `failure_rate`, the
+    breaker opens and calls fail fast for `open_seconds`. It then goes half-open and
+    lets `half_open_probes` calls through: a success closes it, a failure re-opens it.
+    While half-open, results of other calls (nested or started earlier) are ignored.
+    """
+
+    def __init__(self, name: str, window: int = LLM_BREAKER_WINDOW, min_calls: int = LLM_BREAKER_MIN_CALLS,
+                 failure_rate: float = LLM_BREAKER_FAILURE_RATE, slow_call_seconds: float = LLM_BREAKER_SLOW_CALL_SECONDS,
+                 call_timeout: float = LLM_BREAKER_CALL_TIMEOUT_SECONDS, open_seconds: float = LLM_BREAKER_OPEN_SECONDS,
+                 half_open_probes: int = LLM_BREAKER_HALF_OPEN_PROBES):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.call_timeout = call_timeout
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._outcomes: Deque[Tuple[bool, float]] = deque(maxlen=window)  # (failed, latency)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            logger.info(f"Circuit {self.name} half-open; probing the backend")
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls would be rejected outright (open and not yet due for a probe)."""
+        return self.state == OPEN
+
+    def stats(self) -> Dict[str, Any]:
+        failures = sum(1 for failed, _ in self._outcomes if failed)
+        return {
+            "state": self.state,
+            "windowCalls": len(self._outcomes),
+            "windowFailures": failures,
+            "timesOpened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+    def _open(self, reason: str) -> None:
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.times_opened += 1
+        logger.warning(f"Circuit {self.name} opened: {reason}")
+
+    def _allow(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+            self._probes_in_flight += 1
+            return True
+        return False
+
+    def _record(self, failed: bool, latency: float, probe: bool) -> None:
+        failed = failed or latency >= self.slow_call_seconds
+        if self._state == HALF_OPEN:
+            if not probe:
+                return  # Nested in a probe, or started before the breaker opened: only the probe decides
+            self._probes_in_flight -= 1
+            if failed:
+                self._open(f"probe failed after {latency:.1f}s")
+            else:
+                self._state = CLOSED
+                self._outcomes.clear()
+                logger.info(f"Circuit {self.name} closed after a successful probe")
+            return
+        if self._state == OPEN:
+            return  # Late result of a call started before the breaker opened
+        self._outcomes.append((failed, latency))
+        if len(self._outcomes) >= self.min_calls:
+            rate = sum(1 for f, _ in self._outcomes if f) / len(self._outcomes)
+            if rate >= self.failure_rate:
+                self._open(f"{rate:.0%} of the last {len(self._outcomes)} calls failed or were slow")
+
+    async def call(self, awaitable: Awaitable[T]) -> T:
+        """Await an LLM call under the breaker.
+
+        Raises:
+            CircuitOpenError: if the breaker is open; the awaitable is not run.
+        """
+        nested = _inside_guarded_call.get()
+        probe = False
+        if not nested:
+            if not self._allow():
+                self.rejected += 1
+                if asyncio.iscoroutine(awaitable):
+                    awaitable.close()
+                raise CircuitOpenError(f"Circuit {self.name} is open")
+            probe = self._state == HALF_OPEN
+        token = _inside_guarded_call.set(True)
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(awaitable, timeout=self.call_timeout) if not nested else await awaitable
+        except asyncio.CancelledError:
+            if probe:
+                self._probes_in_flight -= 1
+            raise
+        except Exception:
+            self._record(True, time.monotonic() - started, probe)
+            raise
+        finally:
+            _inside_guarded_call.reset(token)
+        self._record(False, time.monotonic() - started, probe)
+        return result
+
+
+class _GuardedCompletions:
+    def __init__(self, completions: Any, breaker: CircuitBreaker):
+        self._completions = completions
+        self._breaker = breaker
+
+    async def create(self, **kwargs: Any) -> Any:
+        return await self._breaker.call(self._completions.create(**kwargs))
+
+    async def parse(self, **kwargs: Any) -> Any:
+        return await self._breaker.call(self._completions.parse(**kwargs))
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._completions, name)
+
+
+class GuardedClient:
+    """An AsyncOpenAI client whose chat completion calls each go through a circuit breaker.
+
+    Agent runs chain several model calls and tool calls; guarding each completion rather
+    than the whole run keeps a long multi-step run from counting as one slow call.
+    """
+
+    def __init__(self, client: Any, breaker: CircuitBreaker):
+        self._client = client
+        self.chat = SimpleNamespace(completions=_GuardedCompletions(client.chat.completions, breaker))
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=_GuardedCompletions(client.beta.chat.completions, breaker)))
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+llm_breaker = CircuitBreaker("llm")
@@ -0,0 +1,114 @@
+import gzip
+import os
+from typing import Any, Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from metrics import metrics
+from logger import setup_logger
+
+try:
+    import brotli  # optional: "br" is only offered when the package is installed
+except ImportError:
+    brotli = None
+
+logger = setup_logger("trial_matcher.compression", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/compression.log")
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+# Smaller bodies are sent as-is: the headers and CPU outweigh the saving
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+
+_COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+metrics.describe("http_compressed_responses_total", "Responses sent compressed, by content encoding")
+metrics.describe("http_compression_bytes_total", "Bytes of compressed responses before (original) and after (sent) compression")
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick 'br' or 'gzip' from an Accept-Encoding header, or None to send the body as-is."""
+    accepted: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    wildcard = accepted.get("*", 0.0)
+    if brotli is not None and accepted.get("br", wildcard) > 0:
+        return "br"
+    if accepted.get("gzip", wildcard) > 0:
+        return "gzip"
+    return None
+
+
+class CompressionMiddleware:
+    """ASGI middleware that gzip- or brotli-compresses JSON and text responses.
+
+    Only complete bodies of at least `minimum_size` bytes are compressed; streamed
+    responses (more_body) and anything already encoded pass through untouched.
+    Strong ETags on compressed responses are weakened, since the bytes differ from
+    the identity representation.
+    """
+
+    def __init__(self, app: Any, minimum_size: int = COMPRESSION_MIN_BYTES, gzip_level: int = COMPRESSION_GZIP_LEVEL,
+                 brotli_quality: int = COMPRESSION_BROTLI_QUALITY):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        pending_start: Optional[Dict[str, Any]] = None
+
+        async def send_compressed(message: Dict[str, Any]) -> None:
+            nonlocal pending_start
+            if message["type"] == "http.response.start":
+                # Held back until the first body message shows whether the body is complete
+                pending_start = message
+                return
+            if message["type"] != "http.response.body" or pending_start is None:
+                await send(message)
+                return
+            start, pending_start = pending_start, None
+            headers = MutableHeaders(raw=list(start.get("headers", [])))
+            body = message.get("body", b"")
+            compressible = headers.get("content-type", "").startswith(_COMPRESSIBLE_TYPES)
+            if compressible:
+                headers.add_vary_header("Accept-Encoding")
+            if (not compressible or message.get("more_body", False) or len(body) < self.minimum_size
+                    or "content-encoding" in headers or start["status"] in (204, 304)):
+                await send({**start, "headers": headers.raw})
+                await send(message)
+                return
+
+            compressed = self._compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = f"W/{etag}"
+            metrics.inc("http_compressed_responses_total", encoding=encoding)
+            metrics.inc("http_compression_bytes_total", len(body), kind="original")
+            metrics.inc("http_compression_bytes_total", len(compressed), kind="sent")
+            await send({**start, "headers": headers.raw})
+            await send({**message, "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
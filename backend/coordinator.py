@@ -0,0 +1,270 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import httpx
+from fastapi import FastAPI, Header, HTTPException, Query, Request, status
+from fastapi.responses import ORJSONResponse, Response
+
+from compression import COMPRESSION_ENABLED, CompressionMiddleware
+from models import (JobStatusResponse, PatientProfile, PatientSearchRequest, PatientSearchResponse,
+                    RematchSummary, StoredMatchesResponse, TrialData, TrialSearchRequest)
+from sharding import HashRing, shard_nodes, shard_ring
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.coordinator", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/coordinator.log")
+
+SHARD_REQUEST_TIMEOUT_SECONDS = float(os.getenv("SHARD_REQUEST_TIMEOUT_SECONDS", "300"))
+# Largest page a shard's reverse-matching endpoint serves (PatientSearchRequest.pageSize)
+_SHARD_MAX_PAGE_SIZE = 100
+# Response headers relayed from a shard to the client
+_FORWARDED_HEADERS = ("retry-after", "etag", "cache-control")
+
+ShardResult = Union[httpx.Response, Exception]
+
+
+class ShardCoordinator:
+    """Routes patient-keyed requests to the owning shard and fans population queries out to all of them.
+
+    Shards are ordinary API nodes started with SHARD_ID set, each holding the patients
+    the hash ring assigns to it plus their match store and analysis cache. The trial
+    catalogue is replicated to every shard.
+    """
+
+    def __init__(self, nodes: Dict[str, str], ring: HashRing, timeout: float = SHARD_REQUEST_TIMEOUT_SECONDS):
+        self.nodes = nodes
+        self.ring = ring
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self) -> None:
+        if not self.nodes:
+            raise RuntimeError("Coordinator needs SHARD_NODES (name=url pairs) to route to")
+        self._client = httpx.AsyncClient(timeout=self.timeout)
+        logger.info(f"Coordinating {len(self.nodes)} shards: {self.nodes}")
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def node_for_patient(self, patient_id: str) -> str:
+        return self.ring.node_for(patient_id)
+
+    async def request(self, node: str, method: str, path: str, **kwargs: Any) -> httpx.Response:
+        return await self._client.request(method, self.nodes[node] + path, **kwargs)
+
+    async def fan_out(self, method: str, path: str, **kwargs: Any) -> Dict[str, ShardResult]:
+        """Send the same request to every shard; failures come back as exceptions, not raised."""
+        results = await asyncio.gather(*(self.request(node, method, path, **kwargs) for node in self.nodes),
+                                       return_exceptions=True)
+        for node, result in zip(self.nodes, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Shard {node} failed {method} {path}: {result!r}")
+        return dict(zip(self.nodes, results))
+
+    async def _shard_top_patients(self, node: str, trial_id: str, needed: int,
+                                  context: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """A shard's best `needed` matches for a trial, read page by page if needed exceeds one page."""
+        page_size = min(needed, _SHARD_MAX_PAGE_SIZE)
+        matches: List[Dict[str, Any]] = []
+        page = 1
+        while True:
+            response = await self.request(node, "POST", "/api/v1/patients/find-for-trial",
+                                          json={"trialId": trial_id, "page": page, "pageSize": page_size, "context": context})
+            if response.status_code == status.HTTP_404_NOT_FOUND:
+                return {"notFound": True}
+            response.raise_for_status()
+            body = response.json()
+            matches += body["matches"]
+            if len(matches) >= needed or page * page_size >= body["totalMatches"]:
+                return {"matches": matches[:needed], "totalMatches": body["totalMatches"],
+                        "candidatesScreened": body["candidatesScreened"], "candidatesAnalyzed": body.get("candidatesAnalyzed", 0)}
+            page += 1
+
+    async def find_patients_for_trial(self, trial_id: str, page: int, page_size: int,
+                                      context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Screen every shard's population for a trial and merge the ranked pages.
+
+        Each shard returns its own top page*page_size, which always contains every
+        patient of the global top page*page_size.
+        """
+        needed = page * page_size
+        results = await asyncio.gather(*(self._shard_top_patients(node, trial_id, needed, context) for node in self.nodes),
+                                       return_exceptions=True)
+        by_node = dict(zip(self.nodes, results))
+        failed = [node for node, result in by_node.items() if isinstance(result, Exception)]
+        for node in failed:
+            logger.warning(f"Shard {node} failed reverse matching for {trial_id}: {by_node[node]!r}")
+        answered = [result for result in by_node.values() if not isinstance(result, Exception)]
+        if answered and all(result.get("notFound") for result in answered):
+            return {"error_type": "TRIAL_NOT_FOUND", "message": f"Trial {trial_id} not found."}
+        if not answered:
+            return {"error_type": "SHARDS_UNAVAILABLE", "message": f"No shard answered: {', '.join(failed)}"}
+
+        found = [result for result in answered if not result.get("notFound")]
+        merged = sorted((m for result in found for m in result["matches"]),
+                        key=lambda m: (-(m.get("rank_score") or 0.0), m["patientId"]))
+        start = (page - 1) * page_size
+        return {
+            "status": "partial" if failed else "success",
+            "trialId": trial_id,
+            "matches": merged[start:start + page_size],
+            "totalMatches": sum(result["totalMatches"] for result in found),
+            "page": page,
+            "pageSize": page_size,
+            "candidatesScreened": sum(result["candidatesScreened"] for result in found),
+            "candidatesAnalyzed": sum(result["candidatesAnalyzed"] for result in found),
+            "unavailableShards": failed or None,
+        }
+
+
+coordinator = ShardCoordinator(shard_nodes, shard_ring)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await coordinator.start()
+    yield
+    await coordinator.close()
+
+
+app = FastAPI(
+    title="AI Clinical Trial Matching Service - Shard Coordinator",
+    description="Routes requests to the shard owning each patient and merges population-wide queries.",
+    version="0.2.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware)
+
+
+def _relay(response: httpx.Response) -> Response:
+    """Pass a shard's response through unchanged."""
+    headers = {name: response.headers[name] for name in _FORWARDED_HEADERS if name in response.headers}
+    return Response(content=response.content, status_code=response.status_code, headers=headers,
+                    media_type=response.headers.get("content-type"))
+
+
+async def _forward_to_owner(patient_id: str, method: str, path: str, **kwargs: Any) -> Response:
+    node = coordinator.node_for_patient(patient_id)
+    try:
+        return _relay(await coordinator.request(node, method, path, **kwargs))
+    except httpx.HTTPError as e:
+        logger.error(f"Shard {node} unreachable for patient {patient_id}: {e!r}")
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Shard {node} owning patient {patient_id} is unavailable.")
+
+
+def _ok_bodies(results: Dict[str, ShardResult]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """JSON bodies of the shards that answered 200, and the names of those that failed."""
+    bodies, failed = [], []
+    for node, result in results.items():
+        if isinstance(result, Exception) or result.status_code != status.HTTP_200_OK:
+            failed.append(node)
+        else:
+            bodies.append(result.json())
+    return bodies, failed
+
+
+# --- Patient-keyed requests go to the owning shard ---
+@app.post("/api/v1/trials/find", summary="Find trials for a patient (routed to the patient's shard)")
+async def find_trials(request: TrialSearchRequest, http_request: Request):
+    return await _forward_to_owner(request.patientId, "POST", "/api/v1/trials/find", content=await http_request.body(),
+                                   headers={"content-type": "application/json"})
+
+
+@app.post("/api/v1/jobs/trials/find", status_code=status.HTTP_202_ACCEPTED, response_model=JobStatusResponse,
+          summary="Queue a trial matching job on the patient's shard")
+async def submit_find_trials_job(request: TrialSearchRequest, http_request: Request,
+                                 idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    headers = {"content-type": "application/json"}
+    if idempotency_key:
+        headers["Idempotency-Key"] = idempotency_key
+    return await _forward_to_owner(request.patientId, "POST", "/api/v1/jobs/trials/find",
+                                   content=await http_request.body(), headers=headers)
+
+
+@app.get("/api/v1/jobs/{job_id}", response_model=JobStatusResponse, summary="Get a job from whichever shard queued it")
+async def get_job(job_id: str):
+    # Job ids do not encode the patient, so ask every shard; only the one that queued it knows it
+    results = await coordinator.fan_out("GET", f"/api/v1/jobs/{job_id}")
+    for result in results.values():
+        if not isinstance(result, Exception) and result.status_code == status.HTTP_200_OK:
+            return _relay(result)
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job '{job_id}' not found.")
+
+
+@app.put("/api/v1/patients/{patient_id}", response_model=RematchSummary, summary="Update a patient on its shard")
+async def put_patient(patient_id: str, profile: PatientProfile):
+    return await _forward_to_owner(patient_id, "PUT", f"/api/v1/patients/{patient_id}", json=profile.model_dump())
+
+
+@app.get("/api/v1/patients/{patient_id}/matches", response_model=StoredMatchesResponse,
+         summary="Stored matches for a patient, from its shard")
+async def get_patient_matches(patient_id: str, min_rank_score: Optional[float] = None,
+                              limit: int = Query(100, ge=1, le=1000), if_none_match: Optional[str] = Header(None)):
+    params = {"limit": limit, **({"min_rank_score": min_rank_score} if min_rank_score is not None else {})}
+    headers = {"If-None-Match": if_none_match} if if_none_match else {}
+    return await _forward_to_owner(patient_id, "GET", f"/api/v1/patients/{patient_id}/matches", params=params, headers=headers)
+
+
+# --- Population-wide requests fan out to every shard ---
+@app.post("/api/v1/patients/find-for-trial", response_model=PatientSearchResponse,
+          summary="Find eligible patients for a trial across all shards")
+async def find_patients(request: PatientSearchRequest):
+    context = request.context.model_dump() if request.context else None
+    result = await coordinator.find_patients_for_trial(request.trialId, request.page, request.pageSize, context)
+    if result.get("error_type") == "TRIAL_NOT_FOUND":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=result["message"])
+    if "error_type" in result:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=result["message"])
+    return PatientSearchResponse(**result, searchTimestamp=datetime.now(timezone.utc).isoformat())
+
+
+@app.get("/api/v1/trials/{trial_id}/matches", response_model=StoredMatchesResponse,
+         summary="Stored matches for a trial, merged across shards")
+async def get_trial_matches(trial_id: str, min_rank_score: Optional[float] = None,
+                            limit: int = Query(100, ge=1, le=1000)):
+    params = {"limit": limit, **({"min_rank_score": min_rank_score} if min_rank_score is not None else {})}
+    bodies, failed = _ok_bodies(await coordinator.fan_out("GET", f"/api/v1/trials/{trial_id}/matches", params=params))
+    if failed and not bodies:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"No shard answered: {', '.join(failed)}")
+    merged = sorted((m for body in bodies for m in body["matches"]),
+                    key=lambda m: (-(m.get("rank_score") or 0.0), m["patientId"]))[:limit]
+    return StoredMatchesResponse(status="partial" if failed else "success", matches=merged, count=len(merged))
+
+
+@app.put("/api/v1/trials/{trial_id}", response_model=RematchSummary, summary="Update a trial on every shard")
+async def put_trial(trial_id: str, trial: TrialData):
+    if trial.id != trial_id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Trial ID in path and body must match.")
+    # The catalogue is replicated; each shard re-matches its own patients
+    bodies, failed = _ok_bodies(await coordinator.fan_out(
+        "PUT", f"/api/v1/trials/{trial_id}", json=trial.model_dump(exclude={"structured_criteria"})))
+    if failed:
+        # Upserts are idempotent, so the client can retry until every shard has the new version
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
+                            detail=f"Trial update failed on shards {', '.join(failed)}; retry the request.")
+    summary = RematchSummary(trigger=f"trial:{trial_id}")
+    for body in bodies:
+        for counter in ("pairsRecomputed", "pairsSkipped", "pairsFailed", "matchesAdded", "matchesRemoved"):
+            setattr(summary, counter, getattr(summary, counter) + body[counter])
+    return summary
+
+
+@app.get("/health", summary="Coordinator and shard health")
+async def health_check():
+    results = await coordinator.fan_out("GET", "/health")
+    shards = {
+        node: {"url": coordinator.nodes[node],
+               "health": result.json() if not isinstance(result, Exception) and result.status_code == status.HTTP_200_OK else None}
+        for node, result in results.items()
+    }
+    healthy = all(shard["health"] is not None for shard in shards.values())
+    return {"status": "ok" if healthy else "degraded", "role": "coordinator", "shards": shards}
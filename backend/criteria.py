@@ -0,0 +1,163 @@
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+from models import CriteriaEvaluation, NumericCriterion, PatientFeatures, StructuredCriteria, TrialData
+from patient_features import feature_value, features_for, lab_name, opposite_biomarker, required_biomarker
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.criteria", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/criteria.log")
+
+# --- Patterns for criteria we can evaluate without an LLM ---
+_NUMBER = r"(\d+(?:\.\d+)?)"
+_LAB = r"(eGFR|HbA1c|A1c)"
+_UNIT = r"\s*(?:%|ml/min(?:/1\.73\s*m2)?|mL/min(?:/1\.73\s*m2)?)?"
+_COMPARATORS = {"<": ("max", False), "<=": ("max", True), "≤": ("max", True),
+                ">": ("min", False), ">=": ("min", True), "≥": ("min", True)}
+
+_ECOG_RANGE_RE = re.compile(r"^ECOG\s*(?:PS\s*)?(?:of\s*)?(\d)\s*(?:-|–|to)\s*(\d)$", re.IGNORECASE)
+_ECOG_MAX_RE = re.compile(r"^ECOG\s*(?:PS\s*)?(?:<=|≤)\s*(\d)$", re.IGNORECASE)
+_LAB_COMPARE_RE = re.compile(rf"^{_LAB}\s*(<=|>=|<|>|≤|≥)\s*{_NUMBER}{_UNIT}$", re.IGNORECASE)
+_LAB_BETWEEN_RE = re.compile(rf"^{_LAB}\s*between\s*{_NUMBER}{_UNIT}\s*and\s*{_NUMBER}{_UNIT}$", re.IGNORECASE)
+_STAGE_RE = re.compile(r"^Stage\s+([IV]+)((?:\s*(?:,|or|and)\s*[IV]+)*)$", re.IGNORECASE)
+_ROMAN = {"I": 1, "II": 2, "III": 3, "IV": 4}
+
+
+def _parse_numeric_criterion(text: str, exclusion: bool) -> Optional[NumericCriterion]:
+    cleaned = text.strip().rstrip(".")
+    match = _ECOG_RANGE_RE.match(cleaned)
+    if match:
+        return NumericCriterion(field="ecog", min_value=float(match.group(1)), max_value=float(match.group(2)),
+                                exclusion=exclusion, source=text)
+    match = _ECOG_MAX_RE.match(cleaned)
+    if match:
+        return NumericCriterion(field="ecog", max_value=float(match.group(1)), exclusion=exclusion, source=text)
+    match = _LAB_BETWEEN_RE.match(cleaned)
+    if match and lab_name(match.group(1), cleaned):
+        return NumericCriterion(field=lab_name(match.group(1), cleaned), min_value=float(match.group(2)),
+                                max_value=float(match.group(3)), exclusion=exclusion, source=text)
+    match = _LAB_COMPARE_RE.match(cleaned)
+    if match and lab_name(match.group(1), cleaned):
+        bound, inclusive = _COMPARATORS[match.group(2)]
+        value = float(match.group(3))
+        criterion = NumericCriterion(field=lab_name(match.group(1), cleaned), exclusion=exclusion, source=text)
+        if bound == "max":
+            criterion.max_value, criterion.max_inclusive = value, inclusive
+        else:
+            criterion.min_value, criterion.min_inclusive = value, inclusive
+        return criterion
+    return None
+
+
+def _parse_stages(text: str) -> Optional[List[str]]:
+    match = _STAGE_RE.match(text.strip().rstrip("."))
+    if not match:
+        return None
+    stages = [match.group(1).upper()] + re.findall(r"[IV]+", (match.group(2) or "").upper())
+    return stages if all(stage in _ROMAN for stage in stages) else None
+
+
+def extract_structured_criteria(trial: TrialData) -> StructuredCriteria:
+    """Parse a trial's free-text criteria once into a machine-checkable form.
+
+    Anything that does not fully match a known pattern is kept verbatim in the
+    residual fields so it can still be reviewed by the LLM.
+    """
+    criteria = StructuredCriteria(required_biomarkers=[required_biomarker(m) for m in trial.required_markers])
+    if trial.min_age is not None or trial.max_age is not None:
+        criteria.numeric.append(NumericCriterion(
+            field="age",
+            min_value=float(trial.min_age) if trial.min_age is not None else None,
+            max_value=float(trial.max_age) if trial.max_age is not None else None,
+            source=f"Age {trial.min_age if trial.min_age is not None else 0}-{trial.max_age if trial.max_age is not None else 'no max'}",
+        ))
+
+    for text in trial.inclusions:
+        stages = _parse_stages(text)
+        if stages and not criteria.allowed_stages:
+            criteria.allowed_stages, criteria.stage_source = stages, text
+            continue
+        numeric = _parse_numeric_criterion(text, exclusion=False)
+        if numeric:
+            criteria.numeric.append(numeric)
+        else:
+            criteria.residual_inclusions.append(text)
+
+    for text in trial.exclusions:
+        numeric = _parse_numeric_criterion(text, exclusion=True)
+        if numeric:
+            criteria.numeric.append(numeric)
+        else:
+            criteria.residual_exclusions.append(text)
+
+    residual_sentences = []
+    for sentence in re.split(r"(?<=\.)\s+", (trial.eligibility_text or "").strip()):
+        if not sentence:
+            continue
+        numeric = _parse_numeric_criterion(sentence, exclusion=False)
+        if numeric:
+            criteria.numeric.append(numeric)
+        else:
+            residual_sentences.append(sentence)
+    criteria.residual_eligibility_text = " ".join(residual_sentences) or None
+
+    logger.debug(f"Structured criteria for trial {trial.id}: {len(criteria.numeric)} numeric, "
+                 f"{len(criteria.residual_inclusions) + len(criteria.residual_exclusions)} residual")
+    return criteria
+
+
+def _in_range(value: float, criterion: NumericCriterion) -> bool:
+    if criterion.min_value is not None:
+        if value < criterion.min_value or (value == criterion.min_value and not criterion.min_inclusive):
+            return False
+    if criterion.max_value is not None:
+        if value > criterion.max_value or (value == criterion.max_value and not criterion.max_inclusive):
+            return False
+    return True
+
+
+def criterion_holds(criterion: NumericCriterion, value: float) -> bool:
+    """True if a known patient value satisfies the criterion (inside an inclusion range, outside an exclusion one)."""
+    return _in_range(value, criterion) != criterion.exclusion
+
+
+def evaluate_structured_criteria(criteria: StructuredCriteria, patient_profile: Dict[str, Any],
+                                 features: Optional[PatientFeatures] = None) -> CriteriaEvaluation:
+    """Check a patient against precomputed structured criteria, in-process.
+
+    Patient values come from `features` when given, else from the cached parse of the profile.
+    """
+    features = features or features_for(patient_profile)
+    met: List[str] = []
+    failed: List[str] = []
+    unknown: List[str] = []
+
+    for criterion in criteria.numeric:
+        value = feature_value(features, criterion.field)
+        if value is None:
+            unknown.append(f"{criterion.source} (patient {criterion.field} unknown)")
+        elif criterion_holds(criterion, value):
+            met.append(f"{criterion.source} (patient {criterion.field} {value:g})")
+        else:
+            failed.append(f"{criterion.source} (patient {criterion.field} {value:g})")
+
+    # Only a documented opposite status rules a patient out; a missing or unsigned result needs review
+    for marker in criteria.required_biomarkers:
+        opposite = opposite_biomarker(marker)
+        if marker in features.biomarkers:
+            met.append(f"Required biomarker {marker} present")
+        elif opposite in features.biomarkers:
+            failed.append(f"Required biomarker {marker} (patient {opposite})")
+        else:
+            unknown.append(f"Required biomarker {marker} (patient status not documented)")
+
+    if criteria.allowed_stages:
+        if not features.stage:
+            unknown.append(f"{criteria.stage_source} (patient stage unknown)")
+        elif features.stage in criteria.allowed_stages:
+            met.append(f"{criteria.stage_source} (patient stage {features.stage})")
+        else:
+            failed.append(f"{criteria.stage_source} (patient stage {features.stage})")
+
+    status = "ineligible" if failed else ("needs_review" if unknown else "eligible")
+    return CriteriaEvaluation(status=status, met=met, failed=failed, unknown=unknown)
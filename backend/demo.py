@@ -0,0 +1,43 @@
+"""Run the matching workflow for a few mock patients and print the results.
+
+Run from the backend directory:
+    python demo.py
+
+This lives outside services.py on purpose: workflow.py imports services by name, so
+running services.py as a script would load a second copy of it with its own singletons.
+"""
+import asyncio
+import json
+from typing import Any, Dict, List, Union
+
+from models import TrialMatch
+from services import run_trial_matching_workflow
+
+
+def _format_result(result: Union[List[TrialMatch], Dict[str, Any]]) -> str:
+    if isinstance(result, list):
+        return json.dumps([match.model_dump() for match in result], indent=2)
+    return json.dumps(result, indent=2, default=lambda model: model.model_dump())
+
+
+async def main():
+    test_patient_ids = ["PATIENT_001", "PATIENT_002", "PATIENT_NO_MATCH", "PATIENT_ERROR"]
+    # test_patient_ids = ["PATIENT_001"]
+
+    for p_id in test_patient_ids:
+        print(f"\n--- Running agent-based workflow for Patient ID: {p_id} ---")
+        result = await run_trial_matching_workflow(p_id, use_cache=True)
+        print(f"Result for {p_id} (1st run): {_format_result(result)}")
+
+        print(f"\n--- Running agent-based workflow for Patient ID: {p_id} (AGAIN to test cache) ---")
+        result_cached = await run_trial_matching_workflow(p_id, use_cache=True)
+        print(f"Result for {p_id} (2nd run): {_format_result(result_cached)}")
+
+        if p_id == "PATIENT_001":
+            print(f"\n--- Running agent-based workflow for Patient ID: {p_id} (NO CACHE) ---")
+            result_no_cache = await run_trial_matching_workflow(p_id, use_cache=False)
+            print(f"Result for {p_id} (no cache run): {_format_result(result_no_cache)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.jobs", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/jobs.log")
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "data/jobs.db")
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1.0"))
+# A running job's lease; its worker renews it every third of this. A job whose lease
+# lapses (the worker crashed or hung) is claimed again by any worker, in any process.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Claims per job before it is marked failed instead of being run again
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    idempotency_key TEXT UNIQUE,
+    patient_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result_json TEXT,
+    error_json TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    request_json TEXT,
+    available_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+"""
+# Columns added after the first release, for queue files created before them
+_ADDED_COLUMNS = {"lease_owner": "TEXT", "lease_expires_at": "REAL", "request_json": "TEXT", "available_at": "REAL"}
+
+# (patient_id, request options) -> (succeeded, result or error payload)
+JobHandler = Callable[[str, Dict[str, Any]], Awaitable[Tuple[bool, Dict[str, Any]]]]
+
+
+class JobDeferred(Exception):
+    """Raised by a handler that cannot run the job yet; it is queued again after `retry_after` seconds."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Job deferred for {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class JobQueue:
+    """Persistent SQLite-backed queue of trial matching jobs.
+
+    A claimed job holds a lease that its worker keeps renewing while it runs. Jobs
+    survive restarts: once a crashed worker's lease lapses, the job is claimed again,
+    up to JOB_MAX_ATTEMPTS times. Only the current lease owner can renew or finish a
+    job. Idempotency keys are unique, so client retries map to the same job.
+    The database is opened on first use, not on construction.
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_PATH, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Callers hold self._lock
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            existing = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in _ADDED_COLUMNS.items():
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            self._conn = conn
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    def _row_to_dict(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        return {
+            "jobId": row["id"],
+            "patientId": row["patient_id"],
+            "request": json.loads(row["request_json"]) if row["request_json"] else {},
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "result": json.loads(row["result_json"]) if row["result_json"] else None,
+            "error": json.loads(row["error_json"]) if row["error_json"] else None,
+            "createdAt": row["created_at"],
+            "updatedAt": row["updated_at"],
+        }
+
+    def submit(self, patient_id: str, idempotency_key: Optional[str] = None,
+               request: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], bool]:
+        """Enqueue a job, or return the existing one for a repeated idempotency key.
+
+        `request` holds the options the handler runs the job with (paging, diagnostics...).
+
+        Returns:
+            (job, created) where created is False for a deduplicated retry.
+
+        Raises:
+            ValueError: if the idempotency key was already used for a different request.
+        """
+        job_id = uuid.uuid4().hex
+        now = _now()
+        request_json = json.dumps(request or {}, sort_keys=True)
+        with self._lock:
+            conn = self._connection()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT INTO jobs (id, idempotency_key, patient_id, request_json, status, created_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                        (job_id, idempotency_key, patient_id, request_json, now, now),
+                    )
+                created = True
+            except sqlite3.IntegrityError:
+                row = conn.execute("SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+                if row["patient_id"] != patient_id or (row["request_json"] or "{}") != request_json:
+                    raise ValueError("Idempotency key was already used for a different request.")
+                job_id, created = row["id"], False
+            job = self._row_to_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+        return job, created
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._row_to_dict(self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def claim_next(self) -> Optional[Dict[str, Any]]:
+        """Atomically lease the oldest due queued (or lease-expired) job and return it.
+
+        Lease-expired jobs that already used JOB_MAX_ATTEMPTS claims are marked failed
+        first. The returned job carries its "leaseOwner" token for renew_lease and finish.
+        """
+        now = time.time()
+        owner = uuid.uuid4().hex
+        error = json.dumps({"error_type": "JOB_MAX_ATTEMPTS",
+                            "message": f"Job did not complete within {self.max_attempts} attempts."})
+        with self._lock, self._connection() as conn:
+            exhausted = conn.execute(
+                "UPDATE jobs SET status = 'failed', error_json = ?, lease_owner = NULL, updated_at = ? "
+                "WHERE status = 'running' AND COALESCE(lease_expires_at, 0) <= ? AND attempts >= ?",
+                (error, _now(), now, self.max_attempts),
+            ).rowcount
+            row = conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires_at = ?, updated_at = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE (status = 'queued' AND COALESCE(available_at, 0) <= ?) "
+                "OR (status = 'running' AND COALESCE(lease_expires_at, 0) <= ?) ORDER BY created_at LIMIT 1) "
+                "RETURNING *",
+                (owner, now + self.lease_seconds, _now(), now, now),
+            ).fetchone()
+        if exhausted:
+            logger.warning(f"Failed {exhausted} jobs that used all {self.max_attempts} attempts")
+        job = self._row_to_dict(row)
+        if job is not None:
+            if job["attempts"] > 1:
+                logger.warning(f"Job {job['jobId']} claimed again (attempt {job['attempts']} of {self.max_attempts})")
+            job["leaseOwner"] = owner
+        return job
+
+    def renew_lease(self, job_id: str, owner: str) -> bool:
+        """Extend a running job's lease; False if `owner` no longer holds it."""
+        with self._lock, self._connection() as conn:
+            return conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                (time.time() + self.lease_seconds, job_id, owner),
+            ).rowcount == 1
+
+    def release(self, job_id: str, owner: str, delay: float = 0.0) -> None:
+        """Hand a running job back to the queue without charging the attempt (e.g. on shutdown).
+
+        With a `delay` the job is not claimed again for that many seconds.
+        """
+        with self._lock, self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, lease_owner = NULL, lease_expires_at = NULL, "
+                "available_at = ?, updated_at = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                (time.time() + delay, _now(), job_id, owner),
+            )
+
+    def finish(self, job_id: str, owner: str, succeeded: bool, payload: Dict[str, Any]) -> bool:
+        """Record a job's outcome; False (and nothing written) if `owner` lost the lease meanwhile."""
+        column = "result_json" if succeeded else "error_json"
+        with self._lock, self._connection() as conn:
+            return conn.execute(
+                f"UPDATE jobs SET status = ?, {column} = ?, lease_owner = NULL, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                ("succeeded" if succeeded else "failed", json.dumps(payload), _now(), job_id, owner),
+            ).rowcount == 1
+
+
+class JobWorkerPool:
+    """Fixed pool of asyncio workers draining a JobQueue with bounded concurrency."""
+
+    def __init__(self, queue: JobQueue, handler: JobHandler, concurrency: int = JOB_WORKER_CONCURRENCY):
+        self.queue = queue
+        self._handler = handler
+        self.concurrency = concurrency
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def notify(self) -> None:
+        """Wake idle workers after a submit instead of waiting for the next poll."""
+        self._wakeup.set()
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+        logger.info(f"Started {self.concurrency} job workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            # Clear before claiming so a submit racing with an empty claim still wakes us
+            self._wakeup.clear()
+            job = await asyncio.to_thread(self.queue.claim_next)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            logger.info(f"Worker {worker_id} running job {job['jobId']} for patient {job['patientId']}")
+            heartbeat = asyncio.create_task(self._heartbeat(job))
+            try:
+                succeeded, payload = await self._handler(job["patientId"], job["request"])
+            except asyncio.CancelledError:
+                # Shutting down; hand the job back so another worker picks it up now, not after the lease
+                self.queue.release(job["jobId"], job["leaseOwner"])
+                raise
+            except JobDeferred as deferred:
+                logger.info(f"Job {job['jobId']} deferred for {deferred.retry_after}s")
+                await asyncio.to_thread(self.queue.release, job["jobId"], job["leaseOwner"], deferred.retry_after)
+                continue
+            except Exception as e:
+                logger.error(f"Job {job['jobId']} raised: {e}", exc_info=True)
+                succeeded, payload = False, {"error_type": "JOB_HANDLER_EXCEPTION", "message": str(e)}
+            finally:
+                heartbeat.cancel()
+            if await asyncio.to_thread(self.queue.finish, job["jobId"], job["leaseOwner"], succeeded, payload):
+                logger.info(f"Job {job['jobId']} finished with status {'succeeded' if succeeded else 'failed'}")
+            else:
+                logger.warning(f"Job {job['jobId']} lost its lease while running; result discarded")
+
+    async def _heartbeat(self, job: Dict[str, Any]) -> None:
+        """Renew the job's lease while it runs, so no other worker claims it."""
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            if not await asyncio.to_thread(self.queue.renew_lease, job["jobId"], job["leaseOwner"]):
+                logger.warning(f"Lease on job {job['jobId']} was lost; another worker may run it")
+                return
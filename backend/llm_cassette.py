@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ParsedChatCompletion
+
+from llm_output import LlmJsonParser
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.llm_cassette", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/llm_cassette.log")
+
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off").lower()  # off | record | replay
+LLM_CASSETTE_PATH = os.getenv("LLM_CASSETTE_PATH", "data/llm_cassette.jsonl")
+# Unset: replay with each call's recorded latency; otherwise a fixed latency in seconds
+LLM_CASSETTE_REPLAY_LATENCY_SECONDS = os.getenv("LLM_CASSETTE_REPLAY_LATENCY_SECONDS")
+
+_WHITESPACE = re.compile(r"\s+")
+# Volatile fields that differ between runs without changing what the model sees
+_VOLATILE_KEYS = {"id", "tool_call_id"}
+
+
+class CassetteMiss(KeyError):
+    """Raised in replay mode when no recording matches a request."""
+
+
+_parsers: Dict[type, LlmJsonParser] = {}
+
+
+def _replayed_parse(response: Dict[str, Any], response_format: Any) -> ParsedChatCompletion:
+    """Rebuild what the SDK's parse() returns: each message's content validated into `response_format`."""
+    completion = ParsedChatCompletion.model_validate(response)
+    if isinstance(response_format, type):
+        parser = _parsers.setdefault(response_format, LlmJsonParser(response_format))
+        for choice in completion.choices:
+            if choice.message.content:
+                choice.message.parsed = parser.parse(choice.message.content)
+    return completion
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        return _WHITESPACE.sub(" ", value).strip()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items() if k not in _VOLATILE_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, type):
+        return value.__name__  # Pydantic response_format for structured outputs
+    return value
+
+
+def cassette_key(method: str, kwargs: Dict[str, Any]) -> str:
+    """Key a request by its normalized model, prompt, tools and response format."""
+    material = {
+        "method": method,
+        "model": kwargs.get("model"),
+        "messages": _normalize(kwargs.get("messages")),
+        "tools": _normalize([t.get("function", {}).get("name") for t in kwargs.get("tools") or []]),
+        "response_format": _normalize(kwargs.get("response_format")),
+        "stream": bool(kwargs.get("stream")),
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """Append-only JSONL store of recorded LLM exchanges.
+
+    Identical requests may be recorded several times; replay serves them in
+    recording order and then keeps repeating the last one.
+    """
+
+    def __init__(self, path: str = LLM_CASSETTE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Deque[Dict[str, Any]]] = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries.setdefault(entry["key"], deque()).append(entry)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        logger.info(f"Cassette {path} loaded with {sum(len(q) for q in self._entries.values())} recordings")
+
+    def record(self, key: str, entry: Dict[str, Any]) -> None:
+        entry = {"key": key, **entry}
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            self._entries.setdefault(key, deque()).append(entry)
+
+    def lookup(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            recordings = self._entries.get(key)
+            if not recordings:
+                self.misses += 1
+                raise CassetteMiss(f"No recording for request {key[:12]} in {self.path}")
+            self.hits += 1
+            return recordings.popleft() if len(recordings) > 1 else recordings[0]
+
+
+async def _replay_delay(entry: Dict[str, Any]) -> None:
+    delay = float(LLM_CASSETTE_REPLAY_LATENCY_SECONDS) if LLM_CASSETTE_REPLAY_LATENCY_SECONDS is not None else entry.get("latency", 0.0)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class _RecordingStream:
+    """Pass-through async stream that records the chunks actually consumed."""
+
+    def __init__(self, stream: Any, cassette: Cassette, key: str, started: float):
+        self._stream = stream
+        self._cassette = cassette
+        self._key = key
+        self._started = started
+        self._chunks: List[Dict[str, Any]] = []
+        self._recorded = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        async for chunk in self._stream:
+            self._chunks.append(chunk.model_dump(mode="json"))
+            yield chunk
+
+    async def close(self) -> None:
+        await self._stream.close()
+        if not self._recorded:
+            self._recorded = True
+            self._cassette.record(self._key, {"stream": True, "chunks": self._chunks,
+                                              "latency": time.perf_counter() - self._started})
+
+
+class _ReplayStream:
+    def __init__(self, entry: Dict[str, Any]):
+        self._entry = entry
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        chunks = self._entry.get("chunks") or []
+        await _replay_delay(self._entry)
+        for chunk in chunks:
+            yield ChatCompletionChunk.model_validate(chunk)
+
+    async def close(self) -> None:
+        return None
+
+
+class _CassetteCompletions:
+    def __init__(self, client: Optional[Any], cassette: Cassette, mode: str, parse: bool = False):
+        self._client = client
+        self._cassette = cassette
+        self._mode = mode
+        self._parse = parse
+
+    def _target(self):
+        completions = self._client.beta.chat.completions if self._parse else self._client.chat.completions
+        return completions.parse if self._parse else completions.create
+
+    async def _call(self, **kwargs: Any) -> Any:
+        method = "parse" if self._parse else "create"
+        key = cassette_key(method, kwargs)
+        if self._mode == "replay":
+            entry = self._cassette.lookup(key)
+            if entry.get("stream"):
+                return _ReplayStream(entry)
+            await _replay_delay(entry)
+            if self._parse:
+                return _replayed_parse(entry["response"], kwargs.get("response_format"))
+            return ChatCompletion.model_validate(entry["response"])
+
+        started = time.perf_counter()
+        response = await self._target()(**kwargs)
+        if kwargs.get("stream"):
+            return _RecordingStream(response, self._cassette, key, started)
+        self._cassette.record(key, {"stream": False, "response": response.model_dump(mode="json", exclude_none=True),
+                                    "latency": time.perf_counter() - started})
+        return response
+
+    async def create(self, **kwargs: Any) -> Any:
+        return await self._call(**kwargs)
+
+    async def parse(self, **kwargs: Any) -> Any:
+        return await self._call(**kwargs)
+
+
+class _Namespace:
+    def __init__(self, **attrs: Any):
+        self.__dict__.update(attrs)
+
+
+class CassetteClient:
+    """Drop-in stand-in for an AsyncOpenAI client's chat completion endpoints.
+
+    record: forwards to the wrapped client and stores each exchange.
+    replay: serves stored exchanges without a client or network access.
+    """
+
+    def __init__(self, client: Optional[Any], cassette: Cassette, mode: str):
+        if mode == "record" and client is None:
+            raise ValueError("Record mode needs a real client to forward to")
+        self.chat = _Namespace(completions=_CassetteCompletions(client, cassette, mode))
+        self.beta = _Namespace(chat=_Namespace(completions=_CassetteCompletions(client, cassette, mode, parse=True)))
+
+
+_shared_cassette: Optional[Cassette] = None
+
+
+def cassette_enabled() -> bool:
+    return LLM_CASSETTE_MODE in ("record", "replay")
+
+
+def wrap_client(client_factory) -> Any:
+    """Return the client from client_factory, wrapped per LLM_CASSETTE_MODE.
+
+    In replay mode the factory is never called, so no credentials are needed.
+    """
+    global _shared_cassette
+    if not cassette_enabled():
+        return client_factory()
+    if _shared_cassette is None:
+        _shared_cassette = Cassette()
+    client = client_factory() if LLM_CASSETTE_MODE == "record" else None
+    logger.info(f"LLM calls go through the cassette in {LLM_CASSETTE_MODE} mode")
+    return CassetteClient(client, _shared_cassette, LLM_CASSETTE_MODE)
@@ -0,0 +1,238 @@
+import json
+import re
+import time
+from typing import Any, Dict, Generic, List, Optional, Tuple, Type, TypeVar
+
+import orjson
+from pydantic import TypeAdapter, ValidationError
+
+from metrics import metrics
+
+ANALYSIS_LIST_FIELDS = ("reasoning_steps", "match_rationale", "flags")
+
+T = TypeVar("T")
+
+# One summary per (schema, result): its _count gives parse-failure and repair rates, its _sum the cost
+metrics.describe("llm_output_parse_seconds", "Time to parse and validate one LLM JSON output by schema and result (ok, repaired, failed)")
+
+
+class StreamingAnalysisParser:
+    """Incremental parser for a streamed LLMAnalysisResult JSON object.
+
+    Chunks are scanned once, left to right. Top-level string values (such as
+    "decision") become available as soon as their closing quote arrives, and
+    string items of top-level arrays are collected one by one, so a caller can act
+    on the decision long before the object is complete.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self._array_key: Optional[str] = None
+        self.fields: Dict[str, Any] = {}
+
+    @property
+    def text(self) -> str:
+        return self._buffer
+
+    @property
+    def decision(self) -> Optional[str]:
+        decision = self.fields.get("decision")
+        return decision if isinstance(decision, str) else None
+
+    def _on_string(self, value: str) -> None:
+        if self._depth == 1:
+            if self._expect_key:
+                self._key = value
+            elif self._key is not None:
+                self.fields[self._key] = value
+        elif self._depth == 2 and self._array_key is not None:
+            self.fields[self._array_key].append(value)
+
+    def feed(self, chunk: str) -> None:
+        self._buffer += chunk
+        buffer = self._buffer
+        for i in range(self._pos, len(buffer)):
+            ch = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    raw = buffer[self._string_start:i + 1]
+                    try:
+                        self._on_string(json.loads(raw))
+                    except ValueError:
+                        self._on_string(raw[1:-1])
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == "{":
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = True
+            elif ch == "[":
+                self._depth += 1
+                if self._depth == 2 and self._key is not None:
+                    self._array_key = self._key
+                    self.fields[self._key] = []
+            elif ch in "}]":
+                if self._depth == 2:
+                    self._array_key = None
+                self._depth -= 1
+            elif self._depth == 1 and ch == ":":
+                self._expect_key = False
+            elif self._depth == 1 and ch == ",":
+                self._expect_key = True
+                self._key = None
+        self._pos = len(buffer)
+
+    def partial_result(self) -> Dict[str, Any]:
+        """The fields seen so far, shaped like LLMAnalysisResult (lists may be truncated)."""
+        result: Dict[str, Any] = {"decision": self.decision}
+        for field in ANALYSIS_LIST_FIELDS:
+            items: List[Any] = self.fields.get(field) or []
+            result[field] = [item for item in items if isinstance(item, str)]
+        return result
+
+
+# --- Parsing complete outputs ---
+_CODE_FENCE_RE = re.compile(r"```[a-zA-Z]*\s*(.*?)(?:```|$)", re.DOTALL)
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+_STRING = r'"(?:[^"\\]|\\.)*"'
+_DANGLING_KEY_RE = re.compile(rf"{_STRING}\s*:$")
+_UNPAIRED_KEY_RE = re.compile(rf"([{{,])\s*{_STRING}$")
+_STRING_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+
+def _drop_trailing_comma(out: List[str]) -> None:
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+
+def _trim_dangling(text: str, in_object: bool) -> str:
+    """Cut a truncated tail back to the last complete value."""
+    text = text.rstrip()
+    literal = re.search(r"[-+.\w]+$", text)
+    if literal and literal.group(0) not in ("true", "false", "null") and not _NUMBER_RE.fullmatch(literal.group(0)):
+        text = text[:literal.start()].rstrip()
+    if text.endswith(":"):
+        text = _DANGLING_KEY_RE.sub("", text).rstrip()
+    elif in_object:
+        text = _UNPAIRED_KEY_RE.sub(r"\1", text).rstrip()
+    return text.rstrip(",").rstrip()
+
+
+def repair_json(text: str) -> str:
+    """Best-effort fix of the ways LLMs commonly break JSON, without another LLM call.
+
+    Handles markdown code fences and surrounding prose, trailing commas, raw
+    newlines inside strings and output truncated mid-array or mid-object (an
+    unterminated string is dropped, then open brackets are closed). The result is
+    not guaranteed to be valid; callers still parse and validate it.
+    """
+    text = text.strip()
+    if "```" in text:
+        fenced = _CODE_FENCE_RE.search(text)
+        if fenced:
+            text = fenced.group(1).strip()
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        return text
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = escape = False
+    string_start = 0
+    for ch in text[min(starts):]:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            elif ch < " ":
+                ch = _STRING_ESCAPES.get(ch, "")
+            out.append(ch)
+        elif ch == '"':
+            in_string, string_start = True, len(out)
+            out.append(ch)
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            if not stack:
+                break
+            _drop_trailing_comma(out)
+            out.append(stack.pop())
+            if not stack:
+                break  # anything after the top-level value is prose
+        else:
+            out.append(ch)
+    if in_string:
+        del out[string_start:]
+    if not stack:
+        return "".join(out)
+    repaired = _trim_dangling("".join(out), stack[-1] == "}")
+    for closer in reversed(stack):
+        repaired = repaired.rstrip().rstrip(",") + closer
+    return repaired
+
+
+class LlmJsonParser(Generic[T]):
+    """Parses and validates LLM JSON output against a schema in a single pass.
+
+    Well-formed output goes straight through TypeAdapter.validate_json (pydantic-core
+    parses and validates together). Only when that fails is the text repaired,
+    checked with orjson and validated from the parsed value. Each parse is timed
+    per schema and result, so parse-failure and repair rates show up in /metrics.
+    """
+
+    def __init__(self, model: Type[T]):
+        self.schema = getattr(model, "__name__", str(model))
+        self._adapter: TypeAdapter[T] = TypeAdapter(model)
+
+    def parse(self, text: str) -> T:
+        """Validated value for `text`.
+
+        Raises:
+            ValidationError: the original error, if the text is unusable even after repair.
+        """
+        return self.parse_with_repair_flag(text)[0]
+
+    def parse_with_repair_flag(self, text: str) -> Tuple[T, bool]:
+        """(value, repaired); a repaired value may have lost the fields cut off by truncation."""
+        started = time.perf_counter()
+        try:
+            value = self._adapter.validate_json(text)
+        except ValidationError as original:
+            value = self._parse_repaired(text)
+            if value is None:
+                self._record("failed", started)
+                raise original
+            self._record("repaired", started)
+            return value, True
+        self._record("ok", started)
+        return value, False
+
+    def _parse_repaired(self, text: str) -> Optional[T]:
+        repaired = repair_json(text)
+        if repaired == text:
+            return None
+        try:
+            return self._adapter.validate_python(orjson.loads(repaired))
+        except (orjson.JSONDecodeError, ValidationError):
+            return None
+
+    def _record(self, result: str, started: float) -> None:
+        metrics.observe("llm_output_parse_seconds", time.perf_counter() - started, schema=self.schema, result=result)
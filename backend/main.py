@@ -1,18 +1,39 @@
+import asyncio
+import hashlib
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 
 from dotenv import load_dotenv
 load_dotenv() # Load environment variables early
 
-from fastapi import FastAPI, HTTPException, Request, status
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse, PlainTextResponse, Response
+from pydantic import BaseModel
 
 # Assuming models are compatible
-from models import (NoMatchesResponse, TrialMatch, TrialSearchRequest,
-                    TrialSearchResponse)
+from accounting import RequestAccount
+from admission import AdmissionController, AdmissionRejected
+from analysis_cache import analysis_cache
+from circuit_breaker import llm_breaker
+from compression import COMPRESSION_ENABLED, CompressionMiddleware
+from jobs import JobDeferred, JobQueue, JobWorkerPool
+from metrics import metrics
+from offload import monitor_event_loop_lag
+from profiling import (PROFILING_ADMIN_HEADER, PROFILING_ADMIN_TOKEN, PROFILING_ENABLED, PROFILING_HEADER, ProfilingMiddleware,
+                       admin_token_valid, request_profiler)
+from ranking import RANKING_DEFAULT_LIMIT
+from models import (JobStatusResponse, NoMatchesResponse, PatientProfile, PatientSearchRequest,
+                    PatientSearchResponse, RematchSummary, SearchDiagnostics, StoredMatchesResponse,
+                    TrialData, TrialMatch, TrialSearchRequest, TrialSearchResponse)
 # Import the new Agno workflow function
-from services import run_trial_matching_workflow 
+from services import (cpu_offloader, find_patients_for_trial, get_stored_matches_for_patient, match_store,
+                      get_stored_matches_for_trial, run_trial_matching_workflow,
+                      stored_matches_version_for_patient, stored_matches_version_for_trial,
+                      probe_llm, update_patient_profile, update_trial, warm_up)
 from logger import setup_logger
 
 # Setup logger
@@ -22,10 +43,144 @@ logger = setup_logger(
     log_file="logs/api.log"
 )
 
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+# Non-standard status (nginx convention) used only for logging; the client never sees it.
+HTTP_499_CLIENT_CLOSED_REQUEST = 499
+
+
+async def _cancel_on_disconnect(http_request: Request, awaitable: Awaitable[Any]) -> Any:
+    """Await `awaitable`, cancelling it as soon as the client disconnects.
+
+    Cancellation propagates into the workflow and any LLM calls it is awaiting, so
+    abandoned requests stop consuming LLM spend and pooled workflows.
+
+    Raises:
+        HTTPException: 499 if the client disconnected before the work finished.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                logger.info(f"Client disconnected from {http_request.url.path}; cancelling in-flight work")
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise HTTPException(status_code=HTTP_499_CLIENT_CLOSED_REQUEST, detail="Client closed request.")
+    finally:
+        # Also covers the endpoint itself being cancelled (e.g. server shutdown)
+        if not task.done():
+            task.cancel()
+
+
+async def _run_admitted_workflow(patient_id: str, clinician_id: Optional[str], limit: int,
+                                 account: Optional[RequestAccount] = None) -> Any:
+    """Run the matching workflow once the admission controller grants a slot."""
+    async with admission_controller.slot(clinician_id):
+        return await run_trial_matching_workflow(patient_id, limit=limit, account=account)
+
+
+def _model_response(model: BaseModel, status_code: int = status.HTTP_200_OK) -> Response:
+    """Serialize a response model straight to JSON bytes, skipping dict conversion and re-validation."""
+    return Response(content=model.model_dump_json(), status_code=status_code, media_type="application/json")
+
+
+def _search_response(request: TrialSearchRequest, workflow_result: Any, account: RequestAccount) -> BaseModel:
+    """Shape a successful or degraded workflow result as the requested page, with diagnostics if asked for."""
+    diagnostics = SearchDiagnostics(**account.to_diagnostics()) if request.includeDiagnostics else None
+    timestamp_str = datetime.now(timezone.utc).isoformat()
+    page_size = request.pageSize or RANKING_DEFAULT_LIMIT
+    start = (request.page - 1) * page_size
+    if isinstance(workflow_result, dict):  # Degraded: LLM circuit open
+        return TrialSearchResponse(status="degraded", matches=workflow_result["matches"][start:start + page_size],
+                                   page=request.page, pageSize=page_size, message=workflow_result["message"],
+                                   diagnostics=diagnostics, searchTimestamp=timestamp_str)
+    if not workflow_result:
+        return NoMatchesResponse(diagnostics=diagnostics, searchTimestamp=timestamp_str)
+    return TrialSearchResponse(matches=workflow_result[start:start + page_size], page=request.page,
+                               pageSize=page_size, diagnostics=diagnostics, searchTimestamp=timestamp_str)
+
+
+async def _run_find_trials_job(patient_id: str, request_options: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+    """Job handler: run the workflow like the synchronous endpoint, admission slot and paging included.
+
+    Raises:
+        JobDeferred: if admission control sheds the job; it is queued again after the Retry-After delay.
+    """
+    request = TrialSearchRequest(patientId=patient_id, **request_options)
+    clinician_id = request.context.requestingClinicianId if request.context else None
+    page_size = request.pageSize or RANKING_DEFAULT_LIMIT
+    account = RequestAccount()
+    try:
+        workflow_result = await _run_admitted_workflow(patient_id, clinician_id, limit=request.page * page_size, account=account)
+    except AdmissionRejected as rejected:
+        raise JobDeferred(rejected.retry_after) from rejected
+    if isinstance(workflow_result, dict) and "error_type" in workflow_result:
+        return False, workflow_result
+    return True, _search_response(request, workflow_result, account).model_dump(mode="json")
+
+
+job_queue = JobQueue()
+admission_controller = AdmissionController()
+job_workers = JobWorkerPool(job_queue, _run_find_trials_job)
+
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
+WARMUP_MAX_RETRY_SECONDS = float(os.getenv("WARMUP_MAX_RETRY_SECONDS", "60"))
+
+# Readiness state reported by /ready; only the in-process warm-up flips "ready".
+# "llm" tracks the synthetic LLM probe separately: while it fails the service is ready but degraded.
+readiness: Dict[str, Any] = {"ready": False, "attempts": 0, "warmup": None, "last_error": None,
+                             "llm": {"status": "pending", "attempts": 0, "last_error": None}}
+
+
+async def _retry_with_backoff(name: str, step: Callable[[], Awaitable[Any]], state: Dict[str, Any]) -> Any:
+    """Await `step` until it succeeds, counting attempts and the last error in `state`."""
+    delay = WARMUP_RETRY_SECONDS
+    while True:
+        state["attempts"] += 1
+        try:
+            return await step()
+        except Exception as e:
+            state["last_error"] = str(e)
+            logger.warning(f"{name} attempt {state['attempts']} failed: {e}; retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_MAX_RETRY_SECONDS)
+
+
+async def _warm_up_until_ready() -> None:
+    """Retry warm-up with backoff until it succeeds, then keep probing the LLM until it answers."""
+    readiness["warmup"] = await _retry_with_backoff("Warm-up", warm_up, readiness)
+    readiness["ready"] = True
+    logger.info("Service is ready")
+    probe = await _retry_with_backoff("LLM probe", probe_llm, readiness["llm"])
+    readiness["llm"].update(status="skipped" if probe == "skipped" else "ok", last_error=None)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Queued jobs are served whatever the warm-up outcome: with the LLM down they get degraded results
+    await job_workers.start()
+    # Warm up in the background so /health answers immediately while /ready stays false
+    warmup_task = asyncio.create_task(_warm_up_until_ready())
+    lag_monitor_task = asyncio.create_task(monitor_event_loop_lag())
+    yield
+    warmup_task.cancel()
+    lag_monitor_task.cancel()
+    await asyncio.gather(warmup_task, lag_monitor_task, return_exceptions=True)
+    await job_workers.stop()
+    cpu_offloader.shutdown()
+    # The stores open their files on first use; close them so a restarted app reopens cleanly
+    for store in (job_queue, match_store, analysis_cache):
+        store.close()
+
+
 app = FastAPI(
     title="AI Clinical Trial Matching Service (Agno-Powered)", # Updated title
     description="Uses Agno agents to find clinical trials.",
     version="0.2.0", # Updated version
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # CORS configuration
@@ -42,6 +197,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware)
+
+if PROFILING_ENABLED:
+    # Only installed when enabled, so unprofiled deployments pay nothing per request
+    app.add_middleware(ProfilingMiddleware, profiler=request_profiler, paths=["/api/v1/trials/find"])
+    logger.info(f"Request profiling enabled (header {PROFILING_HEADER}, sample rate {request_profiler.sample_rate})")
+    if not PROFILING_ADMIN_TOKEN:
+        logger.warning("PROFILING_ADMIN_TOKEN is not set: profiling headers are ignored and /admin/profiles refuses every request")
+
 @app.post(
     "/api/v1/trials/find",
     # Response model might need adjustment if Agno returns slightly different structure
@@ -53,21 +218,26 @@ app.add_middleware(
         200: {"description": "Successful match or no matches found", "model": TrialSearchResponse | NoMatchesResponse},
         404: {"description": "Patient ID not found (as determined by Agno workflow)"},
         500: {"description": "Internal server error during Agno workflow"},
+        503: {"description": "At capacity; retry after the number of seconds in the Retry-After header"},
     }
 )
-async def find_trials(request: TrialSearchRequest):
+async def find_trials(request: TrialSearchRequest, http_request: Request):
     logger.info(f"Received Agno trial matching request for patientId: {request.patientId}")
     start_time = datetime.now(timezone.utc)
 
     try:
         # ---> Call the new Agno workflow function <---
         logger.debug(f"Starting Agno workflow for patientId: {request.patientId}")
-        workflow_result = await run_trial_matching_workflow(request.patientId)
+        clinician_id = request.context.requestingClinicianId if request.context else None
+        page_size = request.pageSize or RANKING_DEFAULT_LIMIT
+        account = RequestAccount()
+        # The workflow ranks just enough matches to fill the requested page
+        workflow_result = await _cancel_on_disconnect(
+            http_request, _run_admitted_workflow(request.patientId, clinician_id, limit=request.page * page_size, account=account)
+        )
         logger.debug(f"Agno workflow completed for patientId: {request.patientId}")
 
-        end_time = datetime.now(timezone.utc)
-        timestamp_str = end_time.isoformat()
-        duration = (end_time - start_time).total_seconds()
+        duration = (datetime.now(timezone.utc) - start_time).total_seconds()
 
         # Handle results from the Agno workflow
         if isinstance(workflow_result, dict) and "error_type" in workflow_result:
@@ -91,21 +261,17 @@ async def find_trials(request: TrialSearchRequest):
                     detail=workflow_result.get("message", "An unexpected error occurred during the trial matching process.")
                 )
 
+        elif isinstance(workflow_result, dict) and workflow_result.get("status") == "degraded":
+            logger.warning(f"Serving degraded results for patientId: {request.patientId}")
+            return _model_response(_search_response(request, workflow_result, account))
         elif isinstance(workflow_result, list):
             # Success case: we have a list of match dictionaries 
             if not workflow_result:
                 logger.info(f"No matches found via Agno for patientId: {request.patientId}")
-                return JSONResponse(
-                    status_code=status.HTTP_200_OK,
-                    content=NoMatchesResponse(searchTimestamp=timestamp_str).dict()
-                )
             else:
                 logger.info(f"Found {len(workflow_result)} matches via Agno for patientId: {request.patientId}")
                 logger.debug(f"Agno Processing time: {duration:.2f} seconds")
-                return JSONResponse(
-                    status_code=status.HTTP_200_OK,
-                    content=TrialSearchResponse(matches=workflow_result, searchTimestamp=timestamp_str).dict()
-                )
+            return _model_response(_search_response(request, workflow_result, account))
         else:
             # Handle unexpected result types from Agno workflow
             logger.error(f"Unexpected result type from Agno workflow for patientId {request.patientId}: {type(workflow_result)}")
@@ -117,6 +283,12 @@ async def find_trials(request: TrialSearchRequest):
         # Re-raise HTTP exceptions (like 404) without wrapping them
         logger.debug(f"Re-raising HTTP exception for {request.patientId} with status {http_ex.status_code}")
         raise
+    except AdmissionRejected as rejected:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Service is at capacity ({rejected.reason}); retry later.",
+            headers={"Retry-After": str(rejected.retry_after)},
+        )
     except Exception as e:
         logger.error(f"Unhandled error in API endpoint for Agno request {request.patientId}: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -125,11 +297,257 @@ async def find_trials(request: TrialSearchRequest):
         )
 
 
+@app.post(
+    "/api/v1/jobs/trials/find",
+    response_model=JobStatusResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Queue a trial matching job",
+    description="Returns a job ID immediately; poll GET /api/v1/jobs/{job_id} for the result. "
+                "Requests repeating an Idempotency-Key return the original job.",
+)
+async def submit_find_trials_job(
+    request: TrialSearchRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    try:
+        job, created = await asyncio.to_thread(job_queue.submit, request.patientId, idempotency_key,
+                                               request.model_dump(mode="json", exclude={"patientId"}))
+    except ValueError as ve:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(ve))
+    if created:
+        logger.info(f"Queued job {job['jobId']} for patientId: {request.patientId}")
+        job_workers.notify()
+    else:
+        logger.info(f"Idempotent retry for job {job['jobId']} (patientId: {request.patientId})")
+    return job
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}",
+    response_model=JobStatusResponse,
+    summary="Get the status and result of a trial matching job",
+    responses={404: {"description": "Job ID not found"}},
+)
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job '{job_id}' not found.")
+    return job
+
+
+@app.post(
+    "/api/v1/patients/find-for-trial",
+    response_model=PatientSearchResponse,
+    summary="Find eligible patients for a trial",
+    description="Pre-filters the patient population by indexed structured fields, analyzes the survivors and returns a ranked, paginated list.",
+    responses={
+        404: {"description": "Trial ID not found"},
+        500: {"description": "Internal server error during reverse matching"},
+    }
+)
+async def find_patients(request: PatientSearchRequest, http_request: Request):
+    logger.info(f"Received reverse matching request for trialId: {request.trialId}")
+    try:
+        result = await _cancel_on_disconnect(
+            http_request, find_patients_for_trial(request.trialId, page=request.page, page_size=request.pageSize)
+        )
+        if "error_type" in result:
+            if result["error_type"] == "TRIAL_NOT_FOUND":
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=result["message"])
+            logger.error(f"Error from reverse matching for {request.trialId}: {result}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=result.get("message", "An unexpected error occurred during reverse matching.")
+            )
+        timestamp_str = datetime.now(timezone.utc).isoformat()
+        return _model_response(PatientSearchResponse(**result, searchTimestamp=timestamp_str))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Unhandled error in reverse matching endpoint for {request.trialId}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="An unexpected error occurred while processing your request."
+        )
+
+
+@app.put(
+    "/api/v1/trials/{trial_id}",
+    response_model=RematchSummary,
+    summary="Create or update a trial and re-match affected patients",
+    description="Re-runs analysis only for (patient, trial) pairs whose trial or profile version changed.",
+)
+async def put_trial(trial_id: str, trial: TrialData):
+    if trial.id != trial_id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Trial ID in path and body must match.")
+    logger.info(f"Received trial update for {trial_id}")
+    try:
+        return await update_trial(trial.model_dump(exclude={"structured_criteria"}))
+    except ValueError as ve:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ve))
+
+
+@app.put(
+    "/api/v1/patients/{patient_id}",
+    response_model=RematchSummary,
+    summary="Create or update a patient profile and re-match that patient",
+    description="Re-runs analysis only for the trials this patient is a candidate for.",
+)
+async def put_patient(patient_id: str, profile: PatientProfile):
+    if profile.patientId != patient_id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Patient ID in path and body must match.")
+    logger.info(f"Received patient profile update for {patient_id}")
+    profile_dict = profile.model_dump(exclude={"patientId"})
+    profile_dict["patient_id"] = patient_id
+    return await update_patient_profile(profile_dict)
+
+
+# --- Conditional GET for stored matches ---
+metrics.describe("conditional_get_total", "Stored-match reads by resource and result (not_modified: answered 304)")
+
+
+def _matches_etag(version: str, min_rank_score: Optional[float], limit: int) -> str:
+    digest = hashlib.sha1(f"{version}|{min_rank_score}|{limit}".encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison, as If-None-Match requires."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+
+async def _conditional_matches_response(resource: str, version: str, min_rank_score: Optional[float], limit: int,
+                                        if_none_match: Optional[str],
+                                        load: Callable[[], Awaitable[List[Dict[str, Any]]]]) -> Response:
+    """304 if the client's ETag is current, else the stored matches with a fresh ETag.
+
+    `load` is only called on a miss, so unchanged polls skip the query and serialization.
+    """
+    etag = _matches_etag(version, min_rank_score, limit)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(if_none_match, etag):
+        metrics.inc("conditional_get_total", resource=resource, result="not_modified")
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    matches = await load()
+    metrics.inc("conditional_get_total", resource=resource, result="modified")
+    response = _model_response(StoredMatchesResponse(matches=matches, count=len(matches)))
+    response.headers.update(headers)
+    return response
+
+
+@app.get(
+    "/api/v1/patients/{patient_id}/matches",
+    response_model=StoredMatchesResponse,
+    summary="Latest stored matches for a patient",
+    description="Reads precomputed matches from the match store; does not trigger any LLM analysis. "
+                "Responses carry an ETag; send it back in If-None-Match to get 304 while nothing changed.",
+)
+async def get_patient_matches(
+    patient_id: str,
+    min_rank_score: Optional[float] = Query(None, description="Only return matches with rank_score >= this value"),
+    limit: int = Query(100, ge=1, le=1000),
+    if_none_match: Optional[str] = Header(None),
+):
+    return await _conditional_matches_response(
+        "patient_matches", await stored_matches_version_for_patient(patient_id), min_rank_score, limit, if_none_match,
+        lambda: get_stored_matches_for_patient(patient_id, min_rank_score=min_rank_score, limit=limit))
+
+
+@app.get(
+    "/api/v1/trials/{trial_id}/matches",
+    response_model=StoredMatchesResponse,
+    summary="Stored matches for a trial",
+    description="Lists the latest stored patient matches for a trial, ranked by rank_score. Supports If-None-Match like the patient read.",
+)
+async def get_trial_matches(
+    trial_id: str,
+    min_rank_score: Optional[float] = Query(None, description="Only return matches with rank_score >= this value"),
+    limit: int = Query(100, ge=1, le=1000),
+    if_none_match: Optional[str] = Header(None),
+):
+    return await _conditional_matches_response(
+        "trial_matches", await stored_matches_version_for_trial(trial_id), min_rank_score, limit, if_none_match,
+        lambda: get_stored_matches_for_trial(trial_id, min_rank_score=min_rank_score, limit=limit))
+
+
 @app.get("/health", summary="Health Check", status_code=status.HTTP_200_OK)
 async def health_check():
-    """Basic health check endpoint."""
+    """Basic health check endpoint. Stays 200 while the LLM circuit is open: searches degrade rather than fail."""
     logger.debug("Health check requested")
-    return {"status": "ok"}
+    return {"status": "ok", "llmCircuit": llm_breaker.state, "analysisCache": analysis_cache.backend, "workerPid": os.getpid()}
+
+
+@app.get("/ready", summary="Readiness Check")
+async def readiness_check():
+    """Report ready once the in-process warm-up has completed; load balancers should route on this.
+
+    The LLM probe is reported separately: while it has not succeeded, or the LLM circuit
+    is open, the service is ready but "degraded" (structured-only matches).
+    """
+    if not readiness["ready"]:
+        return ORJSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "warming_up", "attempts": readiness["attempts"], "lastError": readiness["last_error"]},
+        )
+    llm = readiness["llm"]
+    llm_status = "unavailable" if llm["status"] == "pending" and llm["last_error"] else llm["status"]
+    degraded = llm_status not in ("ok", "skipped") or llm_breaker.state != "closed"
+    return {"status": "degraded" if degraded else "ready", "warmup": readiness["warmup"],
+            "llm": {"status": llm_status, "attempts": llm["attempts"], "lastError": llm["last_error"], "circuit": llm_breaker.state}}
+
+async def _require_admin_token(admin_token: Optional[str] = Header(None, alias=PROFILING_ADMIN_HEADER)) -> None:
+    if admin_token is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Missing {PROFILING_ADMIN_HEADER} header.")
+    if not admin_token_valid(admin_token, PROFILING_ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token.")
+
+
+# Mounted only when profiling is enabled; every route needs the admin token
+profiling_router = APIRouter(prefix="/admin/profiles", dependencies=[Depends(_require_admin_token)])
+
+
+@profiling_router.get("", summary="List captured request profiles")
+async def list_profiles():
+    """Profiles captured for requests sent with the profiling header or picked by PROFILING_SAMPLE_RATE, newest first."""
+    profiles = await asyncio.to_thread(request_profiler.list_profiles)
+    return {"enabled": PROFILING_ENABLED, "captured": request_profiler.captured,
+            "skippedBusy": request_profiler.skipped_busy, "profiles": profiles}
+
+
+@profiling_router.get("/{filename}", summary="Download a profile artifact", responses={404: {"description": "Unknown artifact"}})
+async def get_profile_artifact(filename: str):
+    path = request_profiler.artifact_path(filename)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Profile artifact '{filename}' not found.")
+    media_type = "text/plain" if filename.endswith(".txt") else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=filename)
+
+
+if PROFILING_ENABLED:
+    app.include_router(profiling_router)
+
+
+@app.get("/metrics", summary="Prometheus metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Per-tier LLM latency/tokens/cost, cascade escalation rate, admission, cache and LLM circuit state."""
+    metrics.set_gauge("admission_in_flight", admission_controller.in_flight)
+    metrics.set_gauge("admission_queued", admission_controller.queued)
+    metrics.set_gauge("admission_admitted", admission_controller.admitted)
+    for reason, count in admission_controller.rejected.items():
+        metrics.set_gauge("admission_rejected", count, reason=reason)
+    # Counting entries is a SQLite (or Redis) round trip; keep it off the event loop
+    metrics.set_gauge("analysis_cache_entries", await asyncio.to_thread(len, analysis_cache))
+    metrics.set_gauge("analysis_cache_hits", analysis_cache.hits)
+    metrics.set_gauge("analysis_cache_misses", analysis_cache.misses)
+    breaker = llm_breaker.stats()
+    metrics.set_gauge("llm_circuit_state", {"closed": 0, "half_open": 1, "open": 2}[breaker["state"]])
+    metrics.set_gauge("llm_circuit_times_opened", breaker["timesOpened"])
+    metrics.set_gauge("llm_circuit_rejected_calls", breaker["rejected"])
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
 
 # --- Main execution (for running with uvicorn) ---
 if __name__ == "__main__":
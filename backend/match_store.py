@@ -0,0 +1,152 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.match_store", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/match_store.log")
+
+MATCH_STORE_PATH = os.getenv("MATCH_STORE_PATH", "data/match_store.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS match_results (
+    patient_id TEXT NOT NULL,
+    trial_id TEXT NOT NULL,
+    catalogue_version INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    decision TEXT,
+    is_match INTEGER NOT NULL,
+    rank_score REAL,
+    match_json TEXT,
+    analysis_json TEXT,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (patient_id, trial_id, catalogue_version, model)
+);
+CREATE INDEX IF NOT EXISTS idx_match_results_patient ON match_results (patient_id, trial_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_match_results_trial ON match_results (trial_id, is_match, rank_score);
+"""
+
+# Latest row per (patient, trial); older catalogue versions and models are kept as history.
+_LATEST_FILTER = """
+created_at = (SELECT MAX(created_at) FROM match_results latest
+              WHERE latest.patient_id = m.patient_id AND latest.trial_id = m.trial_id)
+"""
+
+
+class MatchStore:
+    """SQLite-backed store of match results keyed by patient, trial, catalogue version and model.
+
+    The database is opened on first use rather than on construction, so importing the
+    service creates no files; close() releases it and the next call reopens it.
+    """
+
+    def __init__(self, path: str = MATCH_STORE_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Callers hold self._lock
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            logger.info(f"Match store opened at {self.path}")
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def save_results(self, rows: List[Dict[str, Any]]) -> None:
+        """Insert or replace analysis rows.
+
+        Each row needs patient_id, trial_id, catalogue_version, model and analysis
+        (an LLMAnalysisResult dict); match (a TrialMatch dict) is set for matches only.
+        """
+        if not rows:
+            return
+        created_at = datetime.now(timezone.utc).isoformat()
+        values = [(
+            row["patient_id"], row["trial_id"], row["catalogue_version"], row["model"],
+            (row.get("analysis") or {}).get("decision"),
+            1 if row.get("match") else 0,
+            (row.get("match") or {}).get("rank_score"),
+            json.dumps(row["match"]) if row.get("match") else None,
+            json.dumps(row.get("analysis")) if row.get("analysis") else None,
+            created_at,
+        ) for row in rows]
+        with self._lock, self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO match_results (patient_id, trial_id, catalogue_version, model, decision, "
+                "is_match, rank_score, match_json, analysis_json, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                values,
+            )
+        logger.debug(f"Saved {len(values)} match results")
+
+    def _query(self, where: str, params: List[Any], min_rank_score: Optional[float], limit: int,
+               only_matches: bool = True) -> List[Dict[str, Any]]:
+        sql = f"SELECT * FROM match_results m WHERE {where} AND {'is_match = 1 AND ' if only_matches else ''}{_LATEST_FILTER}"
+        if min_rank_score is not None:
+            sql += " AND rank_score >= ?"
+            params.append(min_rank_score)
+        sql += " ORDER BY rank_score DESC, trial_id LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._connection().execute(sql, params).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "patientId": row["patient_id"],
+            "trialId": row["trial_id"],
+            "catalogueVersion": row["catalogue_version"],
+            "model": row["model"],
+            "decision": row["decision"],
+            "rank_score": row["rank_score"],
+            "match": json.loads(row["match_json"]) if row["match_json"] else None,
+            "analysis": json.loads(row["analysis_json"]) if row["analysis_json"] else None,
+            "createdAt": row["created_at"],
+        }
+
+    def _revision(self, where: str, params: List[Any]) -> str:
+        with self._lock:
+            count, newest = self._connection().execute(f"SELECT COUNT(*), MAX(created_at) FROM match_results WHERE {where}", params).fetchone()
+        return f"{count}:{newest or '-'}"
+
+    def patient_revision(self, patient_id: str) -> str:
+        """Changes whenever a result for the patient is written; cheap enough to check on every poll."""
+        return self._revision("patient_id = ?", [patient_id])
+
+    def trial_revision(self, trial_id: str) -> str:
+        return self._revision("trial_id = ?", [trial_id])
+
+    def latest_for_patient(self, patient_id: str, min_rank_score: Optional[float] = None, limit: int = 100,
+                           only_matches: bool = True) -> List[Dict[str, Any]]:
+        return self._query("patient_id = ?", [patient_id], min_rank_score, limit, only_matches)
+
+    def matches_for_trial(self, trial_id: str, min_rank_score: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        return self._query("trial_id = ?", [trial_id], min_rank_score, limit)
+
+    def _matched_ids(self, column: str, where: str, params: List[Any]) -> List[str]:
+        sql = f"SELECT {column} FROM match_results m WHERE {where} AND is_match = 1 AND {_LATEST_FILTER} ORDER BY {column}"
+        with self._lock:
+            return [row[0] for row in self._connection().execute(sql, params).fetchall()]
+
+    def matched_patients_for_trial(self, trial_id: str) -> List[str]:
+        """Patients whose latest stored result for the trial is a match, however many there are."""
+        return self._matched_ids("patient_id", "trial_id = ?", [trial_id])
+
+    def matched_trials_for_patient(self, patient_id: str) -> List[str]:
+        """Trials whose latest stored result for the patient is a match."""
+        return self._matched_ids("trial_id", "patient_id = ?", [patient_id])
@@ -0,0 +1,94 @@
+import os
+import threading
+from typing import Any, Dict, List, Tuple
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.metrics", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/metrics.log")
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+
+class MetricsRegistry:
+    """Minimal in-process counters, gauges and summaries with Prometheus text output.
+
+    Summaries keep count, sum and max only (max is in snapshot() but not in the
+    Prometheus output); that is enough for mean latency and cost per tier without
+    pulling in a metrics client dependency.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._gauges: Dict[str, Dict[LabelKey, float]] = {}
+        self._summaries: Dict[str, Dict[LabelKey, List[float]]] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            summary = self._summaries.setdefault(name, {}).setdefault(key, [0.0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    def counter_value(self, name: str, **labels: Any) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_label_key(labels), 0.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Plain-dict view of every series, keyed by name then by rendered labels."""
+        with self._lock:
+            return {
+                "counters": {name: {_format_labels(k): v for k, v in series.items()} for name, series in self._counters.items()},
+                "gauges": {name: {_format_labels(k): v for k, v in series.items()} for name, series in self._gauges.items()},
+                "summaries": {
+                    name: {_format_labels(k): {"count": s[0], "sum": s[1], "max": s[2]} for k, s in series.items()}
+                    for name, series in self._summaries.items()
+                },
+            }
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for kind, families in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted(families):
+                    if name in self._help:
+                        lines.append(f"# HELP {name} {self._help[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for key, value in sorted(families[name].items()):
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+            for name in sorted(self._summaries):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} summary")
+                for key, (count, total, _) in sorted(self._summaries[name].items()):
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {total}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -9,6 +9,15 @@ class TrialSearchRequestContext(BaseModel):
 
 class TrialSearchRequest(BaseModel):
     patientId: str = Field(..., description="Unique identifier for the patient")
+    page: int = Field(1, ge=1, le=20, description="1-based page number of the ranked matches")
+    pageSize: Optional[int] = Field(None, ge=1, le=100, description="Number of matches per page (default RANKING_DEFAULT_LIMIT)")
+    context: Optional[TrialSearchRequestContext] = None
+    includeDiagnostics: bool = Field(False, description="Return the search's LLM usage, cost and stage timings in `diagnostics`")
+
+class PatientSearchRequest(BaseModel):
+    trialId: str = Field(..., description="Identifier of the trial to recruit for")
+    page: int = Field(1, ge=1, description="1-based page number")
+    pageSize: int = Field(20, ge=1, le=100, description="Number of matches per page")
     context: Optional[TrialSearchRequestContext] = None
 
 # --- Data Models (used internally and in responses) ---
@@ -39,17 +48,80 @@ class TrialMatch(BaseModel):
 
 # --- Response Models ---
 
+class LlmSourceUsage(BaseModel):
+    calls: int = 0
+    promptTokens: int = 0
+    completionTokens: int = 0
+    costUsd: float = 0.0
+
+class SearchDiagnostics(BaseModel):
+    llmCalls: int = 0
+    promptTokens: int = 0
+    completionTokens: int = 0
+    cachedPromptTokens: int = 0
+    costUsd: float = Field(0.0, description="Estimated from the LLM_*_COST_PER_1K prices")
+    bySource: Dict[str, LlmSourceUsage] = Field(default_factory=dict, description="Keyed by 'agent:<name>' or 'analysis:<tier>'")
+    analysisCacheHits: int = Field(0, description="Pair analyses served from the analysis cache")
+    structuredPrunes: int = Field(0, description="Pairs ruled out by structured criteria without an LLM call")
+    rankingSkips: int = Field(0, description="Analyses skipped once the top matches were settled")
+    stageSeconds: Dict[str, float] = Field(default_factory=dict)
+    totalSeconds: float = 0.0
+
 class TrialSearchResponse(BaseModel):
     status: str = "success"
     matches: List[TrialMatch]
+    page: int = 1
+    pageSize: Optional[int] = None
+    message: Optional[str] = None # Set when status is "degraded"
+    diagnostics: Optional[SearchDiagnostics] = None # Set when the request asked for it
     searchTimestamp: str # ISO format string
 
 class NoMatchesResponse(BaseModel):
     status: str = "no_matches_found"
     matches: List = []
     message: str = "No suitable recruiting trials found based on current criteria."
+    diagnostics: Optional[SearchDiagnostics] = None
+    searchTimestamp: str # ISO format string
+
+class PatientMatch(BaseModel):
+    patientId: str
+    condition: str
+    age: int
+    stage: Optional[str] = None
+    matchRationale: List[str] = Field(default_factory=list)
+    flags: List[str] = Field(default_factory=list)
+    rank_score: Optional[float] = Field(None, description="Internal score for ranking")
+
+class PatientSearchResponse(BaseModel):
+    status: str = "success"
+    trialId: str
+    matches: List[PatientMatch]
+    totalMatches: int = Field(..., description="Matches among the analyzed candidates; analysis stops once the page is settled")
+    page: int
+    pageSize: int
+    candidatesScreened: int = Field(..., description="Patients surviving the indexed pre-filter")
+    candidatesAnalyzed: int = Field(0, description="Candidates analyzed, best upper bound first, before the page was settled")
+    unavailableShards: Optional[List[str]] = Field(None, description="Shards that did not answer (status 'partial'); their patients are missing")
     searchTimestamp: str # ISO format string
 
+class RematchSummary(BaseModel):
+    trigger: str = Field(..., description="What changed, e.g. 'trial:NCT05933044' or 'patient:PATIENT_001'")
+    pairsRecomputed: int = 0
+    pairsSkipped: int = Field(0, description="Pairs whose trial and profile versions were unchanged")
+    pairsFailed: int = 0
+    matchesAdded: int = 0
+    matchesRemoved: int = 0
+
+class JobStatusResponse(BaseModel):
+    jobId: str
+    patientId: str
+    status: str = Field(..., description="queued, running, succeeded or failed")
+    attempts: int = 0
+    result: Optional[Dict[str, Any]] = Field(None, description="TrialSearchResponse or NoMatchesResponse payload once succeeded")
+    error: Optional[Dict[str, Any]] = Field(None, description="Workflow error payload if failed")
+    createdAt: str
+    updatedAt: str
+
 # --- Pydantic Models for Agent/Tool Interactions ---
 class PatientProfileResponse(BaseModel):
     status: str = Field(..., description="Status of the fetch operation (success, not_found, error)")
@@ -58,6 +130,41 @@ class PatientProfileResponse(BaseModel):
     error: Optional[str] = Field(None, description="Detailed error message if status is 'error'.")
 
 
+class NumericCriterion(BaseModel):
+    field: str = Field(..., description="Normalized patient attribute (age, ecog, egfr, hba1c)")
+    min_value: Optional[float] = Field(None, description="Lower bound of the range")
+    max_value: Optional[float] = Field(None, description="Upper bound of the range")
+    min_inclusive: bool = True
+    max_inclusive: bool = True
+    exclusion: bool = Field(False, description="True if a value inside the range excludes the patient")
+    source: str = Field(..., description="Criterion text this was parsed from")
+
+class StructuredCriteria(BaseModel):
+    numeric: List[NumericCriterion] = Field(default_factory=list, description="Machine-checkable numeric ranges")
+    required_biomarkers: List[str] = Field(default_factory=list, description="Canonical biomarker codes the patient must have")
+    allowed_stages: List[str] = Field(default_factory=list, description="Roman numeral disease stages accepted by the trial")
+    stage_source: Optional[str] = Field(None, description="Criterion text the stage requirement was parsed from")
+    residual_inclusions: List[str] = Field(default_factory=list, description="Inclusion criteria that still need LLM review")
+    residual_exclusions: List[str] = Field(default_factory=list, description="Exclusion criteria that still need LLM review")
+    residual_eligibility_text: Optional[str] = Field(None, description="Eligibility text that still needs LLM review")
+
+class PatientFeatures(BaseModel):
+    patient_id: Optional[str] = None
+    age: Optional[float] = None
+    condition: str = Field("", description="Lower-cased condition with whitespace collapsed")
+    stage: Optional[str] = Field(None, description="Roman numeral disease stage, I to IV")
+    stage_code: Optional[int] = Field(None, description="Disease stage as a number, 1 to 4")
+    ecog: Optional[int] = Field(None, description="ECOG performance status, from notes (Karnofsky is converted)")
+    labs: Dict[str, float] = Field(default_factory=dict, description="Lab values from notes by canonical name (egfr, hba1c)")
+    biomarkers: List[str] = Field(default_factory=list, description="Canonical biomarker codes, sorted")
+    prior_therapies: List[str] = Field(default_factory=list, description="Lower-cased prior therapies")
+
+class CriteriaEvaluation(BaseModel):
+    status: str = Field(..., description="eligible, ineligible or needs_review")
+    met: List[str] = Field(default_factory=list, description="Structured criteria the patient satisfies")
+    failed: List[str] = Field(default_factory=list, description="Structured criteria the patient violates")
+    unknown: List[str] = Field(default_factory=list, description="Structured criteria lacking patient data")
+
 class TrialData(BaseModel):
     id: str = Field(..., description="Trial identifier",example="NCT03520686")
     title: str = Field(..., description="Title of the trial")
@@ -71,6 +178,7 @@ class TrialData(BaseModel):
     inclusions: List[str] = Field(default_factory=list, description="Inclusion criteria")
     eligibility_text: Optional[str] = Field(None, description="Full eligibility criteria text")
     url: Optional[str] = Field(None, description="Trial details URL")
+    structured_criteria: Optional[StructuredCriteria] = Field(None, description="Criteria parsed at ingest time")
     
 class DiscoveredTrialsResponse(BaseModel):
     status: str = Field(..., description="Status of the discovery operation (success, error)")
@@ -84,6 +192,22 @@ class LLMAnalysisResult(BaseModel):
     match_rationale: List[str] = Field(..., description="Points supporting a match.", default_factory=list)
     flags: List[str] = Field(..., description="Points against a match or needing review.", default_factory=list)
 
+class StoredMatch(BaseModel):
+    patientId: str
+    trialId: str
+    catalogueVersion: int
+    model: str
+    decision: Optional[str] = None
+    rank_score: Optional[float] = None
+    match: Optional[TrialMatch] = None
+    analysis: Optional[LLMAnalysisResult] = None
+    createdAt: str # ISO format string
+
+class StoredMatchesResponse(BaseModel):
+    status: str = "success"
+    matches: List[StoredMatch]
+    count: int
+
 class AnalysisDetails(BaseModel):
     decision: Optional[str] = None
     reasoning_steps: Optional[List[str]] = Field(default_factory=list)
@@ -0,0 +1,145 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from models import TrialData
+from catalogue import TrialCatalogue
+from ranking import plan_analysis_order
+from metrics import metrics
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.offload", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/offload.log")
+
+# inline: run on the event loop. thread: a thread pool (the stages release little of the GIL,
+# but the loop keeps serving I/O between them). process: a spawn-based process pool.
+OFFLOAD_MODE = os.getenv("OFFLOAD_MODE", "thread").lower()
+OFFLOAD_MAX_WORKERS = int(os.getenv("OFFLOAD_MAX_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Below this many trials a stage runs inline: handing it to a pool costs more than it saves
+OFFLOAD_MIN_TRIALS = int(os.getenv("OFFLOAD_MIN_TRIALS", "200"))
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("EVENT_LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+
+T = TypeVar("T")
+
+metrics.describe("offload_tasks_total", "CPU-bound matching stages by stage and where they ran")
+metrics.describe("offload_task_seconds", "Time spent in CPU-bound matching stages, including pool hand-off")
+metrics.describe("event_loop_lag_seconds", "Delay between a scheduled event-loop wake-up and when it ran")
+metrics.describe("event_loop_lag_max_seconds", "Largest event-loop lag in the current one-minute window")
+
+# --- Stage functions ---
+# Module-level so a process pool can pickle them. They take and return plain ids and
+# numbers; trials are looked up in `_catalogue`, which is the live catalogue in the API
+# process and a snapshot in pool worker processes.
+_catalogue: Optional[TrialCatalogue] = None
+
+
+def _init_worker(trial_dicts: List[Dict[str, Any]]) -> None:
+    global _catalogue
+    _catalogue = TrialCatalogue(trial_dicts)
+
+
+def search_trial_ids(condition: str) -> List[str]:
+    return [trial.id for trial in _catalogue.search(condition)]
+
+
+def plan_trial_ids(patient_profile: Dict[str, Any], trial_ids: List[str]) -> Tuple[List[str], List[float]]:
+    """Trial ids in analysis order with their score upper bounds (see ranking.plan_analysis_order)."""
+    trials = [trial for trial in map(_catalogue.get, trial_ids) if trial is not None]
+    candidates = plan_analysis_order(patient_profile, trials)
+    return [c.trial.id for c in candidates], [c.upper_bound for c in candidates]
+
+
+class CpuOffloader:
+    """Runs CPU-bound matching stages off the event loop so it stays free for LLM I/O.
+
+    In process mode each worker holds a snapshot of the catalogue; the pool is
+    replaced when the catalogue version changes, with in-flight tasks finishing on
+    the old one.
+    """
+
+    def __init__(self, catalogue: TrialCatalogue, mode: str = OFFLOAD_MODE, max_workers: int = OFFLOAD_MAX_WORKERS,
+                 min_trials: int = OFFLOAD_MIN_TRIALS):
+        global _catalogue
+        _catalogue = catalogue
+        self.catalogue = catalogue
+        self.mode = mode if mode in ("inline", "thread", "process") else "thread"
+        self.max_workers = max_workers
+        self.min_trials = min_trials
+        self._executor: Optional[Executor] = None
+        self._executor_version = -1
+
+    def _get_executor(self) -> Executor:
+        if self.mode == "thread":
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="offload")
+            return self._executor
+        if self._executor is None or self._executor_version != self.catalogue.version:
+            previous = self._executor
+            snapshot = [t.model_dump(exclude={"structured_criteria"}) for t in self.catalogue.all()]
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_init_worker, initargs=(snapshot,))
+            self._executor_version = self.catalogue.version
+            if previous is not None:
+                previous.shutdown(wait=False)
+            logger.info(f"Started {self.max_workers} offload processes on catalogue version {self._executor_version}")
+        return self._executor
+
+    def start(self) -> None:
+        """Create the pool now (process workers are spawned on first use) rather than on the first request."""
+        if self.mode != "inline":
+            self._get_executor()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, stage: str, size: int, fn: Callable[..., T], *args: Any) -> T:
+        """Run `fn(*args)` in the pool, or inline when `size` items is too little work to be worth it."""
+        where = "inline" if self.mode == "inline" or size < self.min_trials else self.mode
+        started = time.perf_counter()
+        if where == "inline":
+            result = fn(*args)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        metrics.inc("offload_tasks_total", stage=stage, executor=where)
+        metrics.observe("offload_task_seconds", time.perf_counter() - started, stage=stage, executor=where)
+        return result
+
+    async def search(self, condition: str) -> List[TrialData]:
+        """Recruiting catalogue trials whose condition contains `condition`."""
+        trial_ids = await self.run("discovery", len(self.catalogue), search_trial_ids, condition)
+        return [trial for trial in map(self.catalogue.get, trial_ids) if trial is not None]
+
+    async def plan(self, patient_profile: Dict[str, Any], trials: List[TrialData]) -> List[Tuple[str, float]]:
+        """(trial id, score upper bound) pairs in analysis order.
+
+        Trials the catalogue does not know (so a pool worker cannot look them up) are
+        planned inline and merged in.
+        """
+        known_ids = [t.id for t in trials if self.catalogue.get(t.id) is not None]
+        unknown = [t for t in trials if self.catalogue.get(t.id) is None]
+        ids, bounds = await self.run("planning", len(known_ids), plan_trial_ids, patient_profile, known_ids)
+        planned = list(zip(ids, bounds))
+        if unknown:
+            planned += [(c.trial.id, c.upper_bound) for c in plan_analysis_order(patient_profile, unknown)]
+            planned.sort(key=lambda item: (-item[1], item[0]))
+        return planned
+
+
+async def monitor_event_loop_lag(interval: float = EVENT_LOOP_LAG_INTERVAL_SECONDS) -> None:
+    """Sample how late the event loop wakes up; anything blocking it shows up here."""
+    loop = asyncio.get_running_loop()
+    window_max = 0.0
+    window_started = loop.time()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        metrics.observe("event_loop_lag_seconds", lag)
+        window_max = max(window_max, lag)
+        metrics.set_gauge("event_loop_lag_max_seconds", window_max)
+        if loop.time() - window_started >= 60:
+            window_max, window_started = 0.0, loop.time()
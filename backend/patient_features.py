@@ -0,0 +1,170 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from models import PatientFeatures
+from metrics import metrics
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.patient_features", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/patient_features.log")
+
+# Profiles whose features are kept; a profile is re-parsed only when one of its fields changes
+PATIENT_FEATURE_CACHE_SIZE = int(os.getenv("PATIENT_FEATURE_CACHE_SIZE", "10000"))
+
+metrics.describe("patient_feature_cache_total", "Patient feature lookups by result (hit: parsed earlier, miss: parsed now)")
+
+# --- Canonical vocabulary ---
+# Lab names as written in notes and criteria -> canonical name
+LAB_ALIASES = {"egfr": "egfr", "hba1c": "hba1c", "a1c": "hba1c"}
+# Gene or protein spellings -> canonical name
+BIOMARKER_ALIASES = {"ERBB2": "HER2", "HER-2": "HER2", "HER2/NEU": "HER2", "PDL1": "PD-L1", "PD-L-1": "PD-L1"}
+_POSITIVE_STATUS = {"POSITIVE", "POS", "MUTATION", "MUTATED", "MUTANT", "AMPLIFIED", "AMPLIFICATION",
+                    "FUSION", "REARRANGED", "REARRANGEMENT", "OVEREXPRESSED", "OVEREXPRESSION", "DETECTED"}
+_NEGATIVE_STATUS = {"NEGATIVE", "NEG", "WILD-TYPE", "WILDTYPE", "WT", "NOT DETECTED", "UNDETECTED", "ABSENT"}
+_MARKER_STATUS_RE = re.compile(rf"^(.*?)[\s\-:]+({'|'.join(sorted(_POSITIVE_STATUS | _NEGATIVE_STATUS, key=len, reverse=True))})$")
+
+# --- Patterns for reading values out of free-text notes ---
+_NUMBER = r"(\d+(?:\.\d+)?)"
+_NOTE_ECOG_RE = re.compile(r"\b(?:ECOG\s*(?:PS\s*)?|PS\s*|performance status\s*)(?:of\s*|=\s*|:\s*)?([0-4])\b", re.IGNORECASE)
+_NOTE_KARNOFSKY_RE = re.compile(r"\b(?:Karnofsky|KPS)\s*(?:of\s*|=\s*|:\s*)?(\d{2,3})\s*%?", re.IGNORECASE)
+_NOTE_LAB_RE = re.compile(rf"\b(eGFR|HbA1c|A1c)\s*(?:of\s*|=\s*|:\s*)?{_NUMBER}(\s*mL/min)?", re.IGNORECASE)
+_STAGE_RE = re.compile(r"^(?:STAGE\s*)?(IV|I{1,3}|[1-4])(?![0-9])")
+_ROMAN = {"I": 1, "II": 2, "III": 3, "IV": 4}
+_ROMAN_BY_CODE = {code: roman for roman, code in _ROMAN.items()}
+
+
+def canonical_biomarker(marker: str) -> str:
+    """Normalize a biomarker label to gene plus status: '+', '-' or '' when not stated.
+
+    'egfr positive' -> 'EGFR+', 'ERBB2 amplified' -> 'HER2+', 'BRAF wild-type' -> 'BRAF-'.
+    A named variant implies the gene is altered: 'EGFR Exon 19 deletion' and 'KRAS G12C'
+    -> 'EGFR+' and 'KRAS+'. A bare gene name stays unsigned: 'EGFR' -> 'EGFR'.
+    """
+    text = re.sub(r"\s+", " ", marker.strip().upper())
+    sign = ""
+    match = _MARKER_STATUS_RE.match(text)
+    if match:
+        text, sign = match.group(1), "+" if match.group(2) in _POSITIVE_STATUS else "-"
+    elif text.endswith(("+", "-")):
+        text, sign = text[:-1], text[-1]
+    gene, _, variant = text.strip(" -:").partition(" ")
+    if variant.strip() and not sign:
+        sign = "+"
+    return BIOMARKER_ALIASES.get(gene, gene) + sign
+
+
+def required_biomarker(marker: str) -> str:
+    """Canonical code for a trial requirement; a bare gene name means the gene must be positive."""
+    code = canonical_biomarker(marker)
+    return code if code.endswith(("+", "-")) else code + "+"
+
+
+def opposite_biomarker(code: str) -> Optional[str]:
+    """'EGFR+' -> 'EGFR-' and back; None for an unsigned code."""
+    if code.endswith("+"):
+        return code[:-1] + "-"
+    if code.endswith("-"):
+        return code[:-1] + "+"
+    return None
+
+
+def lab_name(label: str, context: str) -> Optional[str]:
+    """Canonical lab for a matched lab label, or None if it is not a lab mention.
+
+    Upper-case 'EGFR' is the gene, not the kidney-function lab: it only counts as eGFR
+    when a mL/min unit appears in `context`.
+    """
+    name = LAB_ALIASES[label.lower()]
+    if name == "egfr" and label != "eGFR" and "ml/min" not in context.lower():
+        return None
+    return name
+
+
+def parse_stage(stage: Optional[str]) -> Optional[int]:
+    """Stage 1-4 from 'III', 'IIIA', 'Stage 3' or '4'; None if absent or unreadable."""
+    match = _STAGE_RE.match((stage or "").strip().upper())
+    if not match:
+        return None
+    value = match.group(1)
+    return int(value) if value.isdigit() else _ROMAN[value]
+
+
+def _karnofsky_to_ecog(score: int) -> Optional[int]:
+    if not 0 <= score <= 100:
+        return None
+    return 0 if score >= 90 else 1 if score >= 70 else 2 if score >= 50 else 3 if score >= 30 else 4
+
+
+def extract_patient_features(patient_profile: Dict[str, Any]) -> PatientFeatures:
+    """Parse a patient profile once into a compact typed record.
+
+    Stage, performance status and lab values become numbers, biomarkers canonical
+    codes. Values that cannot be read are left unset rather than guessed.
+    """
+    notes = patient_profile.get("notes") or ""
+    features = PatientFeatures(
+        patient_id=patient_profile.get("patient_id"),
+        age=float(patient_profile["age"]) if patient_profile.get("age") is not None else None,
+        condition=" ".join((patient_profile.get("condition") or "").lower().split()),
+        stage_code=parse_stage(patient_profile.get("stage")),
+        biomarkers=sorted({canonical_biomarker(m) for m in patient_profile.get("biomarkers") or [] if m.strip()}),
+        prior_therapies=[t.strip().lower() for t in patient_profile.get("priorTherapies") or [] if t.strip()],
+    )
+    if features.stage_code is not None:
+        features.stage = _ROMAN_BY_CODE[features.stage_code]
+    ecog = _NOTE_ECOG_RE.search(notes)
+    if ecog:
+        features.ecog = int(ecog.group(1))
+    else:
+        karnofsky = _NOTE_KARNOFSKY_RE.search(notes)
+        if karnofsky:
+            features.ecog = _karnofsky_to_ecog(int(karnofsky.group(1)))
+    for label, number, unit in _NOTE_LAB_RE.findall(notes):
+        name = lab_name(label, unit)
+        if name:
+            features.labs[name] = float(number)
+    return features
+
+
+def feature_value(features: PatientFeatures, field: str) -> Optional[float]:
+    """Value of a NumericCriterion field (age, ecog or a lab) for this patient."""
+    if field == "age":
+        return features.age
+    if field == "ecog":
+        return float(features.ecog) if features.ecog is not None else None
+    return features.labs.get(field)
+
+
+# --- Cache of parsed profiles ---
+_cache: "OrderedDict[Tuple[Any, ...], PatientFeatures]" = OrderedDict()
+_cache_lock = threading.Lock()  # the planning stage may run on offload threads
+
+
+def _fingerprint(patient_profile: Dict[str, Any]) -> Tuple[Any, ...]:
+    return (patient_profile.get("patient_id"), patient_profile.get("age"), patient_profile.get("condition"),
+            patient_profile.get("stage"), tuple(patient_profile.get("biomarkers") or ()),
+            tuple(patient_profile.get("priorTherapies") or ()), patient_profile.get("notes"))
+
+
+def features_for(patient_profile: Dict[str, Any]) -> PatientFeatures:
+    """Features for a profile dict, parsed on first sight and served from the cache after.
+
+    Treat the result as read-only: it is shared by every caller with the same profile.
+    """
+    key = _fingerprint(patient_profile)
+    with _cache_lock:
+        features = _cache.get(key)
+        if features is not None:
+            _cache.move_to_end(key)
+    if features is not None:
+        metrics.inc("patient_feature_cache_total", result="hit")
+        return features
+    features = extract_patient_features(patient_profile)
+    metrics.inc("patient_feature_cache_total", result="miss")
+    with _cache_lock:
+        _cache[key] = features
+        while len(_cache) > PATIENT_FEATURE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return features
@@ -0,0 +1,174 @@
+import bisect
+import math
+import os
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from models import PatientFeatures, StructuredCriteria, TrialData
+from criteria import criterion_holds
+from patient_features import LAB_ALIASES, extract_patient_features, feature_value, opposite_biomarker, parse_stage, required_biomarker
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.patient_index", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/patient_index.log")
+
+# Numeric feature columns; one slot per patient row, NaN where the value is unknown
+_NUMERIC_COLUMNS = ("age", "ecog", *sorted(set(LAB_ALIASES.values())))
+
+
+class PatientIndex:
+    """Secondary indexes over the patient population for fast trial -> patient pre-filtering.
+
+    Patients are indexed by normalized condition, canonical biomarker and age so that
+    a trial's hard requirements can be applied as set operations instead of a scan. A
+    required biomarker only removes patients documenting the opposite status; a missing
+    result is left for review.
+    Each profile is parsed once into PatientFeatures on upsert, and the numeric features
+    (age, ECOG, labs, stage) plus a biomarker bitmask are kept in per-column arrays so
+    structured criteria are screened without touching the profile strings.
+    """
+
+    def __init__(self, patients: Iterable[Dict[str, Any]] = ()):
+        self._profiles: Dict[str, Dict[str, Any]] = {}
+        self._features: Dict[str, PatientFeatures] = {}
+        self._by_condition: Dict[str, Set[str]] = {}
+        self._by_biomarker: Dict[str, Set[str]] = {}
+        self._by_age: List[Tuple[int, str]] = []
+        # --- Columnar features ---
+        self._rows: Dict[str, int] = {}
+        self._free_rows: List[int] = []
+        self._row_ids: List[Optional[str]] = []
+        self._columns: Dict[str, array] = {name: array("d") for name in (*_NUMERIC_COLUMNS, "stage")}
+        self._marker_masks: List[int] = []
+        self._marker_bits: Dict[str, int] = {}
+        for profile in patients:
+            self.upsert(profile)
+        logger.info(f"Patient index built with {len(self._profiles)} patients")
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def get(self, patient_id: str) -> Optional[Dict[str, Any]]:
+        return self._profiles.get(patient_id)
+
+    def features(self, patient_id: str) -> Optional[PatientFeatures]:
+        return self._features.get(patient_id)
+
+    def upsert(self, profile: Dict[str, Any]) -> None:
+        patient_id = profile["patient_id"]
+        if patient_id in self._profiles:
+            self.remove(patient_id)
+        features = extract_patient_features(profile)
+        self._profiles[patient_id] = profile
+        self._features[patient_id] = features
+        self._by_condition.setdefault(features.condition, set()).add(patient_id)
+        for marker in features.biomarkers:
+            self._by_biomarker.setdefault(marker, set()).add(patient_id)
+        bisect.insort(self._by_age, (int(profile.get("age") or 0), patient_id))
+        self._store_row(patient_id, features)
+
+    def remove(self, patient_id: str) -> None:
+        profile = self._profiles.pop(patient_id, None)
+        if profile is None:
+            return
+        features = self._features.pop(patient_id)
+        self._by_condition.get(features.condition, set()).discard(patient_id)
+        for marker in features.biomarkers:
+            self._by_biomarker.get(marker, set()).discard(patient_id)
+        age_entry = (int(profile.get("age") or 0), patient_id)
+        position = bisect.bisect_left(self._by_age, age_entry)
+        if position < len(self._by_age) and self._by_age[position] == age_entry:
+            del self._by_age[position]
+        row = self._rows.pop(patient_id)
+        self._row_ids[row] = None
+        self._free_rows.append(row)
+
+    def _store_row(self, patient_id: str, features: PatientFeatures) -> None:
+        if self._free_rows:
+            row = self._free_rows.pop()
+        else:
+            row = len(self._row_ids)
+            self._row_ids.append(None)
+            self._marker_masks.append(0)
+            for column in self._columns.values():
+                column.append(math.nan)
+        self._rows[patient_id] = row
+        self._row_ids[row] = patient_id
+        for name in _NUMERIC_COLUMNS:
+            value = feature_value(features, name)
+            self._columns[name][row] = value if value is not None else math.nan
+        self._columns["stage"][row] = features.stage_code if features.stage_code is not None else math.nan
+        mask = 0
+        for marker in features.biomarkers:
+            mask |= self._marker_bits.setdefault(marker, 1 << len(self._marker_bits))
+        self._marker_masks[row] = mask
+
+    def screen(self, criteria: StructuredCriteria, patient_ids: Iterable[str]) -> List[str]:
+        """Drop patients whose known features fail a hard structured criterion.
+
+        Works column by column over the feature arrays. Unknown values pass, as in
+        evaluate_structured_criteria, where they become needs-review flags.
+        """
+        rows = [self._rows[patient_id] for patient_id in patient_ids if patient_id in self._rows]
+        for criterion in criteria.numeric:
+            column = self._columns.get(criterion.field)
+            if column is None or not rows:
+                continue
+            rows = [row for row in rows if math.isnan(column[row]) or criterion_holds(criterion, column[row])]
+        if criteria.required_biomarkers and rows:
+            contradicting = 0
+            for marker in criteria.required_biomarkers:
+                contradicting |= self._marker_bits.get(opposite_biomarker(marker), 0)
+            if contradicting:
+                rows = [row for row in rows if not self._marker_masks[row] & contradicting]
+        if criteria.allowed_stages and rows:
+            allowed = {parse_stage(stage) for stage in criteria.allowed_stages}
+            column = self._columns["stage"]
+            rows = [row for row in rows if math.isnan(column[row]) or int(column[row]) in allowed]
+        return [self._row_ids[row] for row in rows]
+
+    def _ids_in_age_range(self, min_age: Optional[int], max_age: Optional[int]) -> Set[str]:
+        lo = bisect.bisect_left(self._by_age, min_age, key=lambda entry: entry[0]) if min_age is not None else 0
+        hi = bisect.bisect_right(self._by_age, max_age, key=lambda entry: entry[0]) if max_age is not None else len(self._by_age)
+        return {patient_id for _, patient_id in self._by_age[lo:hi]}
+
+    def passes_trial_filters(self, patient_id: str, trial: TrialData) -> bool:
+        """Apply the same pre-filter as candidates_for_trial to a single patient."""
+        profile = self._profiles.get(patient_id)
+        if profile is None:
+            return False
+        features = self._features[patient_id]
+        if not features.condition or features.condition not in trial.condition.lower():
+            return False
+        if any(opposite_biomarker(required_biomarker(m)) in features.biomarkers for m in trial.required_markers):
+            return False
+        age = int(profile.get("age") or 0)
+        if (trial.min_age is not None and age < trial.min_age) or (trial.max_age is not None and age > trial.max_age):
+            return False
+        return not trial.structured_criteria or bool(self.screen(trial.structured_criteria, [patient_id]))
+
+    def candidates_for_trial(self, trial: TrialData) -> List[str]:
+        """Return ids of patients passing the trial's condition, age and biomarker filters.
+
+        Uses the same condition rule as trial discovery: the patient's condition must
+        appear in the trial's condition. Survivors are then screened against the
+        trial's structured criteria (stage, ECOG, labs) on their precomputed features.
+        """
+        trial_condition = trial.condition.lower()
+        candidate_sets: List[Set[str]] = [set().union(*(
+            ids for condition, ids in self._by_condition.items() if condition and condition in trial_condition
+        ))]
+        if trial.min_age is not None or trial.max_age is not None:
+            candidate_sets.append(self._ids_in_age_range(trial.min_age, trial.max_age))
+
+        candidate_sets.sort(key=len)
+        candidates = set(candidate_sets[0])
+        for ids in candidate_sets[1:]:
+            if not candidates:
+                break
+            candidates &= ids
+        for marker in trial.required_markers:
+            candidates -= self._by_biomarker.get(opposite_biomarker(required_biomarker(marker)), set())
+        if trial.structured_criteria and candidates:
+            candidates = set(self.screen(trial.structured_criteria, candidates))
+        logger.debug(f"Pre-filter for trial {trial.id}: {len(candidates)} of {len(self._profiles)} patients survive")
+        return sorted(candidates)
@@ -0,0 +1,206 @@
+import asyncio
+import hmac
+import io
+import json
+import os
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.profiling", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/profiling.log")
+
+# Nothing is installed unless PROFILING_ENABLED=true, so disabled profiling costs nothing per request
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_HEADER = os.getenv("PROFILING_HEADER", "X-Profile-Request")
+# Required to trigger a capture by header and to read /admin/profiles; unset, only sampling captures
+PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN")
+PROFILING_ADMIN_HEADER = "X-Admin-Token"
+PROFILING_DIR = os.getenv("PROFILING_DIR", "data/profiles")
+PROFILING_MAX_PROFILES = int(os.getenv("PROFILING_MAX_PROFILES", "50"))
+PROFILING_TRACEMALLOC_FRAMES = int(os.getenv("PROFILING_TRACEMALLOC_FRAMES", "10"))
+PROFILING_TOP_N = int(os.getenv("PROFILING_TOP_N", "40"))
+
+PROFILE_ID_HEADER = "X-Profile-Id"
+# Files written per capture, by suffix
+_ARTIFACTS = {
+    ".prof": "cProfile stats (load with pstats or snakeviz)",
+    ".cpu.txt": "Top functions by cumulative time",
+    ".tracemalloc": "tracemalloc snapshot (tracemalloc.Snapshot.load)",
+    ".alloc.txt": "Top allocation sites by size",
+}
+
+
+def admin_token_valid(value: Optional[str], expected: Optional[str] = PROFILING_ADMIN_TOKEN) -> bool:
+    """True if `value` matches the configured admin token; always False when none is configured."""
+    return bool(expected) and value is not None and hmac.compare_digest(value.encode("utf-8"), expected.encode("utf-8"))
+
+
+class RequestProfiler:
+    """Captures a cProfile run and a tracemalloc snapshot around selected requests.
+
+    cProfile and tracemalloc are process-wide, so captures are serialized: while
+    one runs, other selected requests are served unprofiled, and the capture also
+    sees whatever else the event loop ran concurrently.
+    """
+
+    def __init__(self, directory: str = PROFILING_DIR, sample_rate: float = PROFILING_SAMPLE_RATE,
+                 max_profiles: int = PROFILING_MAX_PROFILES):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_profiles = max_profiles
+        self._active = False
+        self.captured = 0
+        self.skipped_busy = 0
+
+    def should_profile(self, header_value: Optional[str], authorized: bool = False) -> bool:
+        """Sampled, or asked for by header; the header is only honoured from an `authorized` admin."""
+        if authorized and header_value is not None and header_value.lower() in ("1", "true", "yes"):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @asynccontextmanager
+    async def capture(self, label: str):
+        """Profile the block; yields the profile id, or None if another capture is running."""
+        if self._active:
+            self.skipped_busy += 1
+            yield None
+            return
+        import cProfile
+        import tracemalloc
+
+        self._active = True
+        profile_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}_{label}_{uuid.uuid4().hex[:8]}"
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(PROFILING_TRACEMALLOC_FRAMES)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            yield profile_id
+        finally:
+            profiler.disable()
+            duration = time.perf_counter() - started
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracemalloc:
+                tracemalloc.stop()
+            self._active = False
+            self.captured += 1
+            try:
+                await asyncio.to_thread(self._write, profile_id, label, duration, peak, profiler, snapshot)
+            except Exception as e:
+                logger.error(f"Failed to write profile {profile_id}: {e}", exc_info=True)
+
+    def _write(self, profile_id: str, label: str, duration: float, peak_bytes: int, profiler: Any, snapshot: Any) -> None:
+        import pstats
+        import tracemalloc
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, profile_id)
+        profiler.dump_stats(base + ".prof")
+        cpu_report = io.StringIO()
+        pstats.Stats(profiler, stream=cpu_report).sort_stats("cumulative").print_stats(PROFILING_TOP_N)
+        with open(base + ".cpu.txt", "w", encoding="utf-8") as f:
+            f.write(cpu_report.getvalue())
+
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+        snapshot.dump(base + ".tracemalloc")
+        top_allocations = snapshot.statistics("lineno")[:PROFILING_TOP_N]
+        with open(base + ".alloc.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(str(stat) for stat in top_allocations) + "\n")
+
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump({
+                "id": profile_id,
+                "label": label,
+                "createdAt": datetime.now(timezone.utc).isoformat(),
+                "durationSeconds": round(duration, 4),
+                "tracemallocPeakBytes": peak_bytes,
+                "files": {profile_id + suffix: description for suffix, description in _ARTIFACTS.items()},
+            }, f)
+        logger.info(f"Wrote profile {profile_id} ({duration:.3f}s) to {self.directory}")
+        self._prune()
+
+    def _prune(self) -> None:
+        profiles = self.list_profiles()
+        for stale in profiles[self.max_profiles:]:
+            for name in [stale["id"] + ".json", *stale["files"]]:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self) -> List[Dict[str, Any]]:
+        """Captured profiles, newest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                        profiles.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return sorted(profiles, key=lambda p: p["createdAt"], reverse=True)
+
+    def artifact_path(self, filename: str) -> Optional[str]:
+        """Path of a listed artifact, or None; only names written by this profiler resolve."""
+        if os.path.basename(filename) != filename or not any(filename.endswith(s) for s in _ARTIFACTS):
+            return None
+        path = os.path.join(self.directory, filename)
+        return path if os.path.isfile(path) else None
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles requests to `paths` when RequestProfiler selects them.
+
+    The profiling header only triggers a capture when the request also carries the
+    admin token. Selected responses carry an X-Profile-Id header naming the capture.
+    """
+
+    def __init__(self, app: Any, profiler: RequestProfiler, paths: Iterable[str], header: str = PROFILING_HEADER,
+                 admin_token: Optional[str] = PROFILING_ADMIN_TOKEN):
+        self.app = app
+        self.profiler = profiler
+        self.paths = set(paths)
+        self.header = header.lower().encode("latin-1")
+        self.admin_token = admin_token
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        headers = {k: v.decode("latin-1") for k, v in scope["headers"]}
+        authorized = admin_token_valid(headers.get(PROFILING_ADMIN_HEADER.lower().encode("latin-1")), self.admin_token)
+        if not self.profiler.should_profile(headers.get(self.header), authorized):
+            await self.app(scope, receive, send)
+            return
+
+        label = scope["path"].strip("/").replace("/", "_")
+        async with self.profiler.capture(label) as profile_id:
+            if profile_id is None:
+                await self.app(scope, receive, send)
+                return
+
+            async def send_with_profile_id(message: Dict[str, Any]) -> None:
+                if message["type"] == "http.response.start":
+                    message = {**message, "headers": [*message.get("headers", []),
+                                                      (PROFILE_ID_HEADER.lower().encode("latin-1"), profile_id.encode("latin-1"))]}
+                await send(message)
+
+            await self.app(scope, receive, send_with_profile_id)
+
+
+request_profiler = RequestProfiler()
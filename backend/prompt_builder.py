@@ -0,0 +1,144 @@
+import json
+import math
+import os
+from dataclasses import dataclass, field
+from textwrap import dedent
+from typing import Any, Dict, List, Optional
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.prompt_builder", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/prompt_builder.log")
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2500"))
+PROMPT_NOTES_MAX_TOKENS = int(os.getenv("PROMPT_NOTES_MAX_TOKENS", "300"))
+PROMPT_ELIGIBILITY_TEXT_MAX_TOKENS = int(os.getenv("PROMPT_ELIGIBILITY_TEXT_MAX_TOKENS", "1000"))
+PROMPT_TOKENIZER_ENCODING = os.getenv("PROMPT_TOKENIZER_ENCODING", "o200k_base")
+
+# Rough per-message overhead of the chat format (role and separators)
+_MESSAGE_OVERHEAD_TOKENS = 4
+_TRUNCATION_MARKER = " [...truncated]"
+
+# Static instructions first, then the per-patient block, then the per-trial block: the
+# first two are byte-identical across a patient's trials, so provider-side prompt
+# caching can reuse them.
+ANALYSIS_SYSTEM_PROMPT = dedent("""
+    You are an expert AI assistant specialized in clinical trial matching. You output ONLY valid JSON.
+    Analyze the patient against the trial criteria **meticulously**.
+    The first user message is the Patient Profile Snippet. The second user message holds the Trial Details Snippet,
+    the criteria already verified in code (do not re-check them) and the structured criteria needing confirmation
+    (patient data missing). Fields marked [...truncated] were shortened to fit the prompt budget.
+    **Think step-by-step** comparing patient details against trial criteria.
+    **Decision:** Conclude 'Potential Match', 'Likely Not a Match', or 'Uncertain'.
+    **Rationale:** List specific points supporting a match.
+    **Flags:** List specific points against a match or needing review.
+    **Output ONLY a JSON object** with keys, in this order: "decision", "reasoning_steps", "match_rationale", "flags".
+""").strip()
+
+_encoding: Any = None
+_encoding_unavailable = False
+
+
+def _get_encoding() -> Optional[Any]:
+    """Load the tiktoken encoding once; None if tiktoken or its BPE file is unavailable."""
+    global _encoding, _encoding_unavailable
+    if _encoding is None and not _encoding_unavailable:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(PROMPT_TOKENIZER_ENCODING)
+        except Exception as e:
+            _encoding_unavailable = True
+            logger.warning(f"tiktoken encoding {PROMPT_TOKENIZER_ENCODING} unavailable ({e}); estimating 4 chars per token")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens tokens, marking it as truncated."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    max_tokens = max(0, max_tokens - count_tokens(_TRUNCATION_MARKER))
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4] + _TRUNCATION_MARKER
+    return encoding.decode(encoding.encode(text)[:max_tokens]) + _TRUNCATION_MARKER
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    """Tokens a chat prompt costs: each message's content plus the per-message overhead."""
+    return sum(count_tokens(message["content"]) + _MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+@dataclass
+class AnalysisPrompt:
+    messages: List[Dict[str, str]]
+    prompt_tokens: int
+    prefix_tokens: int  # system + patient messages, shared by every trial for this patient
+    trimmed_fields: List[str] = field(default_factory=list)
+
+
+def _patient_message(patient_profile: Dict[str, Any], trimmed: List[str]) -> Dict[str, str]:
+    profile = dict(patient_profile)
+    # Capped independently of the trial so the patient block (the cached prefix) never varies per trial
+    if isinstance(profile.get("notes"), str) and count_tokens(profile["notes"]) > PROMPT_NOTES_MAX_TOKENS:
+        profile["notes"] = truncate_to_tokens(profile["notes"], PROMPT_NOTES_MAX_TOKENS)
+        trimmed.append("notes")
+    return {"role": "user", "content": f"Patient Profile Snippet: {json.dumps(profile)}"}
+
+
+def _trial_message(trial_details: Dict[str, Any], verified: List[str], unverified: List[str]) -> Dict[str, str]:
+    return {"role": "user", "content": (
+        f"Trial Details Snippet: {json.dumps(trial_details)}\n"
+        f"Criteria already verified in code (do not re-check): {json.dumps(verified)}\n"
+        f"Structured criteria needing confirmation (patient data missing): {json.dumps(unverified)}"
+    )}
+
+
+def build_analysis_prompt(patient_profile: Dict[str, Any], trial_details: Dict[str, Any], verified: List[str],
+                          unverified: List[str], budget: int = PROMPT_TOKEN_BUDGET) -> AnalysisPrompt:
+    """Lay out the analysis prompt as [static system, patient, trial] within a token budget.
+
+    Oversized free text is truncated and criteria lists lose their trailing items,
+    in the order eligibility_text, inclusions, exclusions, until the prompt fits.
+    """
+    trimmed: List[str] = []
+    prefix = [{"role": "system", "content": ANALYSIS_SYSTEM_PROMPT}, _patient_message(patient_profile, trimmed)]
+    prefix_tokens = count_message_tokens(prefix)
+
+    trial = dict(trial_details)
+    if isinstance(trial.get("eligibility_text"), str) and count_tokens(trial["eligibility_text"]) > PROMPT_ELIGIBILITY_TEXT_MAX_TOKENS:
+        trial["eligibility_text"] = truncate_to_tokens(trial["eligibility_text"], PROMPT_ELIGIBILITY_TEXT_MAX_TOKENS)
+        trimmed.append("eligibility_text")
+
+    def trial_tokens() -> int:
+        return count_message_tokens([_trial_message(trial, verified, unverified)])
+
+    available = budget - prefix_tokens
+    for name in ("eligibility_text", "inclusions", "exclusions"):
+        over = trial_tokens() - available
+        if over <= 0:
+            break
+        value = trial.get(name)
+        if isinstance(value, str) and value:
+            trial[name] = truncate_to_tokens(value, max(0, count_tokens(value) - over))
+        elif isinstance(value, list) and value:
+            kept, omitted = list(value), 0
+            while kept and trial_tokens() > available:
+                kept.pop()
+                omitted += 1
+                trial[name] = kept + [f"[{omitted} more criteria omitted]"]
+        else:
+            continue
+        if name not in trimmed:
+            trimmed.append(name)
+
+    messages = prefix + [_trial_message(trial, verified, unverified)]
+    prompt_tokens = count_message_tokens(messages)
+    if prompt_tokens > budget:
+        logger.warning(f"Prompt is {prompt_tokens} tokens after trimming, over the {budget} token budget")
+    return AnalysisPrompt(messages=messages, prompt_tokens=prompt_tokens, prefix_tokens=prefix_tokens, trimmed_fields=trimmed)
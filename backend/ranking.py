@@ -0,0 +1,167 @@
+import heapq
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from models import CriteriaEvaluation, PatientFeatures, TrialData
+from criteria import evaluate_structured_criteria, extract_structured_criteria
+from patient_features import features_for, required_biomarker
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.ranking", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/ranking.log")
+
+# Score = coverage * W_COVERAGE + similarity * W_SIMILARITY + llm_confidence * W_LLM, each component in [0, 1]
+RANKING_WEIGHT_COVERAGE = float(os.getenv("RANKING_WEIGHT_COVERAGE", "0.4"))
+RANKING_WEIGHT_SIMILARITY = float(os.getenv("RANKING_WEIGHT_SIMILARITY", "0.2"))
+RANKING_WEIGHT_LLM = float(os.getenv("RANKING_WEIGHT_LLM", "0.4"))
+RANKING_FLAG_PENALTY = float(os.getenv("RANKING_FLAG_PENALTY", "0.1"))
+# Matches scoring at least this are "high confidence"; K of them end analysis early
+RANKING_HIGH_CONFIDENCE_SCORE = float(os.getenv("RANKING_HIGH_CONFIDENCE_SCORE", "0.75"))
+RANKING_DEFAULT_LIMIT = int(os.getenv("RANKING_DEFAULT_LIMIT", "10"))
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = {"cancer", "disease", "of", "the", "and", "with", "stage"}
+
+
+def _tokens(text: Optional[str]) -> Set[str]:
+    return {t for t in _TOKEN_RE.findall((text or "").lower()) if t not in _STOPWORDS}
+
+
+def criteria_coverage(evaluation: CriteriaEvaluation) -> float:
+    """Share of structured criteria the patient is known to meet; 0.5 when a trial has none."""
+    total = len(evaluation.met) + len(evaluation.failed) + len(evaluation.unknown)
+    if total == 0:
+        return 0.5
+    return len(evaluation.met) / total
+
+
+def retrieval_similarity(patient_profile: Dict[str, Any], trial: TrialData) -> float:
+    """Overlap between the patient's condition/biomarkers and the trial's condition, title and markers."""
+    patient_terms = _tokens(patient_profile.get("condition"))
+    trial_terms = _tokens(trial.condition) | _tokens(trial.title)
+    condition_overlap = len(patient_terms & trial_terms) / len(patient_terms) if patient_terms else 0.0
+
+    required = {required_biomarker(m) for m in trial.required_markers}
+    if not required:
+        return condition_overlap
+    patient_markers = set(features_for(patient_profile).biomarkers)
+    return 0.5 * condition_overlap + 0.5 * len(required & patient_markers) / len(required)
+
+
+def llm_confidence(flags: List[str]) -> float:
+    return max(0.0, 1.0 - RANKING_FLAG_PENALTY * len(flags))
+
+
+def score_match(coverage: float, similarity: float, flags: List[str]) -> float:
+    return round(RANKING_WEIGHT_COVERAGE * coverage + RANKING_WEIGHT_SIMILARITY * similarity
+                 + RANKING_WEIGHT_LLM * llm_confidence(flags), 4)
+
+
+@dataclass
+class RankingCandidate:
+    trial: TrialData
+    coverage: float
+    similarity: float
+    eligible: bool  # False if a structured criterion already rules the pair out
+
+    @property
+    def upper_bound(self) -> float:
+        """Best score this trial can reach: the LLM part can at most add its full weight."""
+        if not self.eligible:
+            return 0.0
+        return score_match(self.coverage, self.similarity, [])
+
+
+def plan_analysis_order(patient_profile: Dict[str, Any], trials: List[TrialData]) -> List[RankingCandidate]:
+    """Order trials by their score upper bound so likely matches are analyzed first.
+
+    Uses only in-process signals (structured criteria and retrieval similarity), no LLM calls.
+    """
+    candidates = []
+    features = features_for(patient_profile)
+    for trial in trials:
+        structured = trial.structured_criteria or extract_structured_criteria(trial)
+        evaluation = evaluate_structured_criteria(structured, patient_profile, features)
+        candidates.append(RankingCandidate(
+            trial=trial,
+            coverage=criteria_coverage(evaluation),
+            similarity=retrieval_similarity(patient_profile, trial),
+            eligible=evaluation.status != "ineligible",
+        ))
+    candidates.sort(key=lambda c: (-c.upper_bound, c.trial.id))
+    return candidates
+
+
+def plan_patient_order(trial: TrialData, patients: List[Tuple[Dict[str, Any], PatientFeatures]]) -> List[Tuple[str, float]]:
+    """Reverse-matching counterpart of plan_analysis_order: (patient_id, upper bound), best first.
+
+    `patients` pairs each profile with its precomputed features; no LLM calls are made.
+    """
+    structured = trial.structured_criteria or extract_structured_criteria(trial)
+    planned = []
+    for profile, features in patients:
+        evaluation = evaluate_structured_criteria(structured, profile, features)
+        candidate = RankingCandidate(
+            trial=trial,
+            coverage=criteria_coverage(evaluation),
+            similarity=retrieval_similarity(profile, trial),
+            eligible=evaluation.status != "ineligible",
+        )
+        planned.append((profile["patient_id"], candidate.upper_bound))
+    planned.sort(key=lambda entry: (-entry[1], entry[0]))
+    return planned
+
+
+class TopKRanker:
+    """Keeps the k best matches in a min-heap while analyses complete.
+
+    Matches are anything with a `rank_score`; `key` gives the id that breaks score ties
+    (a TrialMatch's trial id by default).
+    """
+
+    def __init__(self, k: int, high_confidence_score: float = RANKING_HIGH_CONFIDENCE_SCORE,
+                 key: Callable[[Any], str] = lambda match: match.id):
+        self.k = k
+        self.high_confidence_score = high_confidence_score
+        self.key = key
+        self._heap: List[Tuple[float, Tuple[int, ...], int, Any]] = []
+        self.seen = 0
+
+    def push(self, match: Any) -> None:
+        self.seen += 1
+        # Ties go to the lexicographically smaller id, same as the final ordering
+        entry = (match.rank_score or 0.0, _reverse_key(self.key(match)), self.seen, match)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+
+    @property
+    def full(self) -> bool:
+        return len(self._heap) >= self.k
+
+    @property
+    def min_score(self) -> float:
+        return self._heap[0][0] if self.full else 0.0
+
+    def can_stop(self, next_upper_bound: Optional[float]) -> bool:
+        """True once analyzing the remaining trials is not worth the LLM calls.
+
+        Either all k kept matches are high confidence, or no remaining trial can
+        outscore the weakest kept match (trials are visited by descending upper bound).
+        """
+        if not self.full:
+            return False
+        if self.min_score >= self.high_confidence_score:
+            return True
+        return next_upper_bound is not None and next_upper_bound <= self.min_score
+
+    def results(self) -> List[Any]:
+        """Kept matches, best first."""
+        return [entry[-1] for entry in sorted(self._heap, key=lambda e: (-e[0], self.key(e[-1])))]
+
+
+def _reverse_key(text: str) -> Tuple[int, ...]:
+    # Inverts string order so that, among equal scores, the heap evicts the larger id first
+    return tuple(-ord(ch) for ch in text) + (0,)
@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from models import RematchSummary, TrialData, TrialMatch
+from catalogue import TrialCatalogue
+from match_store import MatchStore
+from patient_index import PatientIndex
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.rematch", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/rematch.log")
+
+REMATCH_CONCURRENCY = int(os.getenv("REMATCH_CONCURRENCY", "8"))
+
+AnalyzePairFn = Callable[[Dict[str, Any], TrialData], Awaitable[Dict[str, Any]]]
+PairRemovedFn = Callable[[str, str, str], Awaitable[None]]
+
+
+def content_version(data: Dict[str, Any]) -> str:
+    """Stable digest of the fields an analysis depends on."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def trial_version(trial: TrialData) -> str:
+    return content_version(trial.model_dump(exclude={"structured_criteria"}))
+
+
+class RematchEngine:
+    """Change-driven re-matching.
+
+    Tracks, for every analyzed (patient, trial) pair, the profile and trial versions
+    it was computed from. A trial or profile change only recomputes the pairs whose
+    versions went stale, so the work is proportional to the change rather than to
+    the population.
+
+    The tracking is per process. With a `match_store`, the matches stored there are
+    also treated as dependents, so a change handled after a restart, or by another
+    worker, still invalidates every stored match it affects.
+    """
+
+    def __init__(self, catalogue: TrialCatalogue, patient_index: PatientIndex, analyze_pair: AnalyzePairFn,
+                 on_pair_removed: Optional[PairRemovedFn] = None, match_store: Optional[MatchStore] = None):
+        self.catalogue = catalogue
+        self.patient_index = patient_index
+        self._analyze_pair = analyze_pair
+        self._on_pair_removed = on_pair_removed
+        self.match_store = match_store
+        self._pair_versions: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        self._trial_dependents: Dict[str, Set[str]] = {}
+        self._patient_dependents: Dict[str, Set[str]] = {}
+        self.match_lists: Dict[str, Dict[str, TrialMatch]] = {}
+        self._lock = asyncio.Lock()
+
+    def matches_for_patient(self, patient_id: str) -> List[TrialMatch]:
+        return sorted(self.match_lists.get(patient_id, {}).values(), key=lambda m: -(m.rank_score or 0.0))
+
+    def record_analysis(self, profile: Dict[str, Any], trial: TrialData, analysis: Dict[str, Any]) -> bool:
+        """Track a completed analysis, wherever it ran, as a dependency of its versions.
+
+        Returns:
+            True if the pair is now a match that was not one before.
+        """
+        patient_id, trial_id = profile["patient_id"], trial.id
+        self._pair_versions[(patient_id, trial_id)] = (content_version(profile), trial_version(trial))
+        self._trial_dependents.setdefault(trial_id, set()).add(patient_id)
+        self._patient_dependents.setdefault(patient_id, set()).add(trial_id)
+        patient_matches = self.match_lists.setdefault(patient_id, {})
+        if analysis.get("status") == "success":
+            added = trial_id not in patient_matches
+            patient_matches[trial_id] = analysis["match_data"]
+            return added
+        patient_matches.pop(trial_id, None)
+        return False
+
+    async def _stored_matches(self, trial_id: Optional[str] = None, patient_id: Optional[str] = None) -> Set[Tuple[str, str]]:
+        """(patient, trial) pairs whose latest stored result is a match, for one trial or one patient."""
+        if self.match_store is None:
+            return set()
+        if trial_id is not None:
+            patient_ids = await asyncio.to_thread(self.match_store.matched_patients_for_trial, trial_id)
+            return {(matched_patient, trial_id) for matched_patient in patient_ids}
+        trial_ids = await asyncio.to_thread(self.match_store.matched_trials_for_patient, patient_id)
+        return {(patient_id, matched_trial) for matched_trial in trial_ids}
+
+    async def _forget_pairs(self, pairs: List[Tuple[str, str]], reason: str, summary: RematchSummary,
+                            stored: Set[Tuple[str, str]]) -> None:
+        for patient_id, trial_id in pairs:
+            self._pair_versions.pop((patient_id, trial_id), None)
+            self._trial_dependents.get(trial_id, set()).discard(patient_id)
+            self._patient_dependents.get(patient_id, set()).discard(trial_id)
+            was_match = self.match_lists.get(patient_id, {}).pop(trial_id, None) is not None
+            if was_match or (patient_id, trial_id) in stored:
+                summary.matchesRemoved += 1
+                if self._on_pair_removed:
+                    await self._on_pair_removed(patient_id, trial_id, reason)
+
+    async def _recompute_pairs(self, pairs: List[Tuple[str, str]], summary: RematchSummary,
+                               stored: Set[Tuple[str, str]]) -> None:
+        semaphore = asyncio.Semaphore(REMATCH_CONCURRENCY)
+
+        async def recompute(patient_id: str, trial_id: str) -> None:
+            profile = self.patient_index.get(patient_id)
+            trial = self.catalogue.get(trial_id)
+            versions = (content_version(profile), trial_version(trial))
+            if self._pair_versions.get((patient_id, trial_id)) == versions:
+                summary.pairsSkipped += 1
+                return
+            async with semaphore:
+                analysis = await self._analyze_pair(profile, trial)
+            if analysis.get("status") == "error":
+                # Leave the pair stale so the next change retries it
+                logger.warning(f"Re-match failed for patient {patient_id}, trial {trial_id}: {analysis.get('message')}")
+                summary.pairsFailed += 1
+                return
+            summary.pairsRecomputed += 1
+            was_match = trial_id in self.match_lists.get(patient_id, {}) or (patient_id, trial_id) in stored
+            if self.record_analysis(profile, trial, analysis):
+                summary.matchesAdded += 1
+            elif was_match and analysis.get("status") != "success":
+                summary.matchesRemoved += 1
+
+        await asyncio.gather(*(recompute(patient_id, trial_id) for patient_id, trial_id in pairs))
+
+    async def on_trial_changed(self, trial_dict: Dict[str, Any]) -> RematchSummary:
+        """Ingest a new or updated trial and recompute only the affected pairs."""
+        async with self._lock:
+            trial = self.catalogue.upsert(trial_dict)
+            if trial is None:
+                raise ValueError(f"Invalid trial data for {trial_dict.get('id')}")
+            summary = RematchSummary(trigger=f"trial:{trial.id}")
+            stored = await self._stored_matches(trial_id=trial.id)
+            previous_dependents = set(self._trial_dependents.get(trial.id, set())) | {p for p, _ in stored}
+
+            if trial.status != "Recruiting":
+                # No LLM work needed: the trial simply leaves every match list
+                await self._forget_pairs([(p, trial.id) for p in sorted(previous_dependents)],
+                                         f"Trial status changed to {trial.status}", summary, stored)
+                logger.info(f"Trial {trial.id} is no longer recruiting; removed from {summary.matchesRemoved} match lists")
+                return summary
+
+            candidates = set(self.patient_index.candidates_for_trial(trial))
+            await self._forget_pairs([(p, trial.id) for p in sorted(previous_dependents - candidates)],
+                                     "Patient no longer passes the trial's structured pre-filter", summary, stored)
+            await self._recompute_pairs([(patient_id, trial.id) for patient_id in sorted(candidates)], summary, stored)
+            logger.info(f"Re-match after trial change {trial.id}: {summary.model_dump()}")
+            return summary
+
+    async def on_patient_changed(self, profile: Dict[str, Any]) -> RematchSummary:
+        """Ingest a new or updated patient profile and recompute only that patient's pairs."""
+        async with self._lock:
+            patient_id = profile["patient_id"]
+            self.patient_index.upsert(profile)
+            summary = RematchSummary(trigger=f"patient:{patient_id}")
+            stored = await self._stored_matches(patient_id=patient_id)
+            previous_dependents = set(self._patient_dependents.get(patient_id, set())) | {t for _, t in stored}
+
+            candidate_trials = {
+                trial.id for trial in self.catalogue.search(profile.get("condition") or "")
+                if self.patient_index.passes_trial_filters(patient_id, trial)
+            } if profile.get("condition") else set()
+            await self._forget_pairs([(patient_id, t) for t in sorted(previous_dependents - candidate_trials)],
+                                     "Updated profile no longer passes the trial's structured pre-filter", summary, stored)
+            await self._recompute_pairs([(patient_id, trial_id) for trial_id in sorted(candidate_trials)], summary, stored)
+            logger.info(f"Re-match after patient change {patient_id}: {summary.model_dump()}")
+            return summary
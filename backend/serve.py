@@ -0,0 +1,95 @@
+"""Process-manager entry point: runs the API in several worker processes.
+
+    python serve.py --workers 4 --port 8000
+    python serve.py --shards 3 --port 8000   # local sharded cluster behind a coordinator
+
+Each worker is a full copy of the app with its own event loop. With more than one
+worker, analyses are shared through the SQLite analysis cache (unless another
+shared backend is configured), so a pair analyzed by one worker is a cache hit in
+the others and concurrent requests for the same pair run a single LLM analysis.
+The trial catalogue, patient index and re-match state are per worker, though:
+a PUT /api/v1/trials or /api/v1/patients update reaches only the worker that
+served it, and the others keep the data they loaded at startup until restarted.
+
+With --shards N, N shard nodes run on the following ports (each holding the
+patients the hash ring assigns it, with its own match store, job queue and
+analysis cache under SHARD_DATA_DIR) and the coordinator serves on --port.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import uvicorn
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.serve", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/serve.log")
+
+# Defaults applied to every worker when running more than one; explicit settings win.
+MULTI_WORKER_ENV_DEFAULTS = {
+    "ANALYSIS_CACHE_BACKEND": "sqlite",
+}
+SHARD_DATA_DIR = os.getenv("SHARD_DATA_DIR", "data/shards")
+
+
+def default_workers() -> int:
+    return int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the trial matcher API with multiple worker processes.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: WEB_CONCURRENCY or CPU count; 1 per shard with --shards)")
+    parser.add_argument("--shards", type=int, default=0, help="Run this many local shard nodes behind a coordinator")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    args = parser.parse_args()
+
+    if args.shards > 0:
+        run_local_shards(args.shards, args.workers or 1, args.host, args.port)
+        return
+    workers = max(1, args.workers or default_workers())
+    if workers > 1:
+        for name, value in MULTI_WORKER_ENV_DEFAULTS.items():
+            os.environ.setdefault(name, value)
+        if os.environ["ANALYSIS_CACHE_BACKEND"] == "memory":
+            logger.warning("ANALYSIS_CACHE_BACKEND=memory with several workers: each worker keeps its own cache")
+    logger.info(f"Starting {workers} worker(s) on {args.host}:{args.port} "
+                f"(analysis cache: {os.getenv('ANALYSIS_CACHE_BACKEND', 'memory')})")
+    # Workers are spawned processes that import main:app themselves and inherit os.environ
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=workers)
+
+
+def run_local_shards(shards: int, workers: int, host: str, port: int) -> None:
+    """Start `shards` shard nodes on ports port+1.. as subprocesses and the coordinator on `port`."""
+    nodes = {f"shard-{i}": f"http://127.0.0.1:{port + 1 + i}" for i in range(shards)}
+    spec = ",".join(f"{name}={url}" for name, url in nodes.items())
+    processes = []
+    for i, name in enumerate(nodes):
+        data_dir = os.path.join(SHARD_DATA_DIR, name)
+        env = {**os.environ, "SHARD_NODES": spec, "SHARD_ID": name,
+               "MATCH_STORE_PATH": os.path.join(data_dir, "match_store.db"),
+               "JOB_QUEUE_PATH": os.path.join(data_dir, "jobs.db"),
+               "ANALYSIS_CACHE_PATH": os.path.join(data_dir, "analysis_cache.db")}
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port + 1 + i)],
+            env=env,
+        ))
+    logger.info(f"Started {shards} shard node(s): {spec}")
+    os.environ["SHARD_NODES"] = spec
+    os.environ.pop("SHARD_ID", None)
+    try:
+        uvicorn.run("coordinator:app", host=host, port=port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,29 @@
 import asyncio
+import logging
 import os
 import json
 import random
-from textwrap import dedent
-from typing import List, Union, Dict, Any, Optional, Iterator
-
-# --- OpenAI Library Import for direct client use ---
-from openai import AsyncAzureOpenAI as SdkAsyncAzureOpenAI
-
-# --- Pydantic Model for LLM Analysis Output ---
-from pydantic import BaseModel, Field # BaseModel and Field are standard Pydantic
-
-# --- Agno Imports ---
-from dotenv import load_dotenv
-from agno.agent import Agent
-from agno.models.azure import AzureOpenAI as AgnoAzureOpenAI
-from agno.workflow import Workflow, RunEvent, RunResponse
-# from agno.storage.sqlite import SqliteStorage # Example if persistent storage is needed
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, List, Union, Dict, Any, Optional, Iterator, Tuple
+
+# --- Heavy imports (openai, agno) are deferred ---
+# They cost over a second at import time, so they are only imported when a client
+# or workflow is first built (normally from the FastAPI lifespan via init_llm_clients).
+if TYPE_CHECKING:
+    from openai import AsyncAzureOpenAI as SdkAsyncAzureOpenAI
+    from agno.models.azure import AzureOpenAI as AgnoAzureOpenAI
+    from workflow import ClinicalTrialMatchingWorkflow
+
+from pydantic import ValidationError
 
 # --- Local Imports ---
 # All Pydantic response/data models are now imported from models.py
 from models import (
     TrialMatch,
+    PatientMatch,
     # TrialSearchResponse, # Not directly used in this workflow's output, but kept for consistency
     PatientProfileResponse,
     # PatientProfile,     # For type hints in tool functions
@@ -29,13 +31,26 @@ from models import (
     LLMAnalysisResult,      # Used internally by _analyze_trial_match_tool
     TrialAnalysisResponse,
     DiscoverTrialsToolInput,
+    RematchSummary,
     TrialData           # For trial validation
 )
+from analysis_cache import ANALYSIS_CACHE_CLAIM_SECONDS, ANALYSIS_CACHE_POLL_SECONDS, analysis_cache, analysis_cache_key
+from catalogue import TrialCatalogue
+from match_store import MatchStore
+from patient_index import PatientIndex
+from rematch import RematchEngine, content_version, trial_version
+from criteria import evaluate_structured_criteria, extract_structured_criteria
+from llm_output import LlmJsonParser, StreamingAnalysisParser
+from prompt_builder import build_analysis_prompt, count_message_tokens, count_tokens
+from offload import CpuOffloader
+from ranking import RANKING_DEFAULT_LIMIT, TopKRanker, criteria_coverage, plan_patient_order, retrieval_similarity, score_match
+from circuit_breaker import CircuitOpenError, GuardedClient, llm_breaker
+from sharding import owns_patient
+from accounting import RequestAccount, mark_stage, record_event, record_llm_call, track
+from metrics import metrics
 from logger import setup_logger
 
 # --- Configuration & Initialization ---
-load_dotenv()
-
 # Azure OpenAI Configuration
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -43,6 +58,48 @@ AZURE_OPENAI_API_TYPE = os.getenv("AZURE_OPENAI_API_TYPE", "azure")
 OPENAI_API_VERSION = os.getenv("OPENAI_API_VERSION")
 AZURE_OPENAI_DEPLOYMENT_NAME_AGENT = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
 AZURE_OPENAI_DEPLOYMENT_NAME_TOOL_LLM = os.getenv("LLM_MODEL", AZURE_OPENAI_DEPLOYMENT_NAME_AGENT)
+# Cheaper deployment used to screen pairs when the analysis cascade is enabled
+AZURE_OPENAI_DEPLOYMENT_NAME_SCREEN_LLM = os.getenv("LLM_SCREEN_MODEL", AZURE_OPENAI_DEPLOYMENT_NAME_TOOL_LLM)
+ANALYSIS_CASCADE_ENABLED = os.getenv("ANALYSIS_CASCADE_ENABLED", "false").lower() == "true"
+ANALYSIS_CASCADE_ESCALATE_DECISIONS = {
+    decision.strip() for decision in os.getenv("ANALYSIS_CASCADE_ESCALATE_DECISIONS", "Uncertain,Potential Match").split(",")
+    if decision.strip()
+}
+
+# Stream analysis completions and stop generating once the decision is one of these
+ANALYSIS_STREAMING_ENABLED = os.getenv("ANALYSIS_STREAMING_ENABLED", "false").lower() == "true"
+ANALYSIS_EARLY_STOP_DECISIONS = {
+    decision.strip() for decision in os.getenv("ANALYSIS_EARLY_STOP_DECISIONS", "Likely Not a Match").split(",")
+    if decision.strip()
+}
+
+# Analyzer JSON is validated in one pass; malformed output is repaired in-process rather than re-requested
+analysis_output_parser = LlmJsonParser(LLMAnalysisResult)
+REPAIRED_OUTPUT_FLAG = "LLM output was malformed and repaired in-process; confirm eligibility manually"
+
+# Per-tier deployment and price (USD per 1K tokens) for latency/cost reporting
+LLM_TIERS: Dict[str, Dict[str, Any]] = {
+    "screen": {
+        "deployment": AZURE_OPENAI_DEPLOYMENT_NAME_SCREEN_LLM,
+        "prompt_cost_per_1k": float(os.getenv("LLM_SCREEN_PROMPT_COST_PER_1K", "0.00015")),
+        "completion_cost_per_1k": float(os.getenv("LLM_SCREEN_COMPLETION_COST_PER_1K", "0.0006")),
+    },
+    "strong": {
+        "deployment": AZURE_OPENAI_DEPLOYMENT_NAME_TOOL_LLM,
+        "prompt_cost_per_1k": float(os.getenv("LLM_STRONG_PROMPT_COST_PER_1K", "0.0025")),
+        "completion_cost_per_1k": float(os.getenv("LLM_STRONG_COMPLETION_COST_PER_1K", "0.01")),
+    },
+    # Orchestration agents (profiler, discoverer, analyzer) on AZURE_OPENAI_DEPLOYMENT_NAME
+    "agent": {
+        "deployment": AZURE_OPENAI_DEPLOYMENT_NAME_AGENT,
+        "prompt_cost_per_1k": float(os.getenv("LLM_AGENT_PROMPT_COST_PER_1K", "0.0025")),
+        "completion_cost_per_1k": float(os.getenv("LLM_AGENT_COMPLETION_COST_PER_1K", "0.01")),
+    },
+}
+
+# Simulated database/search latency in the mock tools: random | fixed (midpoint of the range) | off.
+# Use fixed or off together with LLM_CASSETTE_MODE=replay for repeatable performance runs.
+SIMULATED_IO_MODE = os.getenv("SIMULATED_IO_MODE", "random").lower()
 
 if AZURE_OPENAI_API_KEY: os.environ["AZURE_OPENAI_API_KEY"] = AZURE_OPENAI_API_KEY
 if AZURE_OPENAI_ENDPOINT: os.environ["AZURE_OPENAI_ENDPOINT"] = AZURE_OPENAI_ENDPOINT
@@ -51,21 +108,47 @@ if OPENAI_API_VERSION: os.environ["OPENAI_API_VERSION"] = OPENAI_API_VERSION
 
 logger = setup_logger("trial_matcher.services", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/services.log")
 
-# LLM instance for Agno Agents
-# Ensure this is a valid Agno model configuration
-agent_llm_config = AgnoAzureOpenAI(
-    id=AZURE_OPENAI_DEPLOYMENT_NAME_AGENT, # The deployment name for the agent's reasoning LLM
-    # model_name=AZURE_OPENAI_DEPLOYMENT_NAME_AGENT # Some Agno models might use model_name
-)
+# LLM instance for Agno Agents and SDK client for _analyze_trial_match_tool.
+# Both are built lazily on first use; init_llm_clients() builds them eagerly at startup.
+_agent_llm_config: Optional["AgnoAzureOpenAI"] = None
+_azure_sdk_client_for_tool: Optional["SdkAsyncAzureOpenAI"] = None
 
 
-# SDK client for direct use in _analyze_trial_match_tool - initialized globally
-# This LLM is specifically for the analysis step if not done by an agent's LLM
-azure_sdk_client_for_tool = SdkAsyncAzureOpenAI(
-    api_key=AZURE_OPENAI_API_KEY,
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    api_version=OPENAI_API_VERSION,
-)
+def get_agent_llm_config() -> "AgnoAzureOpenAI":
+    global _agent_llm_config
+    if _agent_llm_config is None:
+        from agno.models.azure import AzureOpenAI as AgnoAzureOpenAI
+        from llm_cassette import cassette_enabled, wrap_client
+        agent_llm = AgnoAzureOpenAI(
+            id=AZURE_OPENAI_DEPLOYMENT_NAME_AGENT, # The deployment name for the agent's reasoning LLM
+        )
+        # Agno reuses a preset async_client, so each agent model call goes through the cassette
+        # (when enabled) and the LLM circuit breaker
+        client = wrap_client(agent_llm.get_async_client) if cassette_enabled() else agent_llm.get_async_client()
+        agent_llm.async_client = GuardedClient(client, llm_breaker)
+        _agent_llm_config = agent_llm
+    return _agent_llm_config
+
+
+def get_azure_sdk_client() -> "SdkAsyncAzureOpenAI":
+    # This LLM is specifically for the analysis step if not done by an agent's LLM
+    global _azure_sdk_client_for_tool
+    if _azure_sdk_client_for_tool is None:
+        from openai import AsyncAzureOpenAI as SdkAsyncAzureOpenAI
+        from llm_cassette import wrap_client
+        _azure_sdk_client_for_tool = wrap_client(lambda: SdkAsyncAzureOpenAI(
+            api_key=AZURE_OPENAI_API_KEY,
+            azure_endpoint=AZURE_OPENAI_ENDPOINT,
+            api_version=OPENAI_API_VERSION,
+        ))
+    return _azure_sdk_client_for_tool
+
+
+def init_llm_clients() -> None:
+    """Build the LLM clients, their HTTP connection pools and the workflow pool."""
+    get_agent_llm_config().get_async_client()
+    get_azure_sdk_client()
+    workflow_pool.warm()
 
 # --- Mock Data (Not fetched from a SQLite DB to avoid hassle of setup during testing and demo) ---
 MOCK_PATIENT_DB = {
@@ -82,10 +165,44 @@ MOCK_TRIALS_DB = [
     # ... other trials
 ]
 
+# Trials are ingested once at startup; structured criteria are parsed here rather than per analysis.
+trial_catalogue = TrialCatalogue(MOCK_TRIALS_DB)
+cpu_offloader = CpuOffloader(trial_catalogue)
+# On a shard node only the patients the hash ring assigns to this node are indexed and screened
+patient_index = PatientIndex(p for p in MOCK_PATIENT_DB.values() if owns_patient(p["patient_id"]))
+
+REVERSE_MATCH_CONCURRENCY = int(os.getenv("REVERSE_MATCH_CONCURRENCY", "8"))
+# Most candidates analyzed for one reverse-match request, however deep the requested page
+REVERSE_MATCH_MAX_ANALYSES = int(os.getenv("REVERSE_MATCH_MAX_ANALYSES", "200"))
+
+# Persistent, indexed store of analysis results so dashboards can read precomputed matches
+match_store = MatchStore()
+
+
+async def _persist_analyses(patient_id: str, analyses: List[Tuple[str, Optional[TrialMatch], Optional[LLMAnalysisResult]]]) -> None:
+    """Save (trial_id, match, llm_analysis) results for a patient. Store failures are logged, never raised."""
+    rows = [{
+        "patient_id": patient_id,
+        "trial_id": trial_id,
+        "catalogue_version": trial_catalogue.version,
+        "model": AZURE_OPENAI_DEPLOYMENT_NAME_TOOL_LLM or "unknown",
+        "match": match.model_dump() if match else None,
+        "analysis": llm_analysis.model_dump() if llm_analysis else None,
+    } for trial_id, match, llm_analysis in analyses]
+    try:
+        await asyncio.to_thread(match_store.save_results, rows)
+    except Exception as e:
+        logger.error(f"Failed to persist {len(rows)} analyses for patient {patient_id}: {e}", exc_info=True)
+
+async def _simulate_io(low: float, high: float) -> None:
+    if SIMULATED_IO_MODE == "off":
+        return
+    await asyncio.sleep((low + high) / 2 if SIMULATED_IO_MODE == "fixed" else random.uniform(low, high))
+
 # --- Tool Functions (These will be equipped to Agents) ---
 async def _fetch_patient_profile_tool(patient_id: str) -> Dict[str, Any]:
     logger.debug(f"Executing _fetch_patient_profile_tool for {patient_id}")
-    await asyncio.sleep(random.uniform(0.1, 0.3)) # Simulate IO
+    await _simulate_io(0.1, 0.3) # Simulate IO
     if patient_id == "PATIENT_ERROR":
         return {"error": "Simulated database connection error", "status": "error"}
     profile_data = MOCK_PATIENT_DB.get(patient_id)
@@ -118,24 +235,17 @@ async def _discover_trials_tool(patient_id: str,
         patient_condition = patient_profile.condition.lower()
         if not patient_condition:
             return {"status": "error", "error": "Patient profile missing condition."}
-        await asyncio.sleep(random.uniform(0.2, 0.5)) # To mock real-world asynchronous operations that involve waiting for I/O
+        await _simulate_io(0.2, 0.5) # To mock real-world asynchronous operations that involve waiting for I/O
 
-        logger.debug(f"[_discover_trials_tool] MOCK_TRIALS_DB before filtering: {json.dumps(MOCK_TRIALS_DB)}")
-        relevant_trials_models: List[TrialData] = []
-        for t_dict in MOCK_TRIALS_DB:
-
-            if patient_condition in t_dict.get("condition", "").lower() and t_dict.get("status") == "Recruiting":
-                try:
-                    relevant_trials_models.append(TrialData(**t_dict))
-                except Exception as e:
-                    logger.warning(f"[_discover_trials_tool] Could not parse trial dict into TrialData model: {t_dict}. Error: {e}")
-                    continue
+        relevant_trials_models: List[TrialData] = await cpu_offloader.search(patient_condition)
 
         ids_from_models = [model.id for model in relevant_trials_models]
         logger.debug(f"[_discover_trials_tool] IDs of relevant_trials_models (before model_dump): {ids_from_models}")
 
-        result_to_return = {"status": "success", "trials": [model.model_dump() for model in relevant_trials_models]}
-        logger.debug(f"[_discover_trials_tool] EXACT output being returned: {json.dumps(result_to_return)}")
+        # Structured criteria stay server-side; the agent only relays the raw trial fields.
+        result_to_return = {"status": "success", "trials": [model.model_dump(exclude={"structured_criteria"}) for model in relevant_trials_models]}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[_discover_trials_tool] EXACT output being returned: {json.dumps(result_to_return)}")
 
         return result_to_return
 
@@ -146,17 +256,173 @@ async def _discover_trials_tool(patient_id: str,
         logger.error(f"Exception in _discover_trials_tool: {e}", exc_info=True)
         return {"status": "error", "error": f"Unexpected tool error: {str(e)}"}
 
-_ANALYSIS_PROMPT_TEMPLATE_FOR_LLM_TOOL = dedent("""
-    You are an expert AI assistant specialized in clinical trial matching.
-    Analyze the patient against the trial criteria **meticulously**.
-    Patient Profile Snippet: {patient_profile_str}
-    Trial Details Snippet: {trial_details_str}
-    **Think step-by-step** comparing patient details against trial criteria.
-    **Decision:** Conclude 'Potential Match', 'Likely Not a Match', or 'Uncertain'.
-    **Rationale:** List specific points supporting a match.
-    **Flags:** List specific points against a match or needing review.
-    **Output ONLY a JSON object** with keys: "decision", "reasoning_steps", "match_rationale", "flags".
-""")
+metrics.describe("llm_calls_total", "LLM calls by tier (screen/strong analyses, agent orchestration)")
+metrics.describe("llm_call_latency_seconds", "Analysis LLM call latency by tier")
+metrics.describe("llm_tokens_total", "LLM tokens by tier and kind")
+metrics.describe("llm_cost_usd_total", "Estimated LLM cost by tier")
+metrics.describe("analysis_prompt_tokens", "Analysis prompt size after budgeting")
+metrics.describe("analysis_prompt_prefix_tokens", "Cache-eligible prompt prefix (instructions + patient block)")
+metrics.describe("llm_early_stops_total", "Streamed analyses cut short once the decision was known")
+metrics.describe("analysis_cascade_pairs_total", "Pairs screened by the cheap tier")
+metrics.describe("analysis_cascade_escalations_total", "Screened pairs escalated to the strong tier")
+metrics.describe("analysis_cascade_unusable_screens_total", "Screen-tier answers escalated because they were empty, unparseable or repaired")
+metrics.describe("analysis_cascade_escalation_rate", "Share of screened pairs escalated to the strong tier")
+metrics.describe("degraded_responses_total", "Trial searches served from stored analyses and structured criteria while the LLM circuit was open")
+metrics.describe("ranking_analyses_skipped_total", "Trial analyses skipped once the top-K matches were settled")
+metrics.describe("analysis_cache_peer_waits_total", "Analyses that waited for another request or worker to finish the same pair")
+
+
+def _llm_cost(tier: str, prompt_tokens: int, completion_tokens: int) -> float:
+    tier_config = LLM_TIERS[tier]
+    return (prompt_tokens * tier_config["prompt_cost_per_1k"] + completion_tokens * tier_config["completion_cost_per_1k"]) / 1000
+
+
+def _record_tokens(tier: str, source: str, calls: int, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> None:
+    """Add LLM usage to the per-tier metrics and to the current request's account."""
+    metrics.inc("llm_tokens_total", prompt_tokens, tier=tier, kind="prompt")
+    metrics.inc("llm_tokens_total", completion_tokens, tier=tier, kind="completion")
+    if cached_tokens:
+        metrics.inc("llm_tokens_total", cached_tokens, tier=tier, kind="cached_prompt")
+    cost = _llm_cost(tier, prompt_tokens, completion_tokens)
+    metrics.inc("llm_cost_usd_total", cost, tier=tier)
+    record_llm_call(source, prompt_tokens, completion_tokens, cached_tokens, cost, calls=calls)
+
+
+def _record_llm_call(tier: str, started: float, usage: Any) -> None:
+    metrics.inc("llm_calls_total", tier=tier)
+    metrics.observe("llm_call_latency_seconds", time.perf_counter() - started, tier=tier)
+    if usage is None:
+        record_llm_call(f"analysis:{tier}")
+        return
+    prompt_details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(prompt_details, "cached_tokens", None) or 0
+    _record_tokens(tier, f"analysis:{tier}", 1, usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+
+
+def _record_agent_run(agent_name: str, response: Any) -> None:
+    """Account for the LLM calls an agent made during one arun (one entry per model response)."""
+    run_metrics = getattr(response, "metrics", None) or {}
+    calls = len(run_metrics.get("input_tokens") or [])
+    if not calls:
+        return
+    metrics.inc("llm_calls_total", calls, tier="agent")
+    _record_tokens("agent", f"agent:{agent_name}", calls, sum(run_metrics.get("input_tokens") or []),
+                   sum(run_metrics.get("output_tokens") or []), sum(run_metrics.get("cached_tokens") or []))
+
+
+def _estimated_usage(messages: List[Dict[str, str]], streamed_text: str) -> Any:
+    """Token usage for a stream closed before its final (usage) chunk, counted locally.
+
+    The prompt is billed in full; the completion is billed for what was generated
+    before the close, which is at least what was streamed.
+    """
+    from openai.types import CompletionUsage
+    prompt_tokens = count_message_tokens(messages)
+    completion_tokens = count_tokens(streamed_text) if streamed_text else 0
+    return CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                           total_tokens=prompt_tokens + completion_tokens)
+
+
+async def _stream_analysis(messages: List[Dict[str, str]], tier: str) -> Optional[str]:
+    """Stream a completion, stopping as soon as the decision makes the rest unnecessary.
+
+    "decision" is the first key of the requested JSON, so for early-stop decisions
+    the remaining generation is cancelled and whatever rationale has already been
+    streamed is kept. Usage only arrives with the final chunk, so a stream closed
+    before it (early stop, cancellation) is accounted from a local token count.
+    """
+    started = time.perf_counter()
+    stream = await get_azure_sdk_client().chat.completions.create(
+        model=LLM_TIERS[tier]["deployment"],
+        messages=messages,
+        temperature=0.2,
+        response_format={"type": "json_object"},
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    parser = StreamingAnalysisParser()
+    usage = None
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                parser.feed(chunk.choices[0].delta.content)
+                if parser.decision in ANALYSIS_EARLY_STOP_DECISIONS:
+                    metrics.inc("llm_early_stops_total", tier=tier)
+                    logger.debug(f"Early stop on '{parser.decision}' after {len(parser.text)} chars")
+                    return json.dumps(parser.partial_result())
+    finally:
+        await stream.close()
+        if usage is None:
+            metrics.inc("llm_estimated_usage_total", tier=tier)
+            usage = _estimated_usage(messages, parser.text)
+        _record_llm_call(tier, started, usage)
+    return parser.text or None
+
+
+async def _complete_analysis(messages: List[Dict[str, str]], tier: str) -> Optional[str]:
+    """Run one analysis completion on a model tier and record its latency, tokens and cost."""
+    if ANALYSIS_STREAMING_ENABLED:
+        return await llm_breaker.call(_stream_analysis(messages, tier))
+    started = time.perf_counter()
+    #The use of the OpenAI SDK directly has been chosen for control and precision.
+    chat_completion = await llm_breaker.call(get_azure_sdk_client().chat.completions.create(
+        model=LLM_TIERS[tier]["deployment"],
+        messages=messages,
+        temperature=0.2,
+        response_format={"type": "json_object"}
+    ))
+    _record_llm_call(tier, started, getattr(chat_completion, "usage", None))
+    if chat_completion.choices and chat_completion.choices[0].message:
+        return chat_completion.choices[0].message.content
+    return None
+
+
+def _record_cascade_decision(escalated: bool) -> None:
+    metrics.inc("analysis_cascade_pairs_total")
+    if escalated:
+        metrics.inc("analysis_cascade_escalations_total")
+    metrics.set_gauge("analysis_cascade_escalation_rate",
+                      metrics.counter_value("analysis_cascade_escalations_total") / metrics.counter_value("analysis_cascade_pairs_total"))
+
+
+def _parse_screen_output(raw: Optional[str], trial_id: str) -> Optional[LLMAnalysisResult]:
+    """The screen tier's verdict, or None if its answer was empty, unparseable or needed repair.
+
+    None escalates the pair: a screen answer that is not clean JSON is no verdict.
+    """
+    if not raw:
+        reason = "empty"
+    else:
+        try:
+            parsed, repaired = analysis_output_parser.parse_with_repair_flag(raw)
+            if not repaired:
+                logger.debug(f"LLM analysis (SDK, screen tier) for trial {trial_id}: {parsed.decision}")
+                return parsed
+            reason = "repaired"
+        except ValidationError:
+            reason = "unparseable"
+    logger.info(f"Screen-tier output for trial {trial_id} was {reason}; escalating to the strong tier")
+    metrics.inc("analysis_cascade_unusable_screens_total", reason=reason)
+    return None
+
+
+async def _await_peer_analysis(cache_key: str) -> Optional[Dict[str, Any]]:
+    """Wait for the holder of an analysis claim to publish its result.
+
+    Returns None if the claim is released or expires without a result (the holder
+    failed or died), in which case the caller runs the analysis itself.
+    """
+    metrics.inc("analysis_cache_peer_waits_total")
+    deadline = time.monotonic() + ANALYSIS_CACHE_CLAIM_SECONDS
+    while time.monotonic() < deadline:
+        await asyncio.sleep(ANALYSIS_CACHE_POLL_SECONDS)
+        result = await analysis_cache.aget(cache_key)
+        if result is not None or not await analysis_cache.ais_claimed(cache_key):
+            return result
+    return None
+
 
 #Pydantic model definition does not work, openAI keeps on giving error
 #Invalid schema for function '_analyze_trial_match_tool': In context=('properties', 'patient_profile'), 'propertyNames' is not permitted.
@@ -189,64 +455,113 @@ async def _analyze_trial_match_tool(
     trial_url: Optional[str] = None
 ) -> Dict[str, Any]:
 
+    # Snapshot the arguments before any locals are defined; they fully determine the analysis.
+    analysis_inputs = dict(locals())
     logger.debug(f"Executing _analyze_trial_match_tool for trial_id: {trial_id}")
 
-    # Handle optional lists for patient profile
-    actual_patient_prior_therapies = patient_prior_therapies or []
-    actual_patient_biomarkers = patient_biomarkers or []
-    
-    # Handle optional lists for trial data
-    actual_trial_required_markers = trial_required_markers or []
-    actual_trial_exclusions = trial_exclusions or []
-    actual_trial_inclusions = trial_inclusions or []
-
-    # For the LLM prompt template
-    patient_profile_for_prompt = {
-        "age": patient_age, 
-        "condition": patient_condition, # Patient's condition
-        "stage": patient_stage,
-        "biomarkers": actual_patient_biomarkers,
-        "notes": patient_notes
-    }
-    # For the LLM prompt template, use the specific trial fields
-    trial_details_for_prompt = {
-        "min_age": trial_min_age,
-        "max_age": trial_max_age,
-        "condition": trial_condition, # Trial's target condition
-        "required_markers": actual_trial_required_markers,
-        "inclusions": actual_trial_inclusions,
-        "exclusions": actual_trial_exclusions
-    }
+    cache_key = analysis_cache_key(patient_id, trial_id, analysis_inputs)
+    claim_token = None
+    cached_result = await analysis_cache.aget(cache_key)
+    if cached_result is None:
+        claim_token = await analysis_cache.aclaim(cache_key)
+        if claim_token is None:
+            # Another request, possibly in another worker process, is analyzing this exact pair
+            cached_result = await _await_peer_analysis(cache_key)
+            if cached_result is None:
+                # The holder gave up or died; take over its claim (None if yet another worker already has)
+                claim_token = await analysis_cache.aclaim(cache_key)
+    if cached_result is not None:
+        logger.debug(f"Analysis cache hit for patient {patient_id}, trial {trial_id}")
+        record_event("analysis_cache_hits")
+        return cached_result
 
-    patient_profile_str_for_prompt = json.dumps(patient_profile_for_prompt)
-    trial_details_str_for_prompt = json.dumps(trial_details_for_prompt)
-    
-    prompt_content = _ANALYSIS_PROMPT_TEMPLATE_FOR_LLM_TOOL.format(
-        patient_profile_str=patient_profile_str_for_prompt, # Use the new var name
-        trial_details_str=trial_details_str_for_prompt    # Use the new var name
-    )
-    
-    messages_for_sdk: list[dict[str, str]] = [
-        {"role": "system", "content": "You output ONLY valid JSON."},
-        {"role": "user", "content": prompt_content}
-    ]
     raw_llm_response_content = None
+    # From here on the claim is ours: any failure must still release it (finally) and come back as an error result
     try:
-        #The use of the OpenAI SDK directly has been chosen for control and precision.
-        chat_completion = await azure_sdk_client_for_tool.chat.completions.create(
-            model=AZURE_OPENAI_DEPLOYMENT_NAME_TOOL_LLM,
-            messages=messages_for_sdk,
-            temperature=0.2,
-            response_format={"type": "json_object"}
-        )
-        if chat_completion.choices and chat_completion.choices[0].message:
-            raw_llm_response_content = chat_completion.choices[0].message.content
-        if not raw_llm_response_content:
-            return {"status": "error", "message": "LLM returned empty content (SDK)."}
-
-        parsed_llm_data = LLMAnalysisResult(**json.loads(raw_llm_response_content))
-        # Use trial_id (the parameter) for logging
-        logger.debug(f"LLM analysis (SDK) for trial {trial_id}: {parsed_llm_data.decision}")
+        # Handle optional lists for patient profile
+        actual_patient_prior_therapies = patient_prior_therapies or []
+        actual_patient_biomarkers = patient_biomarkers or []
+    
+        # Handle optional lists for trial data
+        actual_trial_required_markers = trial_required_markers or []
+        actual_trial_exclusions = trial_exclusions or []
+        actual_trial_inclusions = trial_inclusions or []
+
+        patient_profile_for_prompt = {
+            "age": patient_age, 
+            "condition": patient_condition, # Patient's condition
+            "stage": patient_stage,
+            "biomarkers": actual_patient_biomarkers,
+            "notes": patient_notes
+        }
+
+        # Structured criteria are precomputed by the catalogue; fall back to parsing the
+        # tool arguments if the agent hands us a trial the catalogue does not know.
+        catalogue_trial = trial_catalogue.get(trial_id)
+        if catalogue_trial and catalogue_trial.structured_criteria:
+            structured_criteria = catalogue_trial.structured_criteria
+            ranking_trial = catalogue_trial
+        else:
+            ranking_trial = TrialData(
+                id=trial_id, title=trial_title, condition=trial_condition, phase=trial_phase, status=trial_status,
+                min_age=trial_min_age, max_age=trial_max_age, required_markers=actual_trial_required_markers,
+                exclusions=actual_trial_exclusions, inclusions=actual_trial_inclusions,
+                eligibility_text=trial_eligibility_text, url=trial_url,
+            )
+            structured_criteria = extract_structured_criteria(ranking_trial)
+        criteria_evaluation = evaluate_structured_criteria(structured_criteria, patient_profile_for_prompt)
+
+        if criteria_evaluation.status == "ineligible":
+            # A hard structured criterion fails; no need to spend an LLM call on this pair.
+            logger.debug(f"Trial {trial_id} excluded by structured criteria: {criteria_evaluation.failed}")
+            record_event("structured_prunes")
+            structured_result = LLMAnalysisResult(
+                decision="Likely Not a Match",
+                reasoning_steps=["Evaluated structured eligibility criteria in-process."],
+                match_rationale=criteria_evaluation.met,
+                flags=criteria_evaluation.failed,
+            )
+            result = {"status": "no_match", "reason": structured_result.decision, "details": structured_result.model_dump(), "llm_analysis": structured_result}
+            await analysis_cache.aset(cache_key, result)
+            return result
+
+        # Only the residual, unstructured criteria are sent to the LLM
+        trial_details_for_prompt = {
+            "condition": trial_condition, # Trial's target condition
+            "inclusions": structured_criteria.residual_inclusions,
+            "exclusions": structured_criteria.residual_exclusions,
+            "eligibility_text": structured_criteria.residual_eligibility_text,
+        }
+
+        prompt = build_analysis_prompt(patient_profile_for_prompt, trial_details_for_prompt,
+                                       criteria_evaluation.met, criteria_evaluation.unknown)
+        logger.info(f"Analysis prompt for patient {patient_id}, trial {trial_id}: {prompt.prompt_tokens} tokens, "
+                    f"cache-eligible prefix {prompt.prefix_tokens} tokens"
+                    + (f", trimmed {prompt.trimmed_fields}" if prompt.trimmed_fields else ""))
+        metrics.observe("analysis_prompt_tokens", prompt.prompt_tokens)
+        metrics.observe("analysis_prompt_prefix_tokens", prompt.prefix_tokens)
+        messages_for_sdk = prompt.messages
+        # In cascade mode the cheap tier screens first and only uncertain/positive pairs reach the strong tier
+        tiers = ("screen", "strong") if ANALYSIS_CASCADE_ENABLED else ("strong",)
+        for tier in tiers:
+            raw_llm_response_content = await _complete_analysis(messages_for_sdk, tier)
+            if tier == "screen":
+                screened = _parse_screen_output(raw_llm_response_content, trial_id)
+                escalate = screened is None or screened.decision in ANALYSIS_CASCADE_ESCALATE_DECISIONS
+                _record_cascade_decision(escalate)
+                if not escalate:
+                    parsed_llm_data = screened
+                    break
+                continue
+            if not raw_llm_response_content:
+                return {"status": "error", "message": "LLM returned empty content (SDK)."}
+
+            parsed_llm_data, repaired = analysis_output_parser.parse_with_repair_flag(raw_llm_response_content)
+            if repaired:
+                # Truncation may have cut off flags; make sure a repaired analysis is reviewed
+                parsed_llm_data.flags.append(REPAIRED_OUTPUT_FLAG)
+            # Use trial_id (the parameter) for logging
+            logger.debug(f"LLM analysis (SDK, {tier} tier) for trial {trial_id}: {parsed_llm_data.decision}")
 
         if parsed_llm_data.decision == "Potential Match":
             # Use trial_phase (the parameter)
@@ -260,370 +575,367 @@ async def _analyze_trial_match_tool(
                 phase=phase_value,
                 condition=trial_condition, 
                 locations=["Location Pending API"], 
-                matchRationale=parsed_llm_data.match_rationale, 
-                flags=parsed_llm_data.flags,
+                matchRationale=criteria_evaluation.met + parsed_llm_data.match_rationale,
+                flags=parsed_llm_data.flags + [f"Requires confirmation: {c}" for c in criteria_evaluation.unknown],
                 detailsUrl=trial_url,    
                 contactInfo="Contact Pending API", 
-                rank_score=round(1.0 - (len(parsed_llm_data.flags) * 0.1), 2)
+                rank_score=score_match(criteria_coverage(criteria_evaluation),
+                                       retrieval_similarity(patient_profile_for_prompt, ranking_trial),
+                                       parsed_llm_data.flags)
             )
             # TrialAnalysisResponse expects a TrialMatch Pydantic object for match_data
-            return {"status": "success", "match_data": match_data, "llm_analysis": parsed_llm_data}
+            result = {"status": "success", "match_data": match_data, "llm_analysis": parsed_llm_data}
         else:
             # TrialAnalysisResponse expects an LLMAnalysisResult Pydantic object for llm_analysis
-            return {"status": "no_match", "reason": parsed_llm_data.decision, "details": parsed_llm_data.model_dump(), "llm_analysis": parsed_llm_data}
+            result = {"status": "no_match", "reason": parsed_llm_data.decision, "details": parsed_llm_data.model_dump(), "llm_analysis": parsed_llm_data}
+        await analysis_cache.aset(cache_key, result)
+        return result
             
-    except json.JSONDecodeError as e:
+    except ValidationError as e:
         logger.error(f"SDK JSON Parsing Error: {e}. Raw: {raw_llm_response_content}", exc_info=True)
         return {"status": "error", "message": "LLM output parsing failed (SDK)."}
+    except CircuitOpenError:
+        logger.warning(f"LLM circuit open; analysis for patient {patient_id}, trial {trial_id} skipped")
+        return {"status": "error", "message": "LLM backend unavailable (circuit open)."}
     except NameError as ne:
         logger.error(f"NameError in _analyze_trial_match_tool: {ne}", exc_info=True)
         return {"status": "error", "message": f"NameError in tool: {ne}"}
     except Exception as e:
         logger.error(f"SDK LLM Call Error or other Exception in _analyze_trial_match_tool: {e}", exc_info=True)
         return {"status": "error", "message": f"LLM API call failed (SDK) or other tool error: {str(e)}"}
+    finally:
+        if claim_token:
+            await analysis_cache.arelease(cache_key, claim_token)
+
+
+async def _analyze_patient_trial_pair(profile: Dict[str, Any], trial: TrialData) -> Dict[str, Any]:
+    """Run the analysis tool for a patient profile dict and a catalogue trial."""
+    return await _analyze_trial_match_tool(
+        patient_id=profile["patient_id"],
+        patient_condition=profile["condition"],
+        patient_age=profile["age"],
+        trial_id=trial.id,
+        trial_title=trial.title,
+        trial_condition=trial.condition,
+        trial_phase=trial.phase,
+        trial_status=trial.status,
+        patient_stage=profile.get("stage"),
+        patient_prior_therapies=profile.get("priorTherapies"),
+        patient_biomarkers=profile.get("biomarkers"),
+        patient_notes=profile.get("notes"),
+        trial_min_age=trial.min_age,
+        trial_max_age=trial.max_age,
+        trial_required_markers=trial.required_markers,
+        trial_exclusions=trial.exclusions,
+        trial_inclusions=trial.inclusions,
+        trial_eligibility_text=trial.eligibility_text,
+        trial_url=trial.url,
+    )
 
 
-# --- Define Clinical Trial Matching Workflow ---
-class ClinicalTrialMatchingWorkflow(Workflow):
-    description: str = "Orchestrates agents to find clinical trial matches for a patient using a direct workflow with Agents."
-
-    patient_profiler_agent: Agent
-    trial_discoverer_agent: Agent
-    trial_analyzer_agent: Agent
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.patient_profiler_agent = Agent(
-            name="PatientProfilerAgent",
-            role="Fetches a patient's profile using their ID.",
-            model=agent_llm_config,
-            tools=[_fetch_patient_profile_tool],
-            instructions="You will be given a patient_id. Use the `_fetch_patient_profile_tool` with this patient_id to get the profile. Output the result from the tool.",
-            response_model=PatientProfileResponse,
-            structured_outputs=True,
-        )        
-
-        self.trial_discoverer_agent = Agent(
-            name="TrialDiscovererAgent",
-            role="Discovers clinical trials based on a patient's profile.",
-            model=agent_llm_config,
-            tools=[_discover_trials_tool],
-            # tool_choice={"type": "function", "function": {"name": "_discover_trials_tool"}}, <-- Going into infinite loop if used
-            instructions=(
-                "You will receive a JSON string containing a 'patient_profile' object. "
-                "You are FORCED to call the `_discover_trials_tool`. "
-                "Extract the necessary values from the 'patient_profile' object in your input "
-                "to use as named arguments for the `_discover_trials_tool` (patient_id, condition, age, etc.). "
-                "The `_discover_trials_tool` will return a JSON string. "
-                "Your *only* task is to output this EXACT JSON string that the tool returns. "
-                "Do not modify it in any way. Do not try to parse it or reformat it. Output the raw JSON string."
-            ),
-            response_model=DiscoveredTrialsResponse,
-            structured_outputs=True,
-            show_tool_calls=True
-        )
+# --- Incremental re-matching on trial / profile changes ---
+async def _analyze_and_persist_pair(profile: Dict[str, Any], trial: TrialData) -> Dict[str, Any]:
+    analysis = await _analyze_patient_trial_pair(profile, trial)
+    if analysis.get("status") != "error":
+        await _persist_analyses(profile["patient_id"], [(trial.id, analysis.get("match_data"), analysis.get("llm_analysis"))])
+    return analysis
 
-        self.trial_analyzer_agent = Agent(
-            name="TrialAnalyzerAgent",
-            role="Analyzes a single trial against a patient's profile for a match.",
-            model=agent_llm_config, 
-            tools=[(_analyze_trial_match_tool)],
-            # tool_choice = {"type": "function", "function": {"name": "_analyze_trial_match_tool"}}, <-- Going into infinite loop if used
-            instructions=["You will be given a patient_profile (JSON string). Parse it into a dictionary. This dictionary is the 'patient_profile' argument for the '_discover_trials_tool'. Call the tool and output its result.", "DO NOT CREATE ANY TRIAL IDs YOURSELF."],
-            response_model=TrialAnalysisResponse, 
-            structured_outputs=True,
-            show_tool_calls=True 
-        )
 
+async def _persist_removed_pair(patient_id: str, trial_id: str, reason: str) -> None:
+    removal = LLMAnalysisResult(decision="Likely Not a Match", reasoning_steps=[reason], flags=[reason])
+    await _persist_analyses(patient_id, [(trial_id, None, removal)])
 
-    async def _get_cached_data(self, key_prefix: str, patient_id: str) -> Optional[Any]:
-        key = f"{key_prefix}_{patient_id}"
-        data = self.session_state.get(key)
-        if data:
-            logger.debug(f"Workflow cache hit for key: {key}")
-            
-            return data
-        logger.debug(f"Workflow cache miss for key: {key}")
+
+rematch_engine = RematchEngine(trial_catalogue, patient_index, _analyze_and_persist_pair, on_pair_removed=_persist_removed_pair,
+                              match_store=match_store)
+
+
+async def update_trial(trial_dict: Dict[str, Any]) -> RematchSummary:
+    """Upsert a trial into the catalogue and re-match only the pairs it affects."""
+    return await rematch_engine.on_trial_changed(trial_dict)
+
+
+async def update_patient_profile(profile_dict: Dict[str, Any]) -> RematchSummary:
+    """Upsert a patient profile and re-match only that patient's pairs."""
+    MOCK_PATIENT_DB[profile_dict["patient_id"]] = profile_dict
+    return await rematch_engine.on_patient_changed(profile_dict)
+
+
+# --- Reverse matching: trial -> eligible patients ---
+async def find_patients_for_trial(trial_id: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+    """Find and rank patients who could fit a trial.
+
+    The population is pre-filtered through the patient index (condition, biomarkers,
+    age). Survivors are analyzed best upper bound first, REVERSE_MATCH_CONCURRENCY at
+    a time through the shared analysis cache, until the top page*page_size matches
+    are settled or REVERSE_MATCH_MAX_ANALYSES candidates have been analyzed.
+
+    Returns:
+        Dict with the requested page of ranked matches, or an error_type dict.
+    """
+    logger.info(f"find_patients_for_trial for trial: {trial_id}")
+    trial = trial_catalogue.get(trial_id)
+    if trial is None:
+        return {"error_type": "TRIAL_NOT_FOUND", "message": f"Trial {trial_id} not found."}
+
+    candidate_ids = patient_index.candidates_for_trial(trial)
+    planned = plan_patient_order(trial, [(patient_index.get(pid), patient_index.features(pid)) for pid in candidate_ids])
+    ranker = TopKRanker(page * page_size, key=lambda match: match.patientId)
+
+    async def analyze(patient_id: str) -> Optional[PatientMatch]:
+        profile = patient_index.get(patient_id)
+        analysis = await _analyze_patient_trial_pair(profile, trial)
+        if analysis.get("status") == "error":
+            logger.warning(f"Reverse match analysis failed for patient {patient_id}, trial {trial_id}: {analysis.get('message')}")
+            return None
+        rematch_engine.record_analysis(profile, trial, analysis)
+        await _persist_analyses(patient_id, [(trial_id, analysis.get("match_data"), analysis.get("llm_analysis"))])
+        if analysis.get("status") != "success":
+            return None
+        match_data: TrialMatch = analysis["match_data"]
+        return PatientMatch(patientId=patient_id, condition=profile["condition"], age=profile["age"], stage=profile.get("stage"),
+                            matchRationale=match_data.matchRationale, flags=match_data.flags, rank_score=match_data.rank_score)
+
+    analyzed = 0
+    budget = min(len(planned), REVERSE_MATCH_MAX_ANALYSES)
+    while analyzed < budget and not ranker.can_stop(planned[analyzed][1]):
+        batch = planned[analyzed:min(analyzed + REVERSE_MATCH_CONCURRENCY, budget)]
+        for match in await asyncio.gather(*(analyze(patient_id) for patient_id, _ in batch)):
+            if match:
+                ranker.push(match)
+        analyzed += len(batch)
+    if analyzed < len(planned):
+        metrics.inc("ranking_analyses_skipped_total", len(planned) - analyzed)
+
+    start = (page - 1) * page_size
+    logger.info(f"Reverse match for {trial_id}: {len(candidate_ids)} candidates screened, {analyzed} analyzed, {ranker.seen} matches")
+    return {
+        "trialId": trial_id,
+        "matches": ranker.results()[start:start + page_size],
+        "totalMatches": ranker.seen,
+        "page": page,
+        "pageSize": page_size,
+        "candidatesScreened": len(candidate_ids),
+        "candidatesAnalyzed": analyzed,
+    }
+
+
+# --- Per-request state and pooled workflows ---
+WORKFLOW_POOL_SIZE = int(os.getenv("WORKFLOW_POOL_SIZE", "8"))
+
+
+@dataclass
+class MatchingRunContext:
+    """Per-request state for one workflow run; never shared between requests."""
+    patient_id: str
+    use_cache: bool = True
+    # Only the best `limit` matches are kept; analysis stops once they are settled
+    limit: int = RANKING_DEFAULT_LIMIT
+    session_state: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def session_id(self) -> str:
+        return f"direct_workflow_agents_for_{self.patient_id}"
+
+
+class WorkflowPool:
+    """Keeps prebuilt ClinicalTrialMatchingWorkflow instances for reuse across requests.
+
+    Each lease gets exclusive use of one workflow (agno Agents are not safe to run
+    concurrently), so concurrent requests stay isolated. When every pooled workflow
+    is busy a fresh one is built; at most `size` are kept idle afterwards.
+    """
+
+    def __init__(self, size: int = WORKFLOW_POOL_SIZE):
+        self.size = size
+        self._idle: deque = deque()
+        self.built = 0
+
+    def _build(self) -> "ClinicalTrialMatchingWorkflow":
+        from workflow import ClinicalTrialMatchingWorkflow
+        self.built += 1
+        workflow = ClinicalTrialMatchingWorkflow(debug_mode=os.getenv("DEBUG_MODE", "false").lower() == "true")
+        workflow.prebuild_tool_schemas()
+        return workflow
+
+    def warm(self) -> None:
+        while len(self._idle) < self.size:
+            self._idle.append(self._build())
+        logger.info(f"Workflow pool warmed with {len(self._idle)} workflows")
+
+    @contextmanager
+    def lease(self):
+        workflow = self._idle.pop() if self._idle else self._build()
+        try:
+            yield workflow
+        finally:
+            workflow.reset_agents()
+            if len(self._idle) < self.size:
+                self._idle.append(workflow)
+
+
+workflow_pool = WorkflowPool()
+
+
+# --- Startup warm-up ---
+WARMUP_SYNTHETIC_ANALYSIS = os.getenv("WARMUP_SYNTHETIC_ANALYSIS", "true").lower() == "true"
+
+
+async def warm_up() -> Dict[str, Any]:
+    """Pay every in-process initialisation cost before the first real request.
+
+    The trial catalogue and patient index are built at import; this builds the LLM
+    clients and pooled workflows and starts the CPU offload pool. Nothing here calls
+    the LLM, so an unreachable Azure deployment does not hold readiness back (see probe_llm).
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    init_llm_clients()
+    cpu_offloader.start()
+    details: Dict[str, Any] = {
+        "trials": len(trial_catalogue),
+        "offload": cpu_offloader.mode,
+        "patients": len(patient_index),
+        "workflows": workflow_pool.built,
+    }
+    details["duration_ms"] = round((loop.time() - started) * 1000, 1)
+    logger.info(f"Warm-up complete: {details}")
+    return details
+
+
+async def probe_llm() -> str:
+    """Run one synthetic analysis completion so the TLS connection to the Azure deployment is open.
+
+    The completion goes straight to the strong tier: the analysis cache is neither read
+    nor written, so every worker makes a real call even when a sibling already probed.
+    Returns the model's decision, or "skipped" when WARMUP_SYNTHETIC_ANALYSIS is off.
+
+    Raises:
+        RuntimeError: if the completion fails or returns no content.
+    """
+    if not WARMUP_SYNTHETIC_ANALYSIS:
+        return "skipped"
+    prompt = build_analysis_prompt(
+        {"age": 50, "condition": "Warm-up", "stage": None, "biomarkers": [], "notes": None},
+        {"condition": "Warm-up", "inclusions": ["Synthetic warm-up request; any decision is acceptable."],
+         "exclusions": [], "eligibility_text": None},
+        [], [],
+    )
+    try:
+        raw_llm_response_content = await _complete_analysis(prompt.messages, "strong")
+    except Exception as e:
+        raise RuntimeError(f"Synthetic warm-up analysis failed: {e}") from e
+    if not raw_llm_response_content:
+        raise RuntimeError("Synthetic warm-up analysis failed: LLM returned empty content (SDK).")
+    try:
+        decision = analysis_output_parser.parse(raw_llm_response_content).decision
+    except ValidationError:
+        # The connection is warm either way; an odd answer to a synthetic prompt is not a failure
+        decision = "unparsed"
+    logger.info(f"LLM probe succeeded: {decision}")
+    return decision
+
+
+# --- Read API over persisted match results ---
+async def get_stored_matches_for_patient(patient_id: str, min_rank_score: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+    return await asyncio.to_thread(match_store.latest_for_patient, patient_id, min_rank_score, limit)
+
+
+async def get_stored_matches_for_trial(trial_id: str, min_rank_score: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+    return await asyncio.to_thread(match_store.matches_for_trial, trial_id, min_rank_score, limit)
+
+
+async def stored_matches_version_for_patient(patient_id: str) -> str:
+    """Version of a patient's stored matches: catalogue version, profile version and store revision."""
+    profile = patient_index.get(patient_id)
+    revision = await asyncio.to_thread(match_store.patient_revision, patient_id)
+    return f"{trial_catalogue.version}:{content_version(profile) if profile else '-'}:{revision}"
+
+
+async def stored_matches_version_for_trial(trial_id: str) -> str:
+    """Version of a trial's stored matches: catalogue version, trial version and store revision."""
+    trial = trial_catalogue.get(trial_id)
+    revision = await asyncio.to_thread(match_store.trial_revision, trial_id)
+    return f"{trial_catalogue.version}:{trial_version(trial) if trial else '-'}:{revision}"
+
+
+# --- Degraded mode while the LLM backend is unhealthy ---
+def _structured_match(profile: Dict[str, Any], trial: TrialData) -> Optional[TrialMatch]:
+    """Match a trial on structured criteria alone; None if a hard criterion fails."""
+    evaluation = evaluate_structured_criteria(trial.structured_criteria or extract_structured_criteria(trial), profile,
+                                              patient_index.features(profile["patient_id"]))
+    if evaluation.status == "ineligible":
         return None
+    flags = [f"Requires confirmation: {c}" for c in evaluation.unknown]
+    return TrialMatch(
+        id=trial.id,
+        title=trial.title,
+        status=trial.status,
+        phase=f"Phase {trial.phase}" if trial.phase not in [None, "N/A", ""] else "N/A",
+        condition=trial.condition,
+        locations=["Location Pending API"],
+        matchRationale=evaluation.met,
+        flags=["Structured criteria only: LLM review unavailable"] + flags,
+        detailsUrl=trial.url,
+        contactInfo="Contact Pending API",
+        rank_score=score_match(criteria_coverage(evaluation), retrieval_similarity(profile, trial), flags),
+    )
 
-    async def _add_cached_data(self, key_prefix: str, patient_id: str, data: Any):
-        key = f"{key_prefix}_{patient_id}"
-        logger.debug(f"Workflow caching data for key: {key}")
-        
-        if hasattr(data, 'model_dump'):
-            self.session_state[key] = data.model_dump()
-        else:
-            self.session_state[key] = data
-
-
-    # # This synchronous run method is generally not ideal if your primary entry is async.
-    # # It's kept for compatibility with how Agno might expect to call workflows in some contexts.
-    # def run(self, patient_id: str, use_cache: bool = True) -> Iterator[RunResponse]:
-    #     logger.warning(
-    #         "Synchronous Workflow.run() called. For async execution from FastAPI, "
-    #         "the run_trial_matching_workflow (async) function is preferred."
-    #     )
-    #     # This path would require careful handling of event loops if an outer loop is running.
-    #     # For simplicity in this context, we'll assume it's called where it can manage its own loop
-    #     # or that it won't be the primary execution path from an async framework.
-    #     if asyncio.get_event_loop().is_running():
-    #         logger.error("Synchronous run() cannot be reliably called when an event loop is already running.")
-    #         yield RunResponse(
-    #             content={"error_type": "ASYNC_CONFLICT", "message": "Sync run called with running event loop."},
-    #             event=RunEvent.workflow_completed, run_id=self.run_id)
-    #         return
-
-    #     loop = asyncio.new_event_loop()
-    #     asyncio.set_event_loop(loop)
-    #     try:
-    #         content, event = loop.run_until_complete(
-    #             self._arun_steps(patient_id, use_cache)
-    #         )
-    #         yield RunResponse(content=content, event=event, run_id=self.run_id)
-    #     except Exception as e:
-    #         logger.error(f"Workflow run failed in synchronous wrapper for {patient_id}: {e}", exc_info=True)
-    #         yield RunResponse(
-    #             content={"error_type": "WORKFLOW_SYNC_EXECUTION_ERROR", "message": str(e)},
-    #             event=RunEvent.workflow_completed, run_id=self.run_id )
-    #     finally:
-    #         loop.close()
-
-
-    async def _arun_steps(self, patient_id: str, use_cache: bool) -> tuple[Union[List[Dict[str, Any]], Dict[str, Any]], RunEvent]:
-        # 0. Check cache for final result
-        if use_cache:
-            cached_final_result = await self._get_cached_data("final_matches", patient_id)
-            if cached_final_result is not None and isinstance(cached_final_result, (list, dict)):
-                logger.info(f"Returning cached final result for patient {patient_id}")
-                return cached_final_result, RunEvent.workflow_completed
-
-        # 1. Fetch Patient Profile using Agent
-        logger.info(f"Step 1: Fetching patient profile for {patient_id} using Agent")
-        profile_data: Optional[Dict[str, Any]] = None
-        patient_profile_response_obj: Optional[PatientProfileResponse] = None
-
-        if use_cache:
-            cached_profile_dict = await self._get_cached_data("patient_profile_agent_response", patient_id)
-            if cached_profile_dict:
-                try:
-                    patient_profile_response_obj = PatientProfileResponse(**cached_profile_dict)
-                    if patient_profile_response_obj.status == "success" and patient_profile_response_obj.profile:
-                        profile_data = patient_profile_response_obj.profile
-                except Exception as e:
-                    logger.warning(f"Could not validate cached patient profile: {e}")
-
-
-        if not profile_data:
-            profiler_response: RunResponse = await self.patient_profiler_agent.arun(patient_id) # Agent's async run
-            if profiler_response and isinstance(profiler_response.content, PatientProfileResponse):
-                patient_profile_response_obj = profiler_response.content
-                if use_cache:
-                    await self._add_cached_data("patient_profile_agent_response", patient_id, patient_profile_response_obj) # Cache the Pydantic object's dict
-            else:
-                err_msg = "Patient Profiler Agent did not return valid PatientProfileResponse."
-                logger.error(f"{err_msg} Content: {profiler_response.content if profiler_response else 'None'}")
-                return {"error_type": "AGENT_RESPONSE_ERROR", "agent": "PatientProfilerAgent", "message": err_msg}, RunEvent.workflow_completed
-
-            if patient_profile_response_obj.status == "success" and patient_profile_response_obj.profile:
-                profile_data = patient_profile_response_obj.profile
-            elif patient_profile_response_obj.status == "not_found":
-                logger.warning(f"Patient {patient_id} not found by agent.")
-                return {"error_type": "PATIENT_NOT_FOUND", "message": patient_profile_response_obj.message or f"Patient {patient_id} not found."}, RunEvent.workflow_completed
-            else: # Error
-                err_msg = patient_profile_response_obj.message or patient_profile_response_obj.error or "Agent failed to fetch profile."
-                logger.error(f"Error from PatientProfilerAgent for {patient_id}: {err_msg}")
-                return {"error_type": "ERROR_FETCHING_PATIENT", "message": err_msg}, RunEvent.workflow_completed
-
-        if not profile_data:
-            return {"error_type": "INTERNAL_ERROR", "message": "Patient profile became unavailable after agent fetch."}, RunEvent.workflow_completed
-
-        # 2. Discover Trials using Agent
-        logger.info(f"Step 2: Discovering trials for patient {patient_id} using Agent")
-        discovered_trials_list: Optional[List[TrialData]] = None 
-        discoverer_response_obj: Optional[DiscoveredTrialsResponse] = None
-
-        if use_cache:
-            cached_trials_dict = await self._get_cached_data("discovered_trials_agent_response", patient_id)
-            if cached_trials_dict:
-                try:
-                    discoverer_response_obj = DiscoveredTrialsResponse(**cached_trials_dict)
-                    if discoverer_response_obj.status == "success" and discoverer_response_obj.trials is not None:
-                        # Ensure that cached trials are TrialData instances
-                        if all(isinstance(t, TrialData) for t in discoverer_response_obj.trials):
-                            discovered_trials_list = discoverer_response_obj.trials
-                        elif all(isinstance(t, dict) for t in discoverer_response_obj.trials):
-                            logger.info("Cached trials are dicts, converting to TrialData instances.")
-                            discovered_trials_list = [TrialData(**t) for t in discoverer_response_obj.trials]
-                        else:
-                            logger.warning("Cached trials are of mixed or unexpected types. Will refetch.")
-                            discovered_trials_list = None # Force refetch
-                except Exception as e:
-                    logger.warning(f"Could not validate cached discovered trials: {e}. Will refetch.")
-                    discovered_trials_list = None # Force refetch
-        
-        if discovered_trials_list is None: # If not found in cache or cache was invalid
-            logger.info(f"Cache miss or invalid for discovered_trials_agent_response. Fetching from agent for patient {patient_id}.")
-            profile_dict_for_agent = profile_data.model_dump() if hasattr(profile_data, 'model_dump') else profile_data
-            agent_input_args_obj = {"patient_profile": profile_dict_for_agent}
-            discoverer_input_json = json.dumps(agent_input_args_obj)
-            logger.debug(f"Passing to TrialDiscovererAgent.arun(): {discoverer_input_json}")
-            
-            try:
-                discoverer_agent_response = await self.trial_discoverer_agent.arun(discoverer_input_json)
-            except Exception as e:
-                logger.error(f"Exception directly from TrialDiscovererAgent.arun(): {e}", exc_info=True)
-                return {"error_type": "AGENT_RUN_EXCEPTION", "agent": "TrialDiscovererAgent", "message": str(e)}, RunEvent.workflow_completed
-
-            # ---- START CRITICAL LOGS for debussing infinite loop issue (finally found forced tool use in the agent was the problem)----
-            if not discoverer_agent_response:
-                logger.debug("TrialDiscovererAgent.arun() returned a None response.")
-                return {"error_type": "AGENT_EMPTY_RESPONSE", "agent": "TrialDiscovererAgent", "message": "Agent returned None"}, RunEvent.workflow_completed
-
-            logger.debug(f"TrialDiscovererAgent - Raw RunResponse.content: {str(discoverer_agent_response.content)[:1000]}")
-            if hasattr(discoverer_agent_response.content, 'model_dump_json') and discoverer_agent_response.content is not None : # check for None
-                logger.debug(f"TrialDiscovererAgent - Content (as Pydantic model): {discoverer_agent_response.content.model_dump_json(indent=2)}")
-            
-            if discoverer_agent_response.tools:
-                logger.debug(f"TrialDiscovererAgent - Number of tool executions recorded: {len(discoverer_agent_response.tools)}")
-                for i, tool_execution in enumerate(discoverer_agent_response.tools):
-                    tool_result_str = str(tool_execution.result)
-                    logger.debug(
-                        f"TrialDiscovererAgent - Recorded ToolExecution {i}: "
-                        f"Name='{tool_execution.tool_name}', "
-                        f"Args='{tool_execution.tool_args}', "
-                        f"Result (first 1000 chars)='{tool_result_str[:1000]}', "
-                        f"Error='{tool_execution.tool_call_error}'"
-                    )
-                    if tool_execution.tool_name == "_discover_trials_tool" and tool_execution.result:
-                         logger.debug(f"FULL _discover_trials_tool RAW Result from ToolExecution.result: {tool_execution.result}")
-            else:
-                logger.warning("TrialDiscovererAgent - No tool executions recorded in RunResponse.tools (after agent.arun)")
-
-            if discoverer_agent_response.thinking:
-                 logger.debug(f"TrialDiscovererAgent - Thinking: {discoverer_agent_response.thinking}")
-            # ---- END CRITICAL LOGS ----
-
-            # Process the response from the agent
-            if isinstance(discoverer_agent_response.content, str):
-                raw_json_from_agent = discoverer_agent_response.content
-                logger.info(f"TrialDiscovererAgent returned raw string: {raw_json_from_agent}")
-                try:
-                    tool_output_dict = json.loads(raw_json_from_agent)
-                    if tool_output_dict.get("status") == "success":
-                        trials_from_tool_dict = tool_output_dict.get("trials", [])
-                        parsed_trials = [TrialData(**trial_dict) for trial_dict in trials_from_tool_dict]
-                        discoverer_response_obj = DiscoveredTrialsResponse(status="success", trials=parsed_trials)
-                    else:
-                        discoverer_response_obj = DiscoveredTrialsResponse(
-                            status=tool_output_dict.get("status", "error"), 
-                            error=tool_output_dict.get("error", "Unknown error from tool output string"),
-                            message=tool_output_dict.get("message")
-                        )
-                    if use_cache:
-                        await self._add_cached_data("discovered_trials_agent_response", patient_id, discoverer_response_obj)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse JSON string from TrialDiscovererAgent: {e}. String was: {raw_json_from_agent}")
-                    return {"error_type": "AGENT_BAD_JSON_STRING", "agent": "TrialDiscovererAgent", "message": "Agent returned unparsable JSON string."}, RunEvent.workflow_completed
-            
-            # This case should ideally not be hit if response_model is None and structured_outputs is False
-            elif isinstance(discoverer_agent_response.content, DiscoveredTrialsResponse):
-                logger.info("TrialDiscovererAgent returned a DiscoveredTrialsResponse Pydantic model directly.")
-                discoverer_response_obj = discoverer_agent_response.content
-                if use_cache:
-                    await self._add_cached_data("discovered_trials_agent_response", patient_id, discoverer_response_obj)
-            else:
-                err_msg = f"TrialDiscovererAgent returned unexpected content type: {type(discoverer_agent_response.content)}. Content: {str(discoverer_agent_response.content)[:500]}"
-                logger.error(err_msg)              
-                return {"error_type": "AGENT_UNEXPECTED_RESPONSE_TYPE", "agent": "TrialDiscovererAgent", "message": err_msg}, RunEvent.workflow_completed
-            
-            # Populate discovered_trials_list from the processed discoverer_response_obj
-            if discoverer_response_obj and discoverer_response_obj.status == "success":
-                discovered_trials_list = discoverer_response_obj.trials or []
-            elif discoverer_response_obj: # Error or other non-success status from agent/tool
-                err_msg = discoverer_response_obj.message or discoverer_response_obj.error or "Agent/tool failed to discover trials."
-                logger.error(f"Error from TrialDiscovererAgent or tool processing for {patient_id}: {err_msg}")
-                return {"error_type": "ERROR_DISCOVERING_TRIALS", "message": err_msg}, RunEvent.workflow_completed
-            else: # discoverer_response_obj is None, meaning some path above didn't populate it.
-                logger.error("discoverer_response_obj is None after agent call and processing. This should not happen.")
-                return {"error_type": "INTERNAL_WORKFLOW_ERROR", "message": "Failed to get response object from discoverer agent."}, RunEvent.workflow_completed
-
-        # After cache or agent call, check discovered_trials_list
-        if discovered_trials_list is None : # Should be an empty list if no trials, not None
-             logger.error("discovered_trials_list is still None after cache and agent logic. This indicates a flaw in population.")
-             #This means it didn't go into the "if discovered_trials_list is None:" block above, or failed within.
-             #It might also mean an error occurred within that block before discoverer_response_obj was processed.
-             return {"error_type": "INTERNAL_WORKFLOW_ERROR", "message": "Trial list not populated."}, RunEvent.workflow_completed
-
-        if not discovered_trials_list: # Handles empty list: no trials found
-            logger.info(f"No trials found by agent for patient {patient_id}.")
-            if use_cache and not await self._get_cached_data("final_matches", patient_id): # Avoid re-caching empty if already cached
-                await self._add_cached_data("final_matches", patient_id, [])
-            return [], RunEvent.workflow_completed
-        
-        # Log before Step 3
-        logger.info(f"Data prepared for TrialAnalyzerAgent. Number of trials in discovered_trials_list: {len(discovered_trials_list)}")
-        for i, trial_item_for_analyzer in enumerate(discovered_trials_list):
-            if hasattr(trial_item_for_analyzer, 'model_dump_json'):
-                logger.debug(f"Trial {i} for Analyzer: {trial_item_for_analyzer.model_dump_json(indent=2)}")
-            else: 
-                 logger.debug(f"Trial {i} for Analyzer (raw dict, unexpected): {json.dumps(trial_item_for_analyzer, indent=2)}")
-        # 3. Analyze Each Trial using Agent
-        logger.info(f"Step 3: Analyzing {len(discovered_trials_list)} discovered trials for {patient_id} using Agent")
-        potential_matches_models: List[TrialMatch] = []
-
-        for trial_data in discovered_trials_list: # trial_data is a TrialData model
-            trial_id = trial_data.id
-            logger.debug(f"Analyzing trial {trial_id} using Agent...")            
-            profile_dict = profile_data.model_dump() if hasattr(profile_data, 'model_dump') else profile_data
-            # Convert trial Pydantic model to dict for analysis
-            trial_dict = trial_data.model_dump()
-            analyzer_input = {"patient_profile": profile_dict, "trial": trial_dict}
-            analyzer_input_json = json.dumps(analyzer_input)
-            logger.debug(f"Analyzing trial {trial_id} with input: {analyzer_input_json}")
-            analyzer_agent_response: RunResponse = await self.trial_analyzer_agent.arun(analyzer_input_json)
-
-            if analyzer_agent_response and isinstance(analyzer_agent_response.content, TrialAnalysisResponse):
-                analysis_result_obj = analyzer_agent_response.content
-
-                if analysis_result_obj.status == "success" and analysis_result_obj.match_data:
-                    logger.info(f"Potential match from Agent: Trial {trial_id} for patient {patient_id}")
-                    # match_data should be a TrialMatch object because TrialAnalysisResponse has match_data: Optional[TrialMatch]
-                    potential_matches_models.append(analysis_result_obj.match_data)
-                elif analysis_result_obj.status == "error":
-                    logger.warning(f"Error from TrialAnalyzerAgent for trial {trial_id}: {analysis_result_obj.message or analysis_result_obj.reason}")
-                else: # no_match or other
-                    logger.debug(f"No match from Agent for trial {trial_id}: {analysis_result_obj.reason}")
-            else:
-                logger.error(f"Trial Analyzer Agent for trial {trial_id} did not return valid TrialAnalysisResponse. Content: {analyzer_agent_response.content if analyzer_agent_response else 'None'}")
-
-        # 4. Compile Final Results
-        logger.info(f"Step 4: Compiling final results. Found {len(potential_matches_models)} potential matches from agent analyses.")
-        # Convert list of TrialMatch Pydantic models to list of dictionaries
-        final_match_list_dicts = [match.model_dump() for match in potential_matches_models]
-
-        if use_cache:
-            await self._add_cached_data("final_matches", patient_id, final_match_list_dicts)
-
-        return final_match_list_dicts, RunEvent.workflow_completed
+
+async def _degraded_trial_matches(patient_id: str, limit: int) -> Dict[str, Any]:
+    """Serve matches without the LLM: stored analyses first, structured criteria for the rest."""
+    mark_stage("degraded")
+    profile = patient_index.get(patient_id)
+    if profile is None:
+        return {"error_type": "PATIENT_NOT_FOUND", "message": f"Patient ID {patient_id} not found."}
+    stored = {row["trialId"]: row for row in await asyncio.to_thread(
+        match_store.latest_for_patient, patient_id, None, 1000, False)}
+    ranker = TopKRanker(limit)
+    for trial in trial_catalogue.search(profile["condition"]):
+        row = stored.get(trial.id)
+        if row is not None:
+            if row["match"]:
+                ranker.push(TrialMatch.model_validate(row["match"]))
+            continue  # Stored non-matches stay excluded
+        match = _structured_match(profile, trial)
+        if match is not None:
+            ranker.push(match)
+    logger.warning(f"Served degraded results for patient {patient_id}: {len(ranker.results())} matches "
+                   f"from {len(stored)} stored analyses and structured criteria")
+    metrics.inc("degraded_responses_total")
+    return {"status": "degraded", "matches": ranker.results(),
+            "message": "The LLM backend is unavailable; results come from earlier analyses and structured criteria only."}
 
 
 # --- Main async function to run the workflow (called by API endpoint) ---
-async def run_trial_matching_workflow(patient_id: str, use_cache: bool = True) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+async def run_trial_matching_workflow(patient_id: str, use_cache: bool = True, limit: int = RANKING_DEFAULT_LIMIT,
+                                      account: Optional[RequestAccount] = None) -> Union[List[TrialMatch], Dict[str, Any]]:
+    """Run the matching workflow; returns at most `limit` matches, best first, or an error_type dict.
+
+    While the LLM circuit is open this returns {"status": "degraded", "matches": [...], "message": ...}
+    built without any LLM calls. LLM usage, cost and stage timings are collected into
+    `account` (a fresh one if not given), logged and added to the search metrics.
+    """
+    account = account or RequestAccount()
+    account.patient_id = patient_id
+    with track(account):
+        return await _run_trial_matching_workflow(patient_id, use_cache, limit)
+
+
+async def _run_trial_matching_workflow(patient_id: str, use_cache: bool, limit: int) -> Union[List[TrialMatch], Dict[str, Any]]:
+    from workflow import RunEvent
     logger.info(f"run_trial_matching_workflow (async orchestrator with Agents) for patient: {patient_id}")
 
-    workflow_session_id = f"direct_workflow_agents_for_{patient_id}"
-    trial_matcher_workflow = ClinicalTrialMatchingWorkflow(
-        session_id=workflow_session_id,
-        debug_mode=os.getenv("DEBUG_MODE", "false").lower() == "true"
-    )
+    if llm_breaker.is_open:
+        return await _degraded_trial_matches(patient_id, limit)
+
+    run_context = MatchingRunContext(patient_id=patient_id, use_cache=use_cache, limit=limit)
 
-    final_output: Union[List[Dict[str, Any]], Dict[str, Any]]
+    final_output: Union[List[TrialMatch], Dict[str, Any]]
 
     try:
-        content, event = await trial_matcher_workflow._arun_steps(
-            patient_id=patient_id,
-            use_cache=use_cache
-        )
+        with workflow_pool.lease() as trial_matcher_workflow:
+            content, event = await trial_matcher_workflow._arun_steps(run_context)
         final_output = content 
 
         if event == RunEvent.workflow_completed:
@@ -642,28 +954,8 @@ async def run_trial_matching_workflow(patient_id: str, use_cache: bool = True) -
         logger.error(f"Exception during agent-based workflow execution for {patient_id}: {e}", exc_info=True)
         final_output = {"error_type": "WORKFLOW_AGENT_UNHANDLED_EXCEPTION", "message": str(e)}
 
+    # The breaker may have opened during this run; degrade rather than fail the request
+    if isinstance(final_output, dict) and "error_type" in final_output and final_output["error_type"] != "PATIENT_NOT_FOUND" \
+            and llm_breaker.state != "closed":
+        return await _degraded_trial_matches(patient_id, limit)
     return final_output
-
-
-# --- Example Usage 3062603---
-async def main():
-    test_patient_ids = ["PATIENT_001", "PATIENT_002", "PATIENT_NO_MATCH", "PATIENT_ERROR"]
-    # test_patient_ids = ["PATIENT_001"]
-
-    for p_id in test_patient_ids:
-        print(f"\n--- Running agent-based workflow for Patient ID: {p_id} ---")
-        result = await run_trial_matching_workflow(p_id, use_cache=True)
-        print(f"Result for {p_id} (1st run): {json.dumps(result, indent=2)}")
-
-        print(f"\n--- Running agent-based workflow for Patient ID: {p_id} (AGAIN to test cache) ---")
-        result_cached = await run_trial_matching_workflow(p_id, use_cache=True)
-        print(f"Result for {p_id} (2nd run): {json.dumps(result_cached, indent=2)}")
-
-        if p_id == "PATIENT_001":
-            print(f"\n--- Running agent-based workflow for Patient ID: {p_id} (NO CACHE) ---")
-            result_no_cache = await run_trial_matching_workflow(p_id, use_cache=False)
-            print(f"Result for {p_id} (no cache run): {json.dumps(result_no_cache, indent=2)}")
-
-
-if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
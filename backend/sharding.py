@@ -0,0 +1,66 @@
+import bisect
+import hashlib
+import os
+from typing import Dict, List, Optional, Tuple
+
+from logger import setup_logger
+
+logger = setup_logger("trial_matcher.sharding", log_level=os.getenv("LOG_LEVEL", "INFO"), log_file="logs/sharding.log")
+
+# Comma-separated name=url pairs, e.g. "shard-0=http://127.0.0.1:8101,shard-1=http://127.0.0.1:8102".
+# Empty means unsharded: this process holds the whole population.
+SHARD_NODES = os.getenv("SHARD_NODES", "")
+# Name of this node in SHARD_NODES; set on shard nodes, unset on the coordinator
+SHARD_ID = os.getenv("SHARD_ID", "")
+SHARD_VIRTUAL_NODES = int(os.getenv("SHARD_VIRTUAL_NODES", "256"))
+
+
+def parse_shard_nodes(spec: str) -> Dict[str, str]:
+    """Parse SHARD_NODES into {name: base url}.
+
+    Raises:
+        ValueError: if an entry is not name=url.
+    """
+    nodes: Dict[str, str] = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, sep, url = entry.partition("=")
+        if not sep or not name.strip() or not url.strip():
+            raise ValueError(f"Invalid SHARD_NODES entry {entry!r}; expected name=url")
+        nodes[name.strip()] = url.strip().rstrip("/")
+    return nodes
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring over node names.
+
+    Each node is placed at `virtual_nodes` points, so keys spread evenly and adding
+    or removing a node only moves the keys on its arcs (about 1/N of them).
+    """
+
+    def __init__(self, nodes: List[str], virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        self.nodes = sorted(set(nodes))
+        self._points: List[Tuple[int, str]] = sorted(
+            (_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in self._points]
+
+    def node_for(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+        position = bisect.bisect(self._hashes, _hash(key)) % len(self._points)
+        return self._points[position][1]
+
+
+shard_nodes = parse_shard_nodes(SHARD_NODES)
+shard_ring = HashRing(list(shard_nodes))
+if SHARD_ID and SHARD_ID not in shard_nodes:
+    raise ValueError(f"SHARD_ID {SHARD_ID!r} is not listed in SHARD_NODES")
+
+
+def owns_patient(patient_id: str) -> bool:
+    """True if this process should hold `patient_id`: always, unless it is a shard node."""
+    return not SHARD_ID or shard_ring.node_for(patient_id) == SHARD_ID
@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# Importing services opens the SQLite stores; keep the suite's out of backend/data
+_STORE_DIR = tempfile.mkdtemp(prefix="trial_matcher_tests_")
+for _name, _file in (("MATCH_STORE_PATH", "match_store.db"), ("JOB_QUEUE_PATH", "jobs.db"),
+                     ("ANALYSIS_CACHE_PATH", "analysis_cache.db")):
+    os.environ.setdefault(_name, os.path.join(_STORE_DIR, _file))
+os.environ.setdefault("SIMULATED_IO_MODE", "off")
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+os.environ.setdefault("PROFILING_ENABLED", "false")
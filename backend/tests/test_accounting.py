@@ -0,0 +1,92 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+
+import services
+from accounting import RequestAccount, current_account, mark_stage, record_event, record_llm_call, track
+from metrics import metrics
+from models import SearchDiagnostics
+
+
+def _summary_count(name: str, labels: str = "") -> int:
+    return metrics.snapshot()["summaries"].get(name, {}).get(labels, {}).get("count", 0)
+
+
+class RequestAccountTest(unittest.TestCase):
+    def test_records_are_no_ops_outside_a_tracked_run(self):
+        self.assertIsNone(current_account())
+        record_llm_call("analysis:strong", 100, 10)
+        record_event("structured_prunes")
+        mark_stage("analysis")
+        self.assertIsNone(current_account())
+
+    def test_usage_adds_up_per_source_and_in_total(self):
+        with track(RequestAccount(patient_id="P1")) as account:
+            record_llm_call("analysis:strong", 100, 20, cached_prompt_tokens=64, cost_usd=0.002)
+            record_llm_call("analysis:strong", 50, 10, cost_usd=0.001)
+            record_llm_call("agent:TrialAnalyzerAgent", 300, 40, cost_usd=0.004, calls=2)
+        self.assertIsNone(current_account())
+        self.assertEqual((account.llm["analysis:strong"].calls, account.llm["analysis:strong"].prompt_tokens), (2, 150))
+        total = account.totals()
+        self.assertEqual((total.calls, total.prompt_tokens, total.completion_tokens, total.cached_prompt_tokens),
+                         (4, 450, 70, 64))
+        self.assertAlmostEqual(total.cost_usd, 0.007)
+
+    def test_tasks_spawned_during_the_run_share_the_account(self):
+        async def analyze():
+            await asyncio.sleep(0)
+            record_llm_call("analysis:screen", 10, 1)
+            record_event("analysis_cache_hits")
+
+        async def run():
+            with track(RequestAccount()) as account:
+                await asyncio.gather(*(asyncio.create_task(analyze()) for _ in range(3)))
+            return account
+
+        account = asyncio.run(run())
+        self.assertEqual(account.llm["analysis:screen"].calls, 3)
+        self.assertEqual(account.events, {"analysis_cache_hits": 3})
+
+    def test_stages_accumulate_and_close_with_the_run(self):
+        with track(RequestAccount()) as account:
+            mark_stage("profile")
+            time.sleep(0.01)
+            mark_stage("analysis")
+            time.sleep(0.01)
+            mark_stage("profile")
+        self.assertEqual(set(account.stage_seconds), {"profile", "analysis"})
+        self.assertGreaterEqual(account.stage_seconds["analysis"], 0.01)
+        self.assertGreaterEqual(account.total_seconds, sum(account.stage_seconds.values()))
+
+    def test_close_reports_the_run_to_metrics_once(self):
+        before = _summary_count("search_llm_calls")
+        account = RequestAccount()
+        with track(account):
+            record_llm_call("analysis:strong", 1, 1)
+        account.close()
+        self.assertEqual(_summary_count("search_llm_calls"), before + 1)
+
+    def test_diagnostics_fit_the_response_model(self):
+        with track(RequestAccount()) as account:
+            record_llm_call("analysis:strong", 100, 20, cost_usd=0.0021234567)
+            record_event("structured_prunes", 2)
+            mark_stage("analysis")
+        diagnostics = SearchDiagnostics(**account.to_diagnostics())
+        self.assertEqual((diagnostics.llmCalls, diagnostics.promptTokens, diagnostics.structuredPrunes), (1, 100, 2))
+        self.assertEqual(diagnostics.costUsd, 0.002123)
+        self.assertEqual(diagnostics.bySource["analysis:strong"].completionTokens, 20)
+        self.assertIn("analysis", diagnostics.stageSeconds)
+
+    def test_agent_runs_are_accounted_per_model_response(self):
+        response = SimpleNamespace(metrics={"input_tokens": [100, 200], "output_tokens": [10, 30], "cached_tokens": [0, 64]})
+        with track(RequestAccount()) as account:
+            services._record_agent_run("TrialAnalyzerAgent", response)
+            services._record_agent_run("TrialAnalyzerAgent", SimpleNamespace(metrics={}))
+        usage = account.llm["agent:TrialAnalyzerAgent"]
+        self.assertEqual((usage.calls, usage.prompt_tokens, usage.completion_tokens, usage.cached_prompt_tokens),
+                         (2, 300, 40, 64))
+
+
+if __name__ == "__main__":
+    unittest.main()
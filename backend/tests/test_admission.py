@@ -0,0 +1,77 @@
+import asyncio
+import unittest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def test_queued_clinicians_are_served_round_robin(self):
+        async def run():
+            controller = AdmissionController(max_in_flight=1, max_queue=10, max_queued_per_clinician=10, queue_timeout=5)
+            order = []
+
+            async def request(clinician_id, label):
+                async with controller.slot(clinician_id):
+                    order.append(label)
+                    await asyncio.sleep(0)
+
+            async with controller.slot("busy"):
+                tasks = [asyncio.create_task(request("A", f"A{i}")) for i in range(3)]
+                await asyncio.sleep(0)
+                tasks.append(asyncio.create_task(request("B", "B0")))
+                await asyncio.sleep(0)
+                self.assertEqual(controller.queued, 4)
+            await asyncio.gather(*tasks)
+            return order, controller
+
+        order, controller = asyncio.run(run())
+        # A burst from clinician A does not make B wait behind all of it
+        self.assertEqual(order, ["A0", "B0", "A1", "A2"])
+        self.assertEqual((controller.in_flight, controller.queued, controller.admitted), (0, 0, 5))
+
+    def test_sheds_when_queues_are_full_or_wait_times_out(self):
+        async def run():
+            controller = AdmissionController(max_in_flight=1, max_queue=3, max_queued_per_clinician=1, queue_timeout=0.05)
+            outcomes = {}
+
+            async def attempt(name, clinician_id):
+                try:
+                    async with controller.slot(clinician_id):
+                        outcomes[name] = "admitted"
+                except AdmissionRejected as e:
+                    outcomes[name] = (e.reason, e.retry_after >= 1)
+
+            async with controller.slot("busy"):
+                waiting = [asyncio.create_task(attempt("A0", "A")), asyncio.create_task(attempt("B0", "B"))]
+                await asyncio.sleep(0)
+                await attempt("A1", "A")
+                waiting.append(asyncio.create_task(attempt("C0", "C")))
+                await asyncio.sleep(0)
+                await attempt("D0", "D")
+                await asyncio.gather(*waiting)
+            return outcomes, controller
+
+        outcomes, controller = asyncio.run(run())
+        self.assertEqual(outcomes["A1"], ("clinician_queue_full", True))
+        self.assertEqual(outcomes["D0"], ("queue_full", True))
+        for name in ("A0", "B0", "C0"):
+            self.assertEqual(outcomes[name], ("queue_timeout", True))
+        self.assertEqual(controller.rejected, {"clinician_queue_full": 1, "queue_full": 1, "queue_timeout": 3})
+        self.assertEqual((controller.in_flight, controller.queued), (0, 0))
+
+    def test_cancelled_waiter_leaves_the_queue(self):
+        async def run():
+            controller = AdmissionController(max_in_flight=1, queue_timeout=5)
+            async with controller.slot("busy"):
+                task = asyncio.create_task(controller.slot("A").__aenter__())
+                await asyncio.sleep(0)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                queued = controller.queued
+            return queued, controller.in_flight
+
+        self.assertEqual(asyncio.run(run()), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from analysis_cache import AnalysisCache, SqliteAnalysisCache
+
+
+class _ClaimContract:
+    """Claim behaviour every backend must share."""
+
+    def make_cache(self) -> AnalysisCache:
+        raise NotImplementedError
+
+    def test_one_holder_at_a_time(self):
+        cache = self.make_cache()
+        token = cache.claim("k")
+        self.assertTrue(token)
+        self.assertIsNone(cache.claim("k"))
+        self.assertTrue(cache.is_claimed("k"))
+        cache.release("k", token)
+        self.assertFalse(cache.is_claimed("k"))
+        self.assertTrue(cache.claim("k"))
+
+    def test_stale_holder_cannot_release_new_claim(self):
+        cache = self.make_cache()
+        stale = cache.claim("k", lease_seconds=0.01)
+        time.sleep(0.02)
+        current = cache.claim("k")
+        self.assertTrue(current)
+        cache.release("k", stale)
+        self.assertTrue(cache.is_claimed("k"))
+        cache.release("k", current)
+        self.assertFalse(cache.is_claimed("k"))
+
+    def test_async_round_trip(self):
+        cache = self.make_cache()
+
+        async def run():
+            token = await cache.aclaim("k")
+            await cache.aset("k", {"status": "no_match"})
+            await cache.arelease("k", token)
+            return await cache.aget("k"), await cache.ais_claimed("k")
+
+        self.assertEqual(asyncio.run(run()), ({"status": "no_match"}, False))
+
+
+class MemoryAnalysisCacheTest(_ClaimContract, unittest.TestCase):
+    def make_cache(self) -> AnalysisCache:
+        return AnalysisCache()
+
+
+class SqliteAnalysisCacheTest(_ClaimContract, unittest.TestCase):
+    def make_cache(self) -> AnalysisCache:
+        directory = tempfile.mkdtemp(prefix="analysis_cache_test_")
+        cache = SqliteAnalysisCache(path=os.path.join(directory, "cache.db"))
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_async_calls_leave_the_event_loop_thread(self):
+        cache = self.make_cache()
+        with mock.patch.object(cache, "get", lambda key: threading.get_ident()):
+            async def run():
+                return threading.get_ident(), await cache.aget("k")
+            loop_thread, call_thread = asyncio.run(run())
+        self.assertNotEqual(loop_thread, call_thread)
+
+
+if __name__ == "__main__":
+    unittest.main()
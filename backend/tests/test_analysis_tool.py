@@ -0,0 +1,37 @@
+import asyncio
+import contextlib
+import unittest
+from unittest import mock
+
+import services
+from analysis_cache import AnalysisCache
+
+_PAIR = dict(patient_id="P1", patient_condition="Non-Small Cell Lung Cancer", patient_age=60,
+             trial_id="NCT_UNKNOWN", trial_title="Lung Trial", trial_condition="Non-Small Cell Lung Cancer",
+             trial_phase="3", trial_status="Recruiting", patient_notes="ECOG 1")
+
+
+class AnalysisToolClaimTest(unittest.TestCase):
+    def _analyze(self, cache: AnalysisCache, pair: dict = _PAIR, **patches):
+        with mock.patch.object(services, "analysis_cache", cache), \
+                (mock.patch.multiple(services, **patches) if patches else contextlib.nullcontext()):
+            return asyncio.run(services._analyze_trial_match_tool(**pair))
+
+    def test_failure_before_llm_call_releases_claim(self):
+        cache = AnalysisCache()
+        for name in ("extract_structured_criteria", "evaluate_structured_criteria", "build_analysis_prompt"):
+            with self.subTest(failing=name):
+                result = self._analyze(cache, **{name: mock.Mock(side_effect=RuntimeError("boom"))})
+                self.assertEqual(result["status"], "error")
+                self.assertFalse(any(cache.is_claimed(key) for key in list(cache._claims)))
+
+    def test_structured_prune_is_cached_and_released(self):
+        cache = AnalysisCache()
+        result = self._analyze(cache, {**_PAIR, "trial_min_age": 70})
+        self.assertEqual(result["status"], "no_match")
+        self.assertEqual(len(cache), 1)
+        self.assertFalse(any(cache.is_claimed(key) for key in list(cache._claims)))
+
+
+if __name__ == "__main__":
+    unittest.main()
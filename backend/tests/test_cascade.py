@@ -0,0 +1,46 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+import services
+from analysis_cache import AnalysisCache
+
+_PAIR = dict(patient_id="P1", patient_condition="Non-Small Cell Lung Cancer", patient_age=60,
+             trial_id="NCT_CASCADE", trial_title="Lung Trial", trial_condition="Non-Small Cell Lung Cancer",
+             trial_phase="3", trial_status="Recruiting", trial_inclusions=["Measurable disease"])
+_STRONG = json.dumps({"decision": "Potential Match", "reasoning_steps": ["checked"], "match_rationale": ["fits"], "flags": []})
+_SCREEN_NO = json.dumps({"decision": "Likely Not a Match", "reasoning_steps": [], "match_rationale": [], "flags": ["no"]})
+
+
+class CascadeTest(unittest.TestCase):
+    def _run(self, screen_output):
+        tiers = []
+
+        async def complete(messages, tier):
+            tiers.append(tier)
+            return screen_output if tier == "screen" else _STRONG
+
+        with mock.patch.object(services, "ANALYSIS_CASCADE_ENABLED", True), \
+                mock.patch.object(services, "analysis_cache", AnalysisCache()), \
+                mock.patch.object(services, "_complete_analysis", complete):
+            result = asyncio.run(services._analyze_trial_match_tool(**_PAIR))
+        return tiers, result
+
+    def test_unusable_screen_output_escalates(self):
+        for name, output in (("empty", ""), ("none", None), ("prose", "I cannot decide."),
+                             ("wrong schema", '{"verdict": "yes"}'), ("truncated", _SCREEN_NO[:25])):
+            with self.subTest(name):
+                tiers, result = self._run(output)
+                self.assertEqual(tiers, ["screen", "strong"])
+                self.assertEqual(result["status"], "success")
+                self.assertNotIn(services.REPAIRED_OUTPUT_FLAG, result["match_data"].flags)
+
+    def test_clean_negative_screen_stops(self):
+        tiers, result = self._run(_SCREEN_NO)
+        self.assertEqual(tiers, ["screen"])
+        self.assertEqual(result["status"], "no_match")
+
+
+if __name__ == "__main__":
+    unittest.main()
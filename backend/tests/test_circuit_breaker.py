@@ -0,0 +1,167 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, GuardedClient
+
+
+async def _ok():
+    return "ok"
+
+
+async def _fail():
+    raise RuntimeError("backend down")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def _breaker(self, **overrides):
+        options = dict(window=4, min_calls=4, failure_rate=0.5, slow_call_seconds=60, call_timeout=5, open_seconds=30)
+        options.update(overrides)
+        return CircuitBreaker("test", **options)
+
+    def _run(self, breaker, *calls):
+        async def run():
+            outcomes = []
+            for fn in calls:
+                try:
+                    outcomes.append(await breaker.call(fn()))
+                except CircuitOpenError:
+                    outcomes.append("rejected")
+                except RuntimeError:
+                    outcomes.append("failed")
+            return outcomes
+        return asyncio.run(run())
+
+    def _elapse_open_period(self, breaker):
+        breaker._opened_at -= breaker.open_seconds
+
+    def test_opens_once_min_calls_reach_the_failure_rate(self):
+        breaker = self._breaker()
+        self._run(breaker, _fail, _ok, _fail)
+        self.assertEqual(breaker.state, CLOSED)  # 2 of 3 failed, but fewer than min_calls
+        self._run(breaker, _ok)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.times_opened, 1)
+
+    def test_stays_closed_below_the_failure_rate(self):
+        breaker = self._breaker()
+        self._run(breaker, _fail, _ok, _ok, _ok, _ok)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_open_breaker_rejects_without_running_the_call(self):
+        breaker = self._breaker()
+        self._run(breaker, _fail, _fail, _fail, _fail)
+        ran = []
+
+        async def tracked():
+            ran.append(True)
+            return "ok"
+
+        self.assertEqual(self._run(breaker, tracked), ["rejected"])
+        self.assertEqual(ran, [])
+        self.assertEqual(breaker.rejected, 1)
+
+    def test_half_open_probe_success_closes(self):
+        breaker = self._breaker()
+        self._run(breaker, _fail, _fail, _fail, _fail)
+        self._elapse_open_period(breaker)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertEqual(self._run(breaker, _ok), ["ok"])
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.stats()["windowCalls"], 0)
+
+    def test_half_open_probe_failure_reopens(self):
+        breaker = self._breaker()
+        self._run(breaker, _fail, _fail, _fail, _fail)
+        self._elapse_open_period(breaker)
+        self.assertEqual(self._run(breaker, _fail, _ok), ["failed", "rejected"])
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.times_opened, 2)
+
+    def test_half_open_admits_only_the_configured_probes(self):
+        breaker = self._breaker(half_open_probes=1)
+        self._run(breaker, _fail, _fail, _fail, _fail)
+        self._elapse_open_period(breaker)
+
+        async def run():
+            release = asyncio.Event()
+
+            async def slow_probe():
+                await release.wait()
+                return "ok"
+
+            probe = asyncio.create_task(breaker.call(slow_probe()))
+            await asyncio.sleep(0)
+            with self.assertRaises(CircuitOpenError):
+                await breaker.call(_ok())
+            release.set()
+            return await probe
+
+        self.assertEqual(asyncio.run(run()), "ok")
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_slow_successes_count_as_failures(self):
+        breaker = self._breaker(slow_call_seconds=0)
+        self.assertEqual(self._run(breaker, _ok, _ok, _ok, _ok), ["ok"] * 4)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_nested_results_are_ignored_while_half_open(self):
+        breaker = self._breaker()
+        self._run(breaker, _fail, _fail, _fail, _fail)
+        self._elapse_open_period(breaker)
+
+        async def probe_with_failing_nested_call():
+            try:
+                await breaker.call(_fail())
+            except RuntimeError:
+                pass
+            return "ok"
+
+        self.assertEqual(self._run(breaker, probe_with_failing_nested_call), ["ok"])
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.times_opened, 1)
+
+
+class GuardedClientTest(unittest.TestCase):
+    def test_slow_multi_step_agent_run_does_not_open_the_breaker(self):
+        breaker = CircuitBreaker("test", window=4, min_calls=2, failure_rate=0.5, slow_call_seconds=0.05, call_timeout=5)
+        completions = []
+
+        async def create(**kwargs):
+            completions.append(kwargs)
+            return "completion"
+
+        client = GuardedClient(SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)),
+                                               beta=SimpleNamespace(chat=SimpleNamespace(completions=None))), breaker)
+
+        async def agent_run():
+            # Model call, tool call, model call...: the run takes far longer than one slow call
+            for _ in range(4):
+                await client.chat.completions.create(model="m", messages=[])
+                await asyncio.sleep(0.03)
+
+        started = time.monotonic()
+        asyncio.run(agent_run())
+        self.assertGreater(time.monotonic() - started, breaker.slow_call_seconds)
+        self.assertEqual(len(completions), 4)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual((breaker.stats()["windowCalls"], breaker.stats()["windowFailures"]), (4, 0))
+
+    def test_open_breaker_surfaces_through_an_agent_run(self):
+        from agno.exceptions import ModelProviderError
+        from workflow import _run_agent
+
+        async def agent_run():
+            try:
+                raise CircuitOpenError("Circuit llm is open")
+            except CircuitOpenError as e:
+                # agno wraps model client errors like this
+                raise ModelProviderError(message=str(e), model_name="AzureOpenAI", model_id="m") from e
+
+        with self.assertRaises(CircuitOpenError):
+            asyncio.run(_run_agent(agent_run()))
+
+
+if __name__ == "__main__":
+    unittest.main()
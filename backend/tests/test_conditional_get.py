@@ -0,0 +1,77 @@
+import unittest
+
+from fastapi.testclient import TestClient
+
+import main
+import services
+
+_PATIENT_ID = "ETAG_PATIENT"
+
+
+def _row(trial_id: str, score: float, title: str = "Lung Trial") -> dict:
+    match = {"id": trial_id, "title": title, "status": "Recruiting", "phase": "Phase 3",
+             "condition": "Non-Small Cell Lung Cancer", "rank_score": score}
+    analysis = {"decision": "Potential Match", "reasoning_steps": [], "match_rationale": [], "flags": []}
+    return {"patient_id": _PATIENT_ID, "trial_id": trial_id, "catalogue_version": services.trial_catalogue.version,
+            "model": "test-model", "match": match, "analysis": analysis}
+
+
+class ConditionalGetTest(unittest.TestCase):
+    url = f"/api/v1/patients/{_PATIENT_ID}/matches"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = TestClient(main.app)  # no lifespan: these reads need no warm-up
+        services.match_store.save_results([_row("NCT_ETAG_1", 0.8)])
+
+    @classmethod
+    def tearDownClass(cls):
+        services.match_store.close()
+
+    def test_unchanged_matches_answer_304(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertGreaterEqual(first.json()["count"], 1)
+        etag = first.headers["etag"]
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(first.headers["cache-control"], "no-cache")
+
+        again = self.client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b"")
+        self.assertEqual(again.headers["etag"], etag)
+        # Weak comparison: the strong form and a list containing the tag both match
+        self.assertEqual(self.client.get(self.url, headers={"If-None-Match": etag[2:]}).status_code, 304)
+        self.assertEqual(self.client.get(self.url, headers={"If-None-Match": f'"other", {etag}'}).status_code, 304)
+        self.assertEqual(self.client.get(self.url, headers={"If-None-Match": "*"}).status_code, 304)
+        self.assertEqual(self.client.get(self.url, headers={"If-None-Match": '"stale"'}).status_code, 200)
+
+    def test_query_parameters_are_part_of_the_etag(self):
+        full = self.client.get(self.url).headers["etag"]
+        filtered = self.client.get(self.url, params={"min_rank_score": 0.5}).headers["etag"]
+        self.assertNotEqual(full, filtered)
+        response = self.client.get(self.url, params={"min_rank_score": 0.5}, headers={"If-None-Match": full})
+        self.assertEqual(response.status_code, 200)
+
+    def test_new_result_changes_the_etag(self):
+        etag = self.client.get(self.url).headers["etag"]
+        services.match_store.save_results([_row("NCT_ETAG_2", 0.6)])
+        response = self.client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["etag"], etag)
+        self.assertIn("NCT_ETAG_2", [m["trialId"] for m in response.json()["matches"]])
+
+    def test_compressed_response_keeps_a_weak_etag(self):
+        services.match_store.save_results([_row(f"NCT_ETAG_BIG_{i}", 0.5, title="Lung Trial " * 40) for i in range(5)])
+        response = self.client.get(self.url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("content-encoding"), "gzip")
+        self.assertIn("Accept-Encoding", response.headers["vary"])
+        etag = response.headers["etag"]
+        self.assertTrue(etag.startswith('W/"'))
+        again = self.client.get(self.url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        self.assertEqual(again.status_code, 304)
+
+
+if __name__ == "__main__":
+    unittest.main()
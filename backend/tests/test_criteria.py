@@ -0,0 +1,94 @@
+import unittest
+
+from criteria import evaluate_structured_criteria, extract_structured_criteria
+from models import TrialData
+from patient_features import canonical_biomarker, extract_patient_features
+from patient_index import PatientIndex
+
+
+def _trial(**fields) -> TrialData:
+    base = {"id": "NCT0", "title": "Trial", "condition": "Non-Small Cell Lung Cancer", "phase": "3", "status": "Recruiting"}
+    return TrialData(**{**base, **fields})
+
+
+def _patient(patient_id: str = "P1", **fields) -> dict:
+    base = {"patient_id": patient_id, "condition": "Non-Small Cell Lung Cancer", "age": 60, "stage": "IV",
+            "priorTherapies": [], "biomarkers": [], "notes": ""}
+    return {**base, **fields}
+
+
+class CanonicalBiomarkerTest(unittest.TestCase):
+    def test_labels(self):
+        cases = {
+            "EGFR": "EGFR", "EGFR+": "EGFR+", "egfr positive": "EGFR+", "EGFR Exon 19 deletion": "EGFR+",
+            "KRAS G12C": "KRAS+", "BRAF wild-type": "BRAF-", "EGFR not detected": "EGFR-",
+            "ERBB2 amplified": "HER2+", "HER2/neu +": "HER2+", "PDL1 negative": "PD-L1-",
+        }
+        for label, expected in cases.items():
+            with self.subTest(label=label):
+                self.assertEqual(canonical_biomarker(label), expected)
+
+
+class BiomarkerCriteriaTest(unittest.TestCase):
+    def _status(self, required, documented):
+        criteria = extract_structured_criteria(_trial(required_markers=required))
+        return evaluate_structured_criteria(criteria, _patient(biomarkers=documented)).status
+
+    def test_required_biomarkers(self):
+        cases = [
+            (["EGFR"], ["EGFR+"], "eligible"),
+            (["EGFR+"], ["EGFR Exon 19 deletion"], "eligible"),
+            (["HER2 positive"], ["ERBB2 amplified"], "eligible"),
+            (["EGFR+"], ["EGFR-"], "ineligible"),
+            (["EGFR+"], ["EGFR wild-type"], "ineligible"),
+            (["EGFR+"], [], "needs_review"),
+            (["EGFR+"], ["KRAS G12C"], "needs_review"),
+            (["EGFR+"], ["EGFR"], "needs_review"),
+        ]
+        for required, documented, expected in cases:
+            with self.subTest(required=required, documented=documented):
+                self.assertEqual(self._status(required, documented), expected)
+
+    def test_index_only_drops_opposite_status(self):
+        index = PatientIndex([
+            _patient("POS", biomarkers=["EGFR Exon 19 deletion"]),
+            _patient("NEG", biomarkers=["EGFR-"]),
+            _patient("UNTESTED"),
+        ])
+        trial = _trial(required_markers=["EGFR"])
+        trial.structured_criteria = extract_structured_criteria(trial)
+        self.assertEqual(index.candidates_for_trial(trial), ["POS", "UNTESTED"])
+        self.assertFalse(index.passes_trial_filters("NEG", trial))
+        self.assertTrue(index.passes_trial_filters("UNTESTED", trial))
+
+
+class LabParsingTest(unittest.TestCase):
+    def test_gene_name_in_notes_is_not_a_lab(self):
+        for notes in ("EGFR 19del confirmed", "EGFR: 19 deletion", "egfr 21 L858R"):
+            with self.subTest(notes=notes):
+                self.assertNotIn("egfr", extract_patient_features(_patient(notes=notes)).labs)
+
+    def test_lab_values_in_notes(self):
+        cases = [
+            ("eGFR 72 mL/min", {"egfr": 72.0}),
+            ("EGFR 55 mL/min/1.73m2", {"egfr": 55.0}),
+            ("HbA1c 8.1%, eGFR of 48", {"hba1c": 8.1, "egfr": 48.0}),
+        ]
+        for notes, expected in cases:
+            with self.subTest(notes=notes):
+                self.assertEqual(extract_patient_features(_patient(notes=notes)).labs, expected)
+
+    def test_gene_mutation_does_not_fail_renal_criterion(self):
+        criteria = extract_structured_criteria(_trial(inclusions=["eGFR >= 60 mL/min"]))
+        evaluation = evaluate_structured_criteria(criteria, _patient(notes="EGFR 19del, ECOG 1"))
+        self.assertEqual(evaluation.status, "needs_review")
+        self.assertEqual(evaluation.failed, [])
+
+    def test_gene_requirement_is_not_parsed_as_lab(self):
+        criteria = extract_structured_criteria(_trial(inclusions=["EGFR > 0"], exclusions=["eGFR < 45 ml/min"]))
+        self.assertEqual([c.source for c in criteria.numeric], ["eGFR < 45 ml/min"])
+        self.assertEqual(criteria.residual_inclusions, ["EGFR > 0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
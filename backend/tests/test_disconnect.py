@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from fastapi import HTTPException
+
+import main
+
+
+class _FakeRequest:
+    """Stands in for starlette's Request; reports a disconnect after `connected_polls` checks."""
+
+    def __init__(self, connected_polls: int):
+        self.connected_polls = connected_polls
+        self.url = mock.Mock(path="/api/v1/trials/find")
+
+    async def is_disconnected(self) -> bool:
+        self.connected_polls -= 1
+        return self.connected_polls < 0
+
+
+@mock.patch.object(main, "DISCONNECT_POLL_SECONDS", 0.01)
+class CancelOnDisconnectTest(unittest.TestCase):
+    def _slow_work(self, events: list):
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                events.append("cancelled")
+                raise
+            return "done"
+        return work()
+
+    def test_disconnect_cancels_work_and_answers_499(self):
+        events = []
+
+        async def run():
+            with self.assertRaises(HTTPException) as raised:
+                await main._cancel_on_disconnect(_FakeRequest(connected_polls=2), self._slow_work(events))
+            return raised.exception
+
+        error = asyncio.run(run())
+        self.assertEqual(error.status_code, main.HTTP_499_CLIENT_CLOSED_REQUEST)
+        self.assertEqual(events, ["cancelled"])
+
+    def test_connected_client_gets_the_result(self):
+        async def quick_work():
+            await asyncio.sleep(0.03)
+            return "done"
+
+        self.assertEqual(asyncio.run(main._cancel_on_disconnect(_FakeRequest(connected_polls=100), quick_work())), "done")
+
+    def test_cancelled_endpoint_cancels_the_work(self):
+        events = []
+
+        async def run():
+            endpoint = asyncio.ensure_future(main._cancel_on_disconnect(_FakeRequest(connected_polls=100), self._slow_work(events)))
+            await asyncio.sleep(0.05)
+            endpoint.cancel()
+            await asyncio.gather(endpoint, return_exceptions=True)
+            await asyncio.sleep(0)
+
+        asyncio.run(run())
+        self.assertEqual(events, ["cancelled"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from unittest.mock import patch
+
+from admission import AdmissionRejected
+from jobs import JobDeferred, JobQueue, JobWorkerPool
+
+
+def _queue_path() -> str:
+    return os.path.join(tempfile.mkdtemp(prefix="jobs_test_"), "jobs.db")
+
+
+def _open_queue(test: unittest.TestCase, path: str, **options) -> JobQueue:
+    queue = JobQueue(path, **options)
+    test.addCleanup(queue.close)
+    return queue
+
+
+class JobLeaseTest(unittest.TestCase):
+    def test_live_lease_is_not_claimed_twice(self):
+        path = _queue_path()
+        queue, sibling = _open_queue(self, path), _open_queue(self, path)
+        queue.submit("PATIENT_001")
+        job = queue.claim_next()
+        self.assertEqual(job["status"], "running")
+        self.assertIsNone(sibling.claim_next())
+        self.assertTrue(queue.finish(job["jobId"], job["leaseOwner"], True, {"status": "success"}))
+        self.assertEqual(sibling.get(job["jobId"])["status"], "succeeded")
+
+    def test_expired_lease_is_reclaimed_and_old_owner_discarded(self):
+        path = _queue_path()
+        crashed, sibling = _open_queue(self, path, lease_seconds=0.05), _open_queue(self, path)
+        crashed.submit("PATIENT_001")
+        stale = crashed.claim_next()
+        time.sleep(0.1)
+        job = sibling.claim_next()
+        self.assertEqual((job["jobId"], job["attempts"]), (stale["jobId"], 2))
+        self.assertFalse(crashed.renew_lease(stale["jobId"], stale["leaseOwner"]))
+        self.assertFalse(crashed.finish(stale["jobId"], stale["leaseOwner"], False, {"error_type": "X"}))
+        self.assertTrue(sibling.finish(job["jobId"], job["leaseOwner"], True, {"status": "success"}))
+
+    def test_max_attempts_marks_job_failed(self):
+        queue = _open_queue(self, _queue_path(), lease_seconds=0.01, max_attempts=2)
+        job_id = queue.submit("PATIENT_001")[0]["jobId"]
+        for _ in range(2):
+            self.assertIsNotNone(queue.claim_next())
+            time.sleep(0.02)
+        self.assertIsNone(queue.claim_next())
+        job = queue.get(job_id)
+        self.assertEqual((job["status"], job["attempts"], job["error"]["error_type"]), ("failed", 2, "JOB_MAX_ATTEMPTS"))
+
+    def test_release_does_not_charge_an_attempt(self):
+        queue = _open_queue(self, _queue_path())
+        queue.submit("PATIENT_001")
+        job = queue.claim_next()
+        queue.release(job["jobId"], job["leaseOwner"])
+        self.assertEqual(queue.get(job["jobId"])["status"], "queued")
+        self.assertEqual(queue.claim_next()["attempts"], 1)
+
+    def test_delayed_release_is_not_claimable_until_due(self):
+        queue = _open_queue(self, _queue_path())
+        queue.submit("PATIENT_001")
+        job = queue.claim_next()
+        queue.release(job["jobId"], job["leaseOwner"], delay=0.1)
+        self.assertIsNone(queue.claim_next())
+        time.sleep(0.15)
+        self.assertEqual(queue.claim_next()["attempts"], 1)
+
+
+class JobRequestOptionsTest(unittest.TestCase):
+    def test_request_options_round_trip(self):
+        queue = _open_queue(self, _queue_path())
+        options = {"page": 2, "pageSize": 5, "includeDiagnostics": True}
+        job, created = queue.submit("PATIENT_001", "key-1", options)
+        self.assertTrue(created)
+        self.assertEqual(job["request"], options)
+        self.assertEqual(queue.claim_next()["request"], options)
+
+    def test_idempotency_key_reused_with_other_options_is_rejected(self):
+        queue = _open_queue(self, _queue_path())
+        queue.submit("PATIENT_001", "key-1", {"page": 1})
+        self.assertFalse(queue.submit("PATIENT_001", "key-1", {"page": 1})[1])
+        with self.assertRaises(ValueError):
+            queue.submit("PATIENT_001", "key-1", {"page": 2})
+
+
+class JobWorkerHeartbeatTest(unittest.TestCase):
+    def test_long_job_keeps_its_lease(self):
+        path = _queue_path()
+        queue, sibling = _open_queue(self, path, lease_seconds=0.15), _open_queue(self, path)
+
+        async def slow_handler(patient_id, request):
+            await asyncio.sleep(0.5)
+            return True, {"patientId": patient_id}
+
+        async def run():
+            pool = JobWorkerPool(queue, slow_handler, concurrency=1)
+            job_id = queue.submit("PATIENT_001")[0]["jobId"]
+            await pool.start()
+            while queue.get(job_id)["status"] == "queued":
+                await asyncio.sleep(0.01)
+            stolen = []
+            while queue.get(job_id)["status"] != "succeeded":
+                stolen.append(await asyncio.to_thread(sibling.claim_next))
+                await asyncio.sleep(0.05)
+            await pool.stop()
+            return job_id, [job for job in stolen if job]
+
+        job_id, stolen = asyncio.run(run())
+        self.assertEqual(stolen, [])
+        self.assertEqual(queue.get(job_id)["attempts"], 1)
+
+    def test_deferred_job_is_requeued_without_charging_an_attempt(self):
+        queue = _open_queue(self, _queue_path())
+        calls = []
+
+        async def shedding_handler(patient_id, request):
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise JobDeferred(0.2)
+            return True, {"patientId": patient_id}
+
+        async def run():
+            pool = JobWorkerPool(queue, shedding_handler, concurrency=1)
+            job_id = queue.submit("PATIENT_001")[0]["jobId"]
+            await pool.start()
+            while queue.get(job_id)["status"] != "succeeded":
+                await asyncio.sleep(0.01)
+            await pool.stop()
+            return queue.get(job_id)
+
+        job = asyncio.run(run())
+        self.assertEqual(len(calls), 2)
+        self.assertGreaterEqual(calls[1] - calls[0], 0.2)
+        self.assertEqual(job["attempts"], 1)
+
+
+class FindTrialsJobHandlerTest(unittest.TestCase):
+    def setUp(self):
+        import main
+        self.main = main
+
+    def test_job_applies_paging_and_diagnostics(self):
+        matches = [{"id": f"NCT{i:08d}", "title": f"Trial {i}", "status": "Recruiting", "phase": "Phase 2",
+                    "condition": "Widgetitis"} for i in range(5)]
+
+        async def workflow(patient_id, limit, account):
+            self.assertEqual(limit, 4)
+            return matches[:limit]
+
+        with patch.object(self.main, "run_trial_matching_workflow", side_effect=workflow):
+            succeeded, payload = asyncio.run(self.main._run_find_trials_job(
+                "PATIENT_001", {"page": 2, "pageSize": 2, "includeDiagnostics": True}))
+        self.assertTrue(succeeded)
+        self.assertEqual([match["id"] for match in payload["matches"]], ["NCT00000002", "NCT00000003"])
+        self.assertEqual((payload["page"], payload["pageSize"]), (2, 2))
+        self.assertIsNotNone(payload["diagnostics"])
+
+    def test_shed_job_is_deferred(self):
+        async def shed(*args, **kwargs):
+            raise AdmissionRejected("queue_full", retry_after=3)
+
+        with patch.object(self.main, "_run_admitted_workflow", side_effect=shed):
+            with self.assertRaises(JobDeferred) as raised:
+                asyncio.run(self.main._run_find_trials_job("PATIENT_001", {}))
+        self.assertEqual(raised.exception.retry_after, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
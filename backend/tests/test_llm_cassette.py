@@ -0,0 +1,121 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ParsedChatCompletion
+
+import llm_cassette
+from llm_cassette import Cassette, CassetteClient, CassetteMiss, cassette_key
+from models import LLMAnalysisResult
+
+_MESSAGES = [{"role": "system", "content": "Analyze."}, {"role": "user", "content": "Patient  and\n trial."}]
+_ANALYSIS = json.dumps({"decision": "Potential Match", "reasoning_steps": ["fits"], "match_rationale": [], "flags": []})
+
+
+def _completion(content: str) -> dict:
+    return {"id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "gpt-test",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}]}
+
+
+def _chunk(content: str) -> ChatCompletionChunk:
+    return ChatCompletionChunk.model_validate({"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 0, "model": "gpt-test",
+                                               "choices": [{"index": 0, "delta": {"content": content}}]})
+
+
+class _FakeStream:
+    def __init__(self, chunks):
+        self._chunks = list(chunks)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self._chunks:
+            yield chunk
+
+    async def close(self):
+        return None
+
+
+def _fake_client(create=None, parse=None) -> SimpleNamespace:
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)),
+                           beta=SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(parse=parse))))
+
+
+@mock.patch.object(llm_cassette, "LLM_CASSETTE_REPLAY_LATENCY_SECONDS", "0")
+class CassetteRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix="cassette_test_"), "cassette.jsonl")
+
+    def _replay_client(self) -> CassetteClient:
+        # A fresh Cassette reads the recordings back from disk, as a replay run would
+        return CassetteClient(None, Cassette(self.path), "replay")
+
+    def test_create_is_replayed_without_a_client(self):
+        create = mock.AsyncMock(return_value=ChatCompletion.model_validate(_completion(_ANALYSIS)))
+        recorder = CassetteClient(_fake_client(create=create), Cassette(self.path), "record")
+        asyncio.run(recorder.chat.completions.create(model="gpt-test", messages=_MESSAGES))
+
+        # Whitespace differences in the prompt still hit the recording
+        messages = [dict(m, content=" ".join(m["content"].split())) for m in _MESSAGES]
+        replayed = asyncio.run(self._replay_client().chat.completions.create(model="gpt-test", messages=messages))
+        self.assertIsInstance(replayed, ChatCompletion)
+        self.assertEqual(replayed.choices[0].message.content, _ANALYSIS)
+        create.assert_awaited_once()
+
+    def test_parse_rebuilds_the_structured_output(self):
+        recorded = ParsedChatCompletion.model_validate(_completion(_ANALYSIS))
+        recorded.choices[0].message.parsed = LLMAnalysisResult.model_validate_json(_ANALYSIS)
+        recorder = CassetteClient(_fake_client(parse=mock.AsyncMock(return_value=recorded)), Cassette(self.path), "record")
+        asyncio.run(recorder.beta.chat.completions.parse(model="gpt-test", messages=_MESSAGES, response_format=LLMAnalysisResult))
+
+        replayed = asyncio.run(self._replay_client().beta.chat.completions.parse(
+            model="gpt-test", messages=_MESSAGES, response_format=LLMAnalysisResult))
+        parsed = replayed.choices[0].message.parsed
+        self.assertIsInstance(parsed, LLMAnalysisResult)
+        self.assertEqual(parsed.decision, "Potential Match")
+
+    def test_stream_replays_the_consumed_chunks(self):
+        chunks = [_chunk('{"decision": '), _chunk('"Likely Not a Match"'), _chunk(', "flags": []}')]
+        create = mock.AsyncMock(return_value=_FakeStream(chunks))
+        recorder = CassetteClient(_fake_client(create=create), Cassette(self.path), "record")
+
+        async def consume(client, limit):
+            stream = await client.chat.completions.create(model="gpt-test", messages=_MESSAGES, stream=True)
+            contents = []
+            async for chunk in stream:
+                contents.append(chunk.choices[0].delta.content)
+                if len(contents) == limit:
+                    break
+            await stream.close()
+            return contents
+
+        # An early-stopped stream records only what was consumed
+        self.assertEqual(asyncio.run(consume(recorder, 2)), ['{"decision": ', '"Likely Not a Match"'])
+        self.assertEqual(asyncio.run(consume(self._replay_client(), 10)), ['{"decision": ', '"Likely Not a Match"'])
+
+    def test_unrecorded_request_misses(self):
+        with self.assertRaises(CassetteMiss):
+            asyncio.run(self._replay_client().chat.completions.create(model="gpt-test", messages=_MESSAGES))
+
+    def test_record_mode_needs_a_client(self):
+        with self.assertRaises(ValueError):
+            CassetteClient(None, Cassette(self.path), "record")
+
+
+class CassetteKeyTest(unittest.TestCase):
+    def test_volatile_ids_and_whitespace_are_ignored(self):
+        first = [{"role": "tool", "content": "result  one", "tool_call_id": "call_1"}]
+        second = [{"role": "tool", "content": "result one", "tool_call_id": "call_2"}]
+        self.assertEqual(cassette_key("create", {"model": "m", "messages": first}),
+                         cassette_key("create", {"model": "m", "messages": second}))
+        self.assertNotEqual(cassette_key("create", {"model": "m", "messages": first}),
+                            cassette_key("parse", {"model": "m", "messages": first}))
+
+
+if __name__ == "__main__":
+    unittest.main()
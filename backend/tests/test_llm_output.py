@@ -0,0 +1,52 @@
+import json
+import unittest
+
+from pydantic import ValidationError
+
+from llm_output import LlmJsonParser, repair_json
+from models import LLMAnalysisResult
+
+_ANALYSIS = {"decision": "Potential Match", "reasoning_steps": ["Step 1", "Step 2"],
+             "match_rationale": ["Stage IV"], "flags": ["Brain metastases not documented"]}
+_TEXT = json.dumps(_ANALYSIS)
+
+
+class RepairJsonTest(unittest.TestCase):
+    def test_repairs_common_malformations(self):
+        cases = {
+            "code fence": (f"```json\n{_TEXT}\n```", _ANALYSIS),
+            "surrounding prose": (f"Here is my analysis: {_TEXT} Hope this helps.", _ANALYSIS),
+            "trailing commas": ('{"decision": "Uncertain", "flags": ["a",],}', {"decision": "Uncertain", "flags": ["a"]}),
+            "raw newline in string": ('{"decision": "Uncertain", "reasoning_steps": ["line 1\nline 2"]}',
+                                      {"decision": "Uncertain", "reasoning_steps": ["line 1\nline 2"]}),
+            "truncated array": ('{"decision": "Uncertain", "flags": ["a", "b', {"decision": "Uncertain", "flags": ["a"]}),
+            "truncated after key": ('{"decision": "Uncertain", "flags":', {"decision": "Uncertain"}),
+        }
+        for name, (text, expected) in cases.items():
+            with self.subTest(name):
+                self.assertEqual(json.loads(repair_json(text)), expected)
+
+
+class LlmJsonParserTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = LlmJsonParser(LLMAnalysisResult)
+
+    def test_well_formed_output_is_not_flagged(self):
+        value, repaired = self.parser.parse_with_repair_flag(_TEXT)
+        self.assertFalse(repaired)
+        self.assertEqual(value.model_dump(), _ANALYSIS)
+
+    def test_malformed_output_is_repaired_and_flagged(self):
+        value, repaired = self.parser.parse_with_repair_flag(_TEXT[:_TEXT.index('"flags"')] + '"flags": ["Brain')
+        self.assertTrue(repaired)
+        self.assertEqual((value.decision, value.flags), ("Potential Match", []))
+
+    def test_unrecoverable_output_raises_validation_error(self):
+        for text in ("I cannot decide.", '{"verdict": "yes"}', '{"decis'):
+            with self.subTest(text=text):
+                with self.assertRaises(ValidationError):
+                    self.parser.parse(text)
+
+
+if __name__ == "__main__":
+    unittest.main()
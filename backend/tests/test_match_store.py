@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from match_store import MatchStore
+
+
+def _row(patient_id: str, trial_id: str, score=None, catalogue_version: int = 1) -> dict:
+    match = {"id": trial_id, "rank_score": score} if score is not None else None
+    decision = "Potential Match" if match else "Likely Not a Match"
+    return {"patient_id": patient_id, "trial_id": trial_id, "catalogue_version": catalogue_version,
+            "model": "test-model", "match": match, "analysis": {"decision": decision}}
+
+
+class MatchStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix="match_store_test_"), "nested", "match_store.db")
+        self.store = MatchStore(self.path)
+        self.addCleanup(self.store.close)
+
+    def test_database_is_opened_on_first_use(self):
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.store.latest_for_patient("P1"), [])
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_reads_return_the_latest_row_per_pair_best_first(self):
+        self.store.save_results([_row("P1", "NCT1", 0.4), _row("P1", "NCT2", 0.9), _row("P2", "NCT1", 0.7)])
+        # A newer catalogue version turns NCT1 into a non-match for P1; history is kept but not served
+        self.store.save_results([_row("P1", "NCT1", catalogue_version=2)])
+
+        self.assertEqual([m["trialId"] for m in self.store.latest_for_patient("P1")], ["NCT2"])
+        self.assertEqual(len(self.store.latest_for_patient("P1", only_matches=False)), 2)
+        self.assertEqual([m["patientId"] for m in self.store.matches_for_trial("NCT1")], ["P2"])
+        self.assertEqual(self.store.latest_for_patient("P1", min_rank_score=0.95), [])
+        self.assertEqual(self.store.matched_trials_for_patient("P1"), ["NCT2"])
+        self.assertEqual(self.store.matched_patients_for_trial("NCT1"), ["P2"])
+
+    def test_revision_changes_on_every_write(self):
+        before = self.store.patient_revision("P1")
+        self.store.save_results([_row("P1", "NCT1", 0.5)])
+        after = self.store.patient_revision("P1")
+        self.assertNotEqual(before, after)
+        self.assertEqual(self.store.trial_revision("NCT2"), "0:-")
+
+    def test_close_then_reuse_reopens(self):
+        self.store.save_results([_row("P1", "NCT1", 0.5)])
+        self.store.close()
+        self.assertEqual(len(self.store.latest_for_patient("P1")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
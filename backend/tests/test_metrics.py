@@ -0,0 +1,38 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+class _CountingCache:
+    """Reports whether len() was called on the event loop thread."""
+    hits = 0
+    misses = 0
+
+    def __init__(self):
+        self.counted_on_loop = None
+
+    def __len__(self):
+        try:
+            asyncio.get_running_loop()
+            self.counted_on_loop = True
+        except RuntimeError:
+            self.counted_on_loop = False
+        return 7
+
+
+class MetricsEndpointTest(unittest.TestCase):
+    def test_cache_size_is_counted_off_the_event_loop(self):
+        cache = _CountingCache()
+        with mock.patch.object(main, "analysis_cache", cache):
+            response = TestClient(main.app).get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("analysis_cache_entries 7", response.text)
+        self.assertIs(cache.counted_on_loop, False)
+
+
+if __name__ == "__main__":
+    unittest.main()
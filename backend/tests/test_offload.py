@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import unittest
+
+import offload
+from catalogue import TrialCatalogue
+from metrics import metrics
+from offload import CpuOffloader
+from ranking import plan_analysis_order
+
+_PATIENT = {"patient_id": "P1", "condition": "Non-Small Cell Lung Cancer", "age": 60, "stage": "IV",
+            "priorTherapies": [], "biomarkers": ["EGFR+"], "notes": "ECOG 1"}
+
+
+def _trial(i: int, condition: str = "Non-Small Cell Lung Cancer", status: str = "Recruiting") -> dict:
+    return {"id": f"NCT{i:08d}", "title": f"Trial {i}", "condition": condition, "phase": "3", "status": status,
+            "min_age": 18, "required_markers": ["EGFR+"] if i % 2 else [], "inclusions": [f"Criterion {i}"]}
+
+
+def _thread_name(_: object) -> str:
+    return threading.current_thread().name
+
+
+class CpuOffloaderTest(unittest.TestCase):
+    def setUp(self):
+        # Offloaders point the module-level catalogue at their own; put the app's back afterwards
+        previous = offload._catalogue
+        self.addCleanup(setattr, offload, "_catalogue", previous)
+        self.catalogue = TrialCatalogue([_trial(i) for i in range(6)] + [_trial(90, condition="Breast Cancer"),
+                                                                          _trial(91, status="Completed")])
+
+    def _offloader(self, mode: str, min_trials: int) -> CpuOffloader:
+        offloader = CpuOffloader(self.catalogue, mode=mode, max_workers=2, min_trials=min_trials)
+        self.addCleanup(offloader.shutdown)
+        return offloader
+
+    def test_small_stages_run_inline(self):
+        offloader = self._offloader("thread", min_trials=100)
+        before = metrics.counter_value("offload_tasks_total", stage="test", executor="inline")
+
+        async def run():
+            return await offloader.run("test", 10, _thread_name, None), threading.current_thread().name
+
+        ran_on, loop_thread = asyncio.run(run())
+        self.assertEqual(ran_on, loop_thread)
+        self.assertIsNone(offloader._executor)
+        self.assertEqual(metrics.counter_value("offload_tasks_total", stage="test", executor="inline"), before + 1)
+
+    def test_large_stages_run_in_the_thread_pool(self):
+        offloader = self._offloader("thread", min_trials=5)
+        ran_on = asyncio.run(offloader.run("test", 5, _thread_name, None))
+        self.assertTrue(ran_on.startswith("offload"))
+
+    def test_inline_mode_never_builds_a_pool(self):
+        offloader = self._offloader("inline", min_trials=0)
+        offloader.start()
+        asyncio.run(offloader.run("test", 10_000, _thread_name, None))
+        self.assertIsNone(offloader._executor)
+
+    def test_search_returns_recruiting_trials_for_the_condition(self):
+        for min_trials in (0, 100):  # pooled and inline
+            with self.subTest(min_trials=min_trials):
+                offloader = self._offloader("thread", min_trials=min_trials)
+                trials = asyncio.run(offloader.search("lung cancer"))
+                self.assertEqual([t.id for t in trials], [f"NCT{i:08d}" for i in range(6)])
+
+    def test_plan_merges_trials_missing_from_the_catalogue(self):
+        offloader = self._offloader("thread", min_trials=0)
+        unknown = TrialCatalogue([_trial(50)]).get("NCT00000050")
+        trials = [self.catalogue.get(f"NCT{i:08d}") for i in range(6)] + [unknown]
+        planned = asyncio.run(offloader.plan(_PATIENT, trials))
+        expected = sorted(((c.trial.id, c.upper_bound) for c in plan_analysis_order(_PATIENT, trials)),
+                          key=lambda item: (-item[1], item[0]))
+        self.assertEqual(planned, expected)
+
+    def test_process_pool_is_replaced_when_the_catalogue_changes(self):
+        offloader = self._offloader("process", min_trials=0)
+        first = offloader._get_executor()
+        self.assertIs(offloader._get_executor(), first)
+        self.catalogue.upsert(_trial(7))
+        self.assertIsNot(offloader._get_executor(), first)
+        self.assertEqual(offloader._executor_version, self.catalogue.version)
+
+
+if __name__ == "__main__":
+    unittest.main()
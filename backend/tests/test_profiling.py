@@ -0,0 +1,72 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import main
+from profiling import PROFILING_ADMIN_HEADER, PROFILING_HEADER, ProfilingMiddleware, RequestProfiler
+
+_TOKEN = "s3cret"
+
+
+class ProfilingMiddlewareTest(unittest.TestCase):
+    def _request(self, headers: dict) -> tuple:
+        profiler = RequestProfiler(directory=tempfile.mkdtemp(prefix="profiles_test_"), sample_rate=0)
+        sent = []
+
+        async def app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+
+        async def send(message):
+            sent.append(message)
+
+        middleware = ProfilingMiddleware(app, profiler=profiler, paths=["/api/v1/trials/find"], admin_token=_TOKEN)
+        scope = {"type": "http", "path": "/api/v1/trials/find",
+                 "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]}
+        asyncio.run(middleware(scope, None, send))
+        return profiler.captured, dict(sent[0]["headers"])
+
+    def test_header_without_admin_token_is_ignored(self):
+        for headers in ({PROFILING_HEADER: "1"}, {PROFILING_HEADER: "1", PROFILING_ADMIN_HEADER: "wrong"}):
+            with self.subTest(headers=headers):
+                captured, response_headers = self._request(headers)
+                self.assertEqual(captured, 0)
+                self.assertNotIn(b"x-profile-id", response_headers)
+
+    def test_header_with_admin_token_captures(self):
+        captured, response_headers = self._request({PROFILING_HEADER: "1", PROFILING_ADMIN_HEADER: _TOKEN})
+        self.assertEqual(captured, 1)
+        self.assertIn(b"x-profile-id", response_headers)
+
+
+class ProfilingAdminRoutesTest(unittest.TestCase):
+    def test_routes_are_not_mounted_when_profiling_is_disabled(self):
+        self.assertFalse(main.PROFILING_ENABLED)
+        self.assertEqual(TestClient(main.app).get("/admin/profiles", headers={PROFILING_ADMIN_HEADER: _TOKEN}).status_code, 404)
+
+    def test_routes_require_the_admin_token(self):
+        app = FastAPI()
+        app.include_router(main.profiling_router)
+        client = TestClient(app)
+        with mock.patch.object(main, "PROFILING_ADMIN_TOKEN", _TOKEN), \
+                mock.patch.object(main, "request_profiler", RequestProfiler(directory=os.path.join(tempfile.mkdtemp(), "none"))):
+            self.assertEqual(client.get("/admin/profiles").status_code, 401)
+            self.assertEqual(client.get("/admin/profiles", headers={PROFILING_ADMIN_HEADER: "wrong"}).status_code, 403)
+            self.assertEqual(client.get("/admin/profiles/x.prof", headers={PROFILING_ADMIN_HEADER: "wrong"}).status_code, 403)
+            response = client.get("/admin/profiles", headers={PROFILING_ADMIN_HEADER: _TOKEN})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["profiles"], [])
+
+    def test_unset_token_refuses_every_request(self):
+        app = FastAPI()
+        app.include_router(main.profiling_router)
+        with mock.patch.object(main, "PROFILING_ADMIN_TOKEN", None):
+            self.assertEqual(TestClient(app).get("/admin/profiles", headers={PROFILING_ADMIN_HEADER: ""}).status_code, 403)
+
+
+if __name__ == "__main__":
+    unittest.main()
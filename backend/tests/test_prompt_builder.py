@@ -0,0 +1,72 @@
+import json
+import unittest
+
+from prompt_builder import (ANALYSIS_SYSTEM_PROMPT, PROMPT_NOTES_MAX_TOKENS, build_analysis_prompt,
+                            count_message_tokens, count_tokens)
+
+_PATIENT = {"age": 60, "condition": "Non-Small Cell Lung Cancer", "stage": "IV", "biomarkers": ["EGFR+"], "notes": "Stable."}
+
+
+def _trial(**overrides):
+    trial = {"condition": "Non-Small Cell Lung Cancer", "inclusions": ["Measurable disease"],
+             "exclusions": ["Active brain metastases"], "eligibility_text": "Adults with advanced NSCLC."}
+    trial.update(overrides)
+    return trial
+
+
+def _trial_snippet(prompt) -> dict:
+    first_line = prompt.messages[2]["content"].splitlines()[0]
+    return json.loads(first_line[len("Trial Details Snippet: "):])
+
+
+class PromptLayoutTest(unittest.TestCase):
+    def test_static_then_patient_then_trial(self):
+        prompt = build_analysis_prompt(_PATIENT, _trial(), ["Age 60 within 18-75"], ["ECOG"])
+        self.assertEqual([m["role"] for m in prompt.messages], ["system", "user", "user"])
+        self.assertEqual(prompt.messages[0]["content"], ANALYSIS_SYSTEM_PROMPT)
+        self.assertTrue(prompt.messages[1]["content"].startswith("Patient Profile Snippet:"))
+        self.assertTrue(prompt.messages[2]["content"].startswith("Trial Details Snippet:"))
+        self.assertIn("Age 60 within 18-75", prompt.messages[2]["content"])
+        self.assertEqual(prompt.prefix_tokens, count_message_tokens(prompt.messages[:2]))
+        self.assertEqual(prompt.prompt_tokens, count_message_tokens(prompt.messages))
+        self.assertEqual(prompt.trimmed_fields, [])
+
+    def test_prefix_is_identical_across_trials(self):
+        first = build_analysis_prompt(_PATIENT, _trial(), [], [])
+        second = build_analysis_prompt(_PATIENT, _trial(condition="NSCLC", eligibility_text="x" * 5000), ["a"], ["b"], budget=400)
+        self.assertEqual(first.messages[:2], second.messages[:2])
+        self.assertEqual(first.prefix_tokens, second.prefix_tokens)
+
+
+class PromptBudgetTest(unittest.TestCase):
+    def test_long_notes_are_capped_in_the_prefix(self):
+        prompt = build_analysis_prompt(dict(_PATIENT, notes="history " * 2000), _trial(), [], [])
+        notes = json.loads(prompt.messages[1]["content"][len("Patient Profile Snippet: "):])["notes"]
+        self.assertTrue(notes.endswith("[...truncated]"))
+        self.assertLessEqual(count_tokens(notes), PROMPT_NOTES_MAX_TOKENS)
+        self.assertEqual(prompt.trimmed_fields, ["notes"])
+
+    def test_eligibility_text_is_trimmed_before_criteria_lists(self):
+        prompt = build_analysis_prompt(_PATIENT, _trial(eligibility_text="criterion " * 3000), [], [], budget=800)
+        trial = _trial_snippet(prompt)
+        self.assertLessEqual(prompt.prompt_tokens, 800)
+        self.assertEqual(prompt.trimmed_fields, ["eligibility_text"])
+        self.assertTrue(trial["eligibility_text"].endswith("[...truncated]"))
+        self.assertEqual(trial["inclusions"], ["Measurable disease"])
+
+    def test_criteria_lists_lose_trailing_items_in_order(self):
+        inclusions = [f"Inclusion criterion number {i} with some detail" for i in range(200)]
+        exclusions = [f"Exclusion criterion number {i}" for i in range(5)]
+        prompt = build_analysis_prompt(_PATIENT, _trial(eligibility_text="", inclusions=inclusions, exclusions=exclusions),
+                                       [], [], budget=900)
+        trial = _trial_snippet(prompt)
+        self.assertLessEqual(prompt.prompt_tokens, 900)
+        self.assertEqual(prompt.trimmed_fields, ["inclusions"])
+        kept = trial["inclusions"][:-1]
+        self.assertEqual(kept, inclusions[:len(kept)])
+        self.assertEqual(trial["inclusions"][-1], f"[{len(inclusions) - len(kept)} more criteria omitted]")
+        self.assertEqual(trial["exclusions"], exclusions)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from types import SimpleNamespace
+
+from models import TrialData
+from ranking import TopKRanker, plan_analysis_order
+
+
+def _match(trial_id: str, score: float) -> SimpleNamespace:
+    return SimpleNamespace(id=trial_id, rank_score=score)
+
+
+def _trial(trial_id: str, **fields) -> TrialData:
+    return TrialData(id=trial_id, title=f"Trial {trial_id}", condition="Non-Small Cell Lung Cancer", phase="3",
+                     status="Recruiting", **fields)
+
+
+class TopKRankerTest(unittest.TestCase):
+    def test_never_stops_before_k_matches(self):
+        ranker = TopKRanker(3, high_confidence_score=0.75)
+        ranker.push(_match("A", 0.9))
+        ranker.push(_match("B", 0.9))
+        self.assertFalse(ranker.full)
+        self.assertFalse(ranker.can_stop(0.0))
+        self.assertFalse(ranker.can_stop(None))
+
+    def test_stops_when_all_kept_matches_are_high_confidence(self):
+        ranker = TopKRanker(2, high_confidence_score=0.75)
+        ranker.push(_match("A", 0.8))
+        ranker.push(_match("B", 0.7))
+        self.assertFalse(ranker.can_stop(0.95))
+        ranker.push(_match("C", 0.76))
+        self.assertEqual(ranker.min_score, 0.76)
+        self.assertTrue(ranker.can_stop(0.95))
+
+    def test_stops_when_no_remaining_bound_can_beat_the_weakest_kept(self):
+        ranker = TopKRanker(2, high_confidence_score=0.75)
+        ranker.push(_match("A", 0.6))
+        ranker.push(_match("B", 0.5))
+        self.assertFalse(ranker.can_stop(0.55))
+        self.assertTrue(ranker.can_stop(0.5))
+        self.assertTrue(ranker.can_stop(0.2))
+        self.assertFalse(ranker.can_stop(None))
+
+    def test_keeps_the_best_k_and_breaks_ties_by_id(self):
+        ranker = TopKRanker(3)
+        for trial_id, score in (("D", 0.5), ("B", 0.5), ("E", 0.9), ("A", 0.1), ("C", 0.5)):
+            ranker.push(_match(trial_id, score))
+        self.assertEqual([m.id for m in ranker.results()], ["E", "B", "C"])
+        self.assertEqual(ranker.seen, 5)
+
+    def test_custom_key(self):
+        ranker = TopKRanker(1, key=lambda match: match.patientId)
+        ranker.push(SimpleNamespace(patientId="P2", rank_score=0.5))
+        ranker.push(SimpleNamespace(patientId="P1", rank_score=0.5))
+        self.assertEqual([m.patientId for m in ranker.results()], ["P1"])
+
+
+class PlanAnalysisOrderTest(unittest.TestCase):
+    def test_orders_by_upper_bound_with_ineligible_last(self):
+        patient = {"patient_id": "P1", "condition": "Non-Small Cell Lung Cancer", "age": 45, "stage": "IV",
+                   "priorTherapies": [], "biomarkers": ["EGFR positive"], "notes": "ECOG 1"}
+        trials = [
+            _trial("NCT3", min_age=65),  # ruled out by age
+            _trial("NCT2"),
+            _trial("NCT1", required_markers=["EGFR"]),
+        ]
+        planned = plan_analysis_order(patient, trials)
+        self.assertEqual([c.trial.id for c in planned], ["NCT1", "NCT2", "NCT3"])
+        self.assertFalse(planned[-1].eligible)
+        self.assertEqual(planned[-1].upper_bound, 0.0)
+        self.assertGreater(planned[0].upper_bound, planned[1].upper_bound)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+import main
+import services
+
+
+@mock.patch.object(main, "warm_up", mock.AsyncMock(return_value={"trials": 2}))
+class ReadinessTest(unittest.TestCase):
+    def _wait_for(self, client: TestClient, predicate, timeout: float = 5.0) -> dict:
+        deadline = time.monotonic() + timeout
+        while True:
+            body = client.get("/ready").json()
+            if predicate(body) or time.monotonic() > deadline:
+                return body
+            time.sleep(0.02)
+
+    def test_llm_outage_leaves_service_ready_but_degraded(self):
+        failing_probe = mock.AsyncMock(side_effect=RuntimeError("Azure unreachable"))
+        state = {"ready": False, "attempts": 0, "warmup": None, "last_error": None,
+                 "llm": {"status": "pending", "attempts": 0, "last_error": None}}
+        with mock.patch.object(main, "probe_llm", failing_probe), mock.patch.object(main, "readiness", state), \
+                mock.patch.object(main, "WARMUP_RETRY_SECONDS", 0.01), TestClient(main.app) as client:
+            body = self._wait_for(client, lambda b: b.get("llm", {}).get("attempts", 0) >= 2)
+            self.assertEqual(client.get("/ready").status_code, 200)
+            self.assertEqual(body["status"], "degraded")
+            self.assertEqual(body["llm"]["status"], "unavailable")
+            self.assertIn("Azure unreachable", body["llm"]["lastError"])
+            self.assertTrue(main.job_workers._tasks)
+
+    def test_probe_success_reports_ready(self):
+        state = {"ready": False, "attempts": 0, "warmup": None, "last_error": None,
+                 "llm": {"status": "pending", "attempts": 0, "last_error": None}}
+        with mock.patch.object(main, "probe_llm", mock.AsyncMock(return_value="no_match")), \
+                mock.patch.object(main, "readiness", state), TestClient(main.app) as client:
+            body = self._wait_for(client, lambda b: b.get("llm", {}).get("status") == "ok")
+        self.assertEqual(body["status"], "ready")
+
+
+@mock.patch.object(services, "WARMUP_SYNTHETIC_ANALYSIS", True)
+class LlmProbeTest(unittest.TestCase):
+    def test_probe_calls_the_llm_without_touching_the_analysis_cache(self):
+        cache = mock.Mock(aget=mock.AsyncMock(return_value={"status": "no_match"}), aset=mock.AsyncMock())
+        completion = mock.AsyncMock(return_value='{"decision": "Likely Not a Match"}')
+        with mock.patch.object(services, "analysis_cache", cache), mock.patch.object(services, "_complete_analysis", completion):
+            self.assertEqual(asyncio.run(services.probe_llm()), "Likely Not a Match")
+        completion.assert_awaited_once()
+        self.assertEqual(completion.await_args.args[1], "strong")
+        cache.aget.assert_not_called()
+        cache.aset.assert_not_called()
+
+    def test_probe_fails_when_the_llm_fails_despite_a_cached_analysis(self):
+        cache = mock.Mock(aget=mock.AsyncMock(return_value={"status": "no_match"}))
+        completion = mock.AsyncMock(side_effect=ConnectionError("Azure unreachable"))
+        with mock.patch.object(services, "analysis_cache", cache), mock.patch.object(services, "_complete_analysis", completion):
+            with self.assertRaisesRegex(RuntimeError, "Azure unreachable"):
+                asyncio.run(services.probe_llm())
+        completion.assert_awaited_once()
+
+    def test_probe_fails_on_empty_content(self):
+        with mock.patch.object(services, "_complete_analysis", mock.AsyncMock(return_value=None)):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(services.probe_llm())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from catalogue import TrialCatalogue
+from match_store import MatchStore
+from models import TrialMatch
+from patient_index import PatientIndex
+from rematch import RematchEngine
+
+_TRIAL = {"id": "NCT1", "title": "Lung Trial", "condition": "Non-Small Cell Lung Cancer", "phase": "3",
+          "status": "Recruiting", "min_age": 18}
+_PATIENT = {"patient_id": "P1", "condition": "Non-Small Cell Lung Cancer", "age": 60, "stage": "IV",
+            "priorTherapies": [], "biomarkers": [], "notes": "ECOG 1"}
+
+
+class RematchEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.store = MatchStore(os.path.join(tempfile.mkdtemp(prefix="rematch_test_"), "match_store.db"))
+        self.addCleanup(self.store.close)
+        self.catalogue = TrialCatalogue([_TRIAL])
+        self.index = PatientIndex([_PATIENT])
+        self.analyzed = []
+
+    def _save(self, patient_id: str, trial_id: str, match: dict = None) -> None:
+        decision = "Potential Match" if match else "Likely Not a Match"
+        self.store.save_results([{"patient_id": patient_id, "trial_id": trial_id, "catalogue_version": self.catalogue.version,
+                                  "model": "test-model", "match": match, "analysis": {"decision": decision}}])
+
+    def _engine(self) -> RematchEngine:
+        """A fresh engine, as after a restart or in another worker: only the store is shared."""
+        async def analyze(profile, trial):
+            self.analyzed.append((profile["patient_id"], trial.id))
+            match = TrialMatch(id=trial.id, title=trial.title, status=trial.status, phase=trial.phase,
+                               condition=trial.condition, rank_score=0.8)
+            self._save(profile["patient_id"], trial.id, match.model_dump())
+            return {"status": "success", "match_data": match, "llm_analysis": None}
+
+        async def removed(patient_id, trial_id, reason):
+            self._save(patient_id, trial_id)
+
+        return RematchEngine(self.catalogue, self.index, analyze, on_pair_removed=removed, match_store=self.store)
+
+    def test_unchanged_pair_is_skipped(self):
+        engine = self._engine()
+        first = asyncio.run(engine.on_patient_changed(dict(_PATIENT)))
+        second = asyncio.run(engine.on_patient_changed(dict(_PATIENT)))
+        self.assertEqual((first.pairsRecomputed, first.matchesAdded), (1, 1))
+        self.assertEqual((second.pairsRecomputed, second.pairsSkipped), (0, 1))
+        self.assertEqual(len(self.analyzed), 1)
+
+    def test_closing_a_trial_removes_matches_stored_by_an_earlier_engine(self):
+        asyncio.run(self._engine().on_trial_changed(dict(_TRIAL)))
+        self.assertEqual(self.store.matched_patients_for_trial("NCT1"), ["P1"])
+
+        summary = asyncio.run(self._engine().on_trial_changed({**_TRIAL, "status": "Completed"}))
+        self.assertEqual(summary.matchesRemoved, 1)
+        self.assertEqual(self.store.matches_for_trial("NCT1"), [])
+        self.assertEqual(self.store.latest_for_patient("P1"), [])
+
+    def test_profile_change_removes_matches_stored_by_an_earlier_engine(self):
+        asyncio.run(self._engine().on_patient_changed(dict(_PATIENT)))
+        self.assertEqual(self.store.matched_trials_for_patient("P1"), ["NCT1"])
+
+        summary = asyncio.run(self._engine().on_patient_changed({**_PATIENT, "condition": "Breast Cancer"}))
+        self.assertEqual(summary.matchesRemoved, 1)
+        self.assertEqual(summary.pairsRecomputed, 0)
+        self.assertEqual(self.store.latest_for_patient("P1"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
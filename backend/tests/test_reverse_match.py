@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import services
+from models import TrialData, TrialMatch
+from patient_index import PatientIndex
+
+_TRIAL = TrialData(id="NCT0", title="Lung Trial", condition="Non-Small Cell Lung Cancer", phase="3", status="Recruiting",
+                   inclusions=["ECOG 0-1"])
+
+
+def _patients(count: int) -> list:
+    # Better-documented patients have a higher upper bound and are analyzed first
+    return [{"patient_id": f"P{i:03d}", "condition": "Non-Small Cell Lung Cancer", "age": 60, "stage": "IV",
+             "priorTherapies": [], "biomarkers": [], "notes": "ECOG 1" if i % 2 else ""} for i in range(count)]
+
+
+class ReverseMatchTest(unittest.TestCase):
+    def _run(self, score: float, page: int = 1, page_size: int = 5, patients: int = 40):
+        analyzed = []
+
+        async def fake_analysis(profile, trial):
+            analyzed.append(profile["patient_id"])
+            match = TrialMatch(id=trial.id, title=trial.title, status=trial.status, phase=trial.phase,
+                               condition=trial.condition, rank_score=score)
+            return {"status": "success", "match_data": match, "llm_analysis": None}
+
+        async def no_persist(*args):
+            return None
+
+        with mock.patch.object(services, "patient_index", PatientIndex(_patients(patients))), \
+                mock.patch.object(services.trial_catalogue, "get", lambda trial_id: _TRIAL), \
+                mock.patch.object(services, "_analyze_patient_trial_pair", fake_analysis), \
+                mock.patch.object(services, "_persist_analyses", no_persist):
+            result = asyncio.run(services.find_patients_for_trial(_TRIAL.id, page=page, page_size=page_size))
+        return result, analyzed
+
+    def test_stops_once_page_is_settled(self):
+        result, analyzed = self._run(score=0.9)
+        self.assertEqual(len(analyzed), services.REVERSE_MATCH_CONCURRENCY)
+        self.assertEqual(result["candidatesScreened"], 40)
+        self.assertEqual(result["candidatesAnalyzed"], len(analyzed))
+        self.assertEqual(len(result["matches"]), 5)
+        # Documented ECOG raises the upper bound, so those patients are analyzed first
+        self.assertTrue(all(int(patient_id[1:]) % 2 for patient_id in analyzed))
+
+    def test_deeper_page_analyzes_more(self):
+        result, analyzed = self._run(score=0.9, page=3, page_size=5)
+        self.assertEqual(len(analyzed), 16)
+        self.assertEqual([m.patientId for m in result["matches"]], sorted(analyzed)[10:15])
+
+    def test_analysis_cap(self):
+        with mock.patch.object(services, "REVERSE_MATCH_MAX_ANALYSES", 12):
+            result, analyzed = self._run(score=0.1, page_size=20)
+        self.assertEqual(len(analyzed), 12)
+        self.assertEqual(result["totalMatches"], 12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from collections import Counter
+
+from sharding import HashRing, parse_shard_nodes
+
+_KEYS = [f"PATIENT_{i:05d}" for i in range(6000)]
+
+
+class HashRingTest(unittest.TestCase):
+    def test_placement_is_deterministic_and_order_independent(self):
+        ring = HashRing(["shard-0", "shard-1", "shard-2"])
+        same = HashRing(["shard-2", "shard-0", "shard-1", "shard-0"])
+        self.assertEqual(same.nodes, ["shard-0", "shard-1", "shard-2"])
+        self.assertEqual([ring.node_for(k) for k in _KEYS], [same.node_for(k) for k in _KEYS])
+
+    def test_keys_spread_roughly_evenly(self):
+        ring = HashRing(["shard-0", "shard-1", "shard-2"])
+        counts = Counter(ring.node_for(k) for k in _KEYS)
+        self.assertEqual(set(counts), {"shard-0", "shard-1", "shard-2"})
+        for count in counts.values():
+            self.assertLess(abs(count - len(_KEYS) / 3), len(_KEYS) * 0.1)
+
+    def test_adding_a_node_moves_only_its_share_to_it(self):
+        before = HashRing(["shard-0", "shard-1", "shard-2"])
+        after = HashRing(["shard-0", "shard-1", "shard-2", "shard-3"])
+        moved = [k for k in _KEYS if before.node_for(k) != after.node_for(k)]
+        self.assertTrue(all(after.node_for(k) == "shard-3" for k in moved))
+        self.assertLess(abs(len(moved) / len(_KEYS) - 0.25), 0.07)
+
+    def test_empty_ring(self):
+        self.assertIsNone(HashRing([]).node_for("PATIENT_00001"))
+
+
+class ParseShardNodesTest(unittest.TestCase):
+    def test_parses_and_normalizes(self):
+        spec = " shard-0 = http://127.0.0.1:8101/ ,, shard-1=http://127.0.0.1:8102"
+        self.assertEqual(parse_shard_nodes(spec), {"shard-0": "http://127.0.0.1:8101", "shard-1": "http://127.0.0.1:8102"})
+        self.assertEqual(parse_shard_nodes(""), {})
+
+    def test_rejects_bad_entries(self):
+        for spec in ("shard-0", "=http://x", "shard-0=", "shard-0=http://x,shard-1"):
+            with self.assertRaises(ValueError, msg=spec):
+                parse_shard_nodes(spec)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import services
+from accounting import RequestAccount, track
+from prompt_builder import count_message_tokens
+
+_MESSAGES = [{"role": "system", "content": "Analyze eligibility."}, {"role": "user", "content": "Patient and trial."}]
+_NEGATIVE = json.dumps({"decision": "Likely Not a Match", "reasoning_steps": ["Stage does not fit"] * 20, "flags": []})
+_POSITIVE = json.dumps({"decision": "Potential Match", "reasoning_steps": ["fits"], "match_rationale": [], "flags": []})
+
+
+def _chunk(content=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class _FakeStream:
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.consumed = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.consumed >= len(self._chunks):
+            raise StopAsyncIteration
+        self.consumed += 1
+        return self._chunks[self.consumed - 1]
+
+    async def close(self):
+        self.closed = True
+
+
+class StreamingUsageTest(unittest.TestCase):
+    def _stream(self, stream: _FakeStream):
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=mock.AsyncMock(return_value=stream))))
+        with mock.patch.object(services, "get_azure_sdk_client", return_value=client), track(RequestAccount()) as account:
+            content = asyncio.run(services._stream_analysis(_MESSAGES, "strong"))
+        return content, account.llm["analysis:strong"]
+
+    def test_early_stop_records_estimated_usage(self):
+        chunks = [_chunk(_NEGATIVE[i:i + 8]) for i in range(0, len(_NEGATIVE), 8)]
+        chunks.append(_chunk(usage=SimpleNamespace(prompt_tokens=999, completion_tokens=999, prompt_tokens_details=None)))
+        stream = _FakeStream(chunks)
+        content, usage = self._stream(stream)
+        self.assertEqual(json.loads(content)["decision"], "Likely Not a Match")
+        self.assertTrue(stream.closed)
+        self.assertLess(stream.consumed, len(chunks))
+        self.assertEqual(usage.calls, 1)
+        self.assertEqual(usage.prompt_tokens, count_message_tokens(_MESSAGES))
+        self.assertGreater(usage.completion_tokens, 0)
+        self.assertGreater(usage.cost_usd, 0)
+
+    def test_completed_stream_records_reported_usage(self):
+        reported = SimpleNamespace(prompt_tokens=120, completion_tokens=30, prompt_tokens_details=SimpleNamespace(cached_tokens=64))
+        content, usage = self._stream(_FakeStream([_chunk(_POSITIVE), _chunk(usage=reported)]))
+        self.assertEqual(content, _POSITIVE)
+        self.assertEqual((usage.prompt_tokens, usage.completion_tokens, usage.cached_prompt_tokens), (120, 30, 64))
+
+
+if __name__ == "__main__":
+    unittest.main()
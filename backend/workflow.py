@@ -0,0 +1,405 @@
+import asyncio
+import logging
+from typing import Awaitable, List, Union, Dict, Any, Optional, Tuple
+
+from agno.agent import Agent
+from agno.exceptions import ModelProviderError
+from agno.workflow import Workflow, RunEvent, RunResponse
+from pydantic import ValidationError
+
+from models import (
+    TrialMatch,
+    PatientProfileResponse,
+    DiscoveredTrialsResponse,
+    LLMAnalysisResult,
+    TrialAnalysisResponse,
+    TrialData
+)
+from accounting import mark_stage, record_event
+from circuit_breaker import CircuitOpenError
+from llm_output import LlmJsonParser
+from metrics import metrics
+from ranking import TopKRanker
+from services import (
+    REPAIRED_OUTPUT_FLAG,
+    MatchingRunContext,
+    _analyze_trial_match_tool,
+    _discover_trials_tool,
+    _fetch_patient_profile_tool,
+    _persist_analyses,
+    _record_agent_run,
+    cpu_offloader,
+    get_agent_llm_config,
+    logger,
+    patient_index,
+    rematch_engine,
+    trial_catalogue,
+)
+
+discovered_trials_parser = LlmJsonParser(DiscoveredTrialsResponse)
+trial_analysis_parser = LlmJsonParser(TrialAnalysisResponse)
+
+
+async def _run_agent(run: Awaitable[RunResponse]) -> RunResponse:
+    """Await an agent run, re-raising a circuit-breaker rejection of one of its model calls.
+
+    The breaker guards each model call (see GuardedClient); agno wraps the resulting
+    CircuitOpenError in a ModelProviderError.
+    """
+    try:
+        return await run
+    except ModelProviderError as e:
+        if isinstance(e.__cause__, CircuitOpenError):
+            raise e.__cause__ from e
+        raise
+
+
+# --- Define Clinical Trial Matching Workflow ---
+class ClinicalTrialMatchingWorkflow(Workflow):
+    description: str = "Orchestrates agents to find clinical trial matches for a patient using a direct workflow with Agents."
+
+    patient_profiler_agent: Agent
+    trial_discoverer_agent: Agent
+    trial_analyzer_agent: Agent
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.patient_profiler_agent = Agent(
+            name="PatientProfilerAgent",
+            role="Fetches a patient's profile using their ID.",
+            model=get_agent_llm_config(),
+            tools=[_fetch_patient_profile_tool],
+            instructions="You will be given a patient_id. Use the `_fetch_patient_profile_tool` with this patient_id to get the profile. Output the result from the tool.",
+            response_model=PatientProfileResponse,
+            structured_outputs=True,
+        )        
+
+        self.trial_discoverer_agent = Agent(
+            name="TrialDiscovererAgent",
+            role="Discovers clinical trials based on a patient's profile.",
+            model=get_agent_llm_config(),
+            tools=[_discover_trials_tool],
+            # tool_choice={"type": "function", "function": {"name": "_discover_trials_tool"}}, <-- Going into infinite loop if used
+            instructions=(
+                "You will receive a JSON string containing a 'patient_profile' object. "
+                "You are FORCED to call the `_discover_trials_tool`. "
+                "Extract the necessary values from the 'patient_profile' object in your input "
+                "to use as named arguments for the `_discover_trials_tool` (patient_id, condition, age, etc.). "
+                "The `_discover_trials_tool` will return a JSON string. "
+                "Your *only* task is to output this EXACT JSON string that the tool returns. "
+                "Do not modify it in any way. Do not try to parse it or reformat it. Output the raw JSON string."
+            ),
+            response_model=DiscoveredTrialsResponse,
+            structured_outputs=True,
+            show_tool_calls=True
+        )
+
+        self.trial_analyzer_agent = Agent(
+            name="TrialAnalyzerAgent",
+            role="Analyzes a single trial against a patient's profile for a match.",
+            model=get_agent_llm_config(), 
+            tools=[(_analyze_trial_match_tool)],
+            # tool_choice = {"type": "function", "function": {"name": "_analyze_trial_match_tool"}}, <-- Going into infinite loop if used
+            instructions=["You will be given a patient_profile (JSON string). Parse it into a dictionary. This dictionary is the 'patient_profile' argument for the '_discover_trials_tool'. Call the tool and output its result.", "DO NOT CREATE ANY TRIAL IDs YOURSELF."],
+            response_model=TrialAnalysisResponse, 
+            structured_outputs=True,
+            show_tool_calls=True 
+        )
+
+
+    def reset_agents(self) -> None:
+        """Drop per-run agent state so a pooled workflow starts each request clean.
+
+        Tool schemas and instructions built on first use are kept.
+        """
+        for agent in (self.patient_profiler_agent, self.trial_discoverer_agent, self.trial_analyzer_agent):
+            if agent.memory is not None:
+                agent.memory.clear()
+            agent.session_state = None
+            agent.run_response = None
+
+    def prebuild_tool_schemas(self) -> None:
+        """Generate each agent's tool/function schemas now rather than on the first request."""
+        for agent in (self.patient_profiler_agent, self.trial_discoverer_agent, self.trial_analyzer_agent):
+            agent.determine_tools_for_model(model=agent.model, session_id="prebuild", async_mode=True)
+
+    async def _store_analyses(self, patient_id: str, analyses: List[Tuple[str, Optional[TrialMatch], Optional[LLMAnalysisResult]]]) -> None:
+        """Persist completed analyses and register them with the re-matching engine."""
+        await _persist_analyses(patient_id, analyses)
+        indexed_profile = patient_index.get(patient_id)
+        for stored_trial_id, stored_match, _ in analyses:
+            catalogue_trial = trial_catalogue.get(stored_trial_id)
+            if indexed_profile and catalogue_trial:
+                rematch_engine.record_analysis(indexed_profile, catalogue_trial, {"status": "success" if stored_match else "no_match", "match_data": stored_match})
+
+    async def _get_cached_data(self, ctx: MatchingRunContext, key_prefix: str) -> Optional[Any]:
+        key = f"{key_prefix}_{ctx.patient_id}"
+        data = ctx.session_state.get(key)
+        if data:
+            logger.debug(f"Workflow cache hit for key: {key}")
+            
+            return data
+        logger.debug(f"Workflow cache miss for key: {key}")
+        return None
+
+    async def _add_cached_data(self, ctx: MatchingRunContext, key_prefix: str, data: Any):
+        key = f"{key_prefix}_{ctx.patient_id}"
+        logger.debug(f"Workflow caching data for key: {key}")
+        # Session state lives only for this run, so models are kept as-is rather than dumped and re-validated
+        ctx.session_state[key] = data
+
+
+    # # This synchronous run method is generally not ideal if your primary entry is async.
+    # # It's kept for compatibility with how Agno might expect to call workflows in some contexts.
+    # def run(self, patient_id: str, use_cache: bool = True) -> Iterator[RunResponse]:
+    #     logger.warning(
+    #         "Synchronous Workflow.run() called. For async execution from FastAPI, "
+    #         "the run_trial_matching_workflow (async) function is preferred."
+    #     )
+    #     # This path would require careful handling of event loops if an outer loop is running.
+    #     # For simplicity in this context, we'll assume it's called where it can manage its own loop
+    #     # or that it won't be the primary execution path from an async framework.
+    #     if asyncio.get_event_loop().is_running():
+    #         logger.error("Synchronous run() cannot be reliably called when an event loop is already running.")
+    #         yield RunResponse(
+    #             content={"error_type": "ASYNC_CONFLICT", "message": "Sync run called with running event loop."},
+    #             event=RunEvent.workflow_completed, run_id=self.run_id)
+    #         return
+
+    #     loop = asyncio.new_event_loop()
+    #     asyncio.set_event_loop(loop)
+    #     try:
+    #         content, event = loop.run_until_complete(
+    #             self._arun_steps(patient_id, use_cache)
+    #         )
+    #         yield RunResponse(content=content, event=event, run_id=self.run_id)
+    #     except Exception as e:
+    #         logger.error(f"Workflow run failed in synchronous wrapper for {patient_id}: {e}", exc_info=True)
+    #         yield RunResponse(
+    #             content={"error_type": "WORKFLOW_SYNC_EXECUTION_ERROR", "message": str(e)},
+    #             event=RunEvent.workflow_completed, run_id=self.run_id )
+    #     finally:
+    #         loop.close()
+
+
+    async def _arun_steps(self, ctx: MatchingRunContext) -> tuple[Union[List[TrialMatch], Dict[str, Any]], RunEvent]:
+        patient_id, use_cache = ctx.patient_id, ctx.use_cache
+        # 0. Check cache for final result
+        if use_cache:
+            cached_final_result = await self._get_cached_data(ctx, "final_matches")
+            if cached_final_result is not None and isinstance(cached_final_result, (list, dict)):
+                logger.info(f"Returning cached final result for patient {patient_id}")
+                return cached_final_result, RunEvent.workflow_completed
+
+        # 1. Fetch Patient Profile using Agent
+        logger.info(f"Step 1: Fetching patient profile for {patient_id} using Agent")
+        mark_stage("profile")
+        profile_data: Optional[Dict[str, Any]] = None
+        patient_profile_response_obj: Optional[PatientProfileResponse] = None
+
+        if use_cache:
+            cached_profile_response = await self._get_cached_data(ctx, "patient_profile_agent_response")
+            if isinstance(cached_profile_response, PatientProfileResponse) and cached_profile_response.status == "success" and cached_profile_response.profile:
+                patient_profile_response_obj = cached_profile_response
+                profile_data = cached_profile_response.profile
+
+        if not profile_data:
+            profiler_response: RunResponse = await _run_agent(self.patient_profiler_agent.arun(patient_id, session_id=ctx.session_id)) # Agent's async run
+            _record_agent_run(self.patient_profiler_agent.name, profiler_response)
+            if profiler_response and isinstance(profiler_response.content, PatientProfileResponse):
+                patient_profile_response_obj = profiler_response.content
+                if use_cache:
+                    await self._add_cached_data(ctx, "patient_profile_agent_response", patient_profile_response_obj) # Cache the Pydantic object's dict
+            else:
+                err_msg = "Patient Profiler Agent did not return valid PatientProfileResponse."
+                logger.error(f"{err_msg} Content: {profiler_response.content if profiler_response else 'None'}")
+                return {"error_type": "AGENT_RESPONSE_ERROR", "agent": "PatientProfilerAgent", "message": err_msg}, RunEvent.workflow_completed
+
+            if patient_profile_response_obj.status == "success" and patient_profile_response_obj.profile:
+                profile_data = patient_profile_response_obj.profile
+            elif patient_profile_response_obj.status == "not_found":
+                logger.warning(f"Patient {patient_id} not found by agent.")
+                return {"error_type": "PATIENT_NOT_FOUND", "message": patient_profile_response_obj.message or f"Patient {patient_id} not found."}, RunEvent.workflow_completed
+            else: # Error
+                err_msg = patient_profile_response_obj.message or patient_profile_response_obj.error or "Agent failed to fetch profile."
+                logger.error(f"Error from PatientProfilerAgent for {patient_id}: {err_msg}")
+                return {"error_type": "ERROR_FETCHING_PATIENT", "message": err_msg}, RunEvent.workflow_completed
+
+        if not profile_data:
+            return {"error_type": "INTERNAL_ERROR", "message": "Patient profile became unavailable after agent fetch."}, RunEvent.workflow_completed
+
+        # 2. Discover Trials using Agent
+        logger.info(f"Step 2: Discovering trials for patient {patient_id} using Agent")
+        mark_stage("discovery")
+        discovered_trials_list: Optional[List[TrialData]] = None 
+        discoverer_response_obj: Optional[DiscoveredTrialsResponse] = None
+
+        if use_cache:
+            cached_trials_response = await self._get_cached_data(ctx, "discovered_trials_agent_response")
+            if isinstance(cached_trials_response, DiscoveredTrialsResponse) and cached_trials_response.status == "success" and cached_trials_response.trials is not None:
+                discovered_trials_list = cached_trials_response.trials
+        
+        if discovered_trials_list is None: # If not found in cache or cache was invalid
+            logger.info(f"Cache miss or invalid for discovered_trials_agent_response. Fetching from agent for patient {patient_id}.")
+            discoverer_input_json = f'{{"patient_profile": {profile_data.model_dump_json()}}}'
+            logger.debug(f"Passing to TrialDiscovererAgent.arun(): {discoverer_input_json}")
+            
+            try:
+                discoverer_agent_response = await _run_agent(self.trial_discoverer_agent.arun(discoverer_input_json, session_id=ctx.session_id))
+                _record_agent_run(self.trial_discoverer_agent.name, discoverer_agent_response)
+            except Exception as e:
+                logger.error(f"Exception directly from TrialDiscovererAgent.arun(): {e}", exc_info=True)
+                return {"error_type": "AGENT_RUN_EXCEPTION", "agent": "TrialDiscovererAgent", "message": str(e)}, RunEvent.workflow_completed
+
+            # ---- START CRITICAL LOGS for debussing infinite loop issue (finally found forced tool use in the agent was the problem)----
+            if not discoverer_agent_response:
+                logger.debug("TrialDiscovererAgent.arun() returned a None response.")
+                return {"error_type": "AGENT_EMPTY_RESPONSE", "agent": "TrialDiscovererAgent", "message": "Agent returned None"}, RunEvent.workflow_completed
+
+            logger.debug(f"TrialDiscovererAgent - Raw RunResponse.content: {str(discoverer_agent_response.content)[:1000]}")
+            if hasattr(discoverer_agent_response.content, 'model_dump_json') and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"TrialDiscovererAgent - Content (as Pydantic model): {discoverer_agent_response.content.model_dump_json(indent=2)}")
+            
+            if discoverer_agent_response.tools:
+                logger.debug(f"TrialDiscovererAgent - Number of tool executions recorded: {len(discoverer_agent_response.tools)}")
+                for i, tool_execution in enumerate(discoverer_agent_response.tools):
+                    tool_result_str = str(tool_execution.result)
+                    logger.debug(
+                        f"TrialDiscovererAgent - Recorded ToolExecution {i}: "
+                        f"Name='{tool_execution.tool_name}', "
+                        f"Args='{tool_execution.tool_args}', "
+                        f"Result (first 1000 chars)='{tool_result_str[:1000]}', "
+                        f"Error='{tool_execution.tool_call_error}'"
+                    )
+                    if tool_execution.tool_name == "_discover_trials_tool" and tool_execution.result:
+                         logger.debug(f"FULL _discover_trials_tool RAW Result from ToolExecution.result: {tool_execution.result}")
+            else:
+                logger.warning("TrialDiscovererAgent - No tool executions recorded in RunResponse.tools (after agent.arun)")
+
+            if discoverer_agent_response.thinking:
+                 logger.debug(f"TrialDiscovererAgent - Thinking: {discoverer_agent_response.thinking}")
+            # ---- END CRITICAL LOGS ----
+
+            # Process the response from the agent
+            if isinstance(discoverer_agent_response.content, str):
+                raw_json_from_agent = discoverer_agent_response.content
+                logger.info(f"TrialDiscovererAgent returned raw string: {raw_json_from_agent}")
+                try:
+                    # Parse and validate in one pass instead of json.loads followed by per-trial construction
+                    discoverer_response_obj = discovered_trials_parser.parse(raw_json_from_agent)
+                    if use_cache:
+                        await self._add_cached_data(ctx, "discovered_trials_agent_response", discoverer_response_obj)
+                except ValidationError as e:
+                    logger.error(f"Failed to parse JSON string from TrialDiscovererAgent: {e}. String was: {raw_json_from_agent}")
+                    return {"error_type": "AGENT_BAD_JSON_STRING", "agent": "TrialDiscovererAgent", "message": "Agent returned unparsable JSON string."}, RunEvent.workflow_completed
+            
+            # This case should ideally not be hit if response_model is None and structured_outputs is False
+            elif isinstance(discoverer_agent_response.content, DiscoveredTrialsResponse):
+                logger.info("TrialDiscovererAgent returned a DiscoveredTrialsResponse Pydantic model directly.")
+                discoverer_response_obj = discoverer_agent_response.content
+                if use_cache:
+                    await self._add_cached_data(ctx, "discovered_trials_agent_response", discoverer_response_obj)
+            else:
+                err_msg = f"TrialDiscovererAgent returned unexpected content type: {type(discoverer_agent_response.content)}. Content: {str(discoverer_agent_response.content)[:500]}"
+                logger.error(err_msg)              
+                return {"error_type": "AGENT_UNEXPECTED_RESPONSE_TYPE", "agent": "TrialDiscovererAgent", "message": err_msg}, RunEvent.workflow_completed
+            
+            # Populate discovered_trials_list from the processed discoverer_response_obj
+            if discoverer_response_obj and discoverer_response_obj.status == "success":
+                discovered_trials_list = discoverer_response_obj.trials or []
+            elif discoverer_response_obj: # Error or other non-success status from agent/tool
+                err_msg = discoverer_response_obj.message or discoverer_response_obj.error or "Agent/tool failed to discover trials."
+                logger.error(f"Error from TrialDiscovererAgent or tool processing for {patient_id}: {err_msg}")
+                return {"error_type": "ERROR_DISCOVERING_TRIALS", "message": err_msg}, RunEvent.workflow_completed
+            else: # discoverer_response_obj is None, meaning some path above didn't populate it.
+                logger.error("discoverer_response_obj is None after agent call and processing. This should not happen.")
+                return {"error_type": "INTERNAL_WORKFLOW_ERROR", "message": "Failed to get response object from discoverer agent."}, RunEvent.workflow_completed
+
+        # After cache or agent call, check discovered_trials_list
+        if discovered_trials_list is None : # Should be an empty list if no trials, not None
+             logger.error("discovered_trials_list is still None after cache and agent logic. This indicates a flaw in population.")
+             #This means it didn't go into the "if discovered_trials_list is None:" block above, or failed within.
+             #It might also mean an error occurred within that block before discoverer_response_obj was processed.
+             return {"error_type": "INTERNAL_WORKFLOW_ERROR", "message": "Trial list not populated."}, RunEvent.workflow_completed
+
+        if not discovered_trials_list: # Handles empty list: no trials found
+            logger.info(f"No trials found by agent for patient {patient_id}.")
+            if use_cache and not await self._get_cached_data(ctx, "final_matches"): # Avoid re-caching empty if already cached
+                await self._add_cached_data(ctx, "final_matches", [])
+            return [], RunEvent.workflow_completed
+        
+        # Log before Step 3
+        logger.info(f"Data prepared for TrialAnalyzerAgent. Number of trials in discovered_trials_list: {len(discovered_trials_list)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, trial_item_for_analyzer in enumerate(discovered_trials_list):
+                logger.debug(f"Trial {i} for Analyzer: {trial_item_for_analyzer.model_dump_json(indent=2)}")
+        # 3. Analyze trials using Agent, most promising first, until the top `limit` matches are settled
+        logger.info(f"Step 3: Analyzing up to {len(discovered_trials_list)} discovered trials for {patient_id} using Agent")
+        ranker = TopKRanker(ctx.limit)
+        analyses_to_store: List[Tuple[str, Optional[TrialMatch], Optional[LLMAnalysisResult]]] = []
+
+        mark_stage("planning")
+        # Discovered trials omit structured criteria; use the catalogue's precomputed copy where available
+        discovered_by_id = {t.id: t for t in discovered_trials_list}
+        # Criteria evaluation and ordering are CPU-bound; large catalogues run them in the offload pool
+        planned = await cpu_offloader.plan(profile_data.model_dump(), list(discovered_by_id.values()))
+        # The profile is the same for every trial; serialize it once
+        profile_json = profile_data.model_dump_json()
+        mark_stage("analysis")
+        try:
+            for position, (trial_id, upper_bound) in enumerate(planned):
+                if ranker.can_stop(upper_bound):
+                    logger.info(f"Top {ctx.limit} matches for {patient_id} settled after {position} of {len(planned)} trials; "
+                                f"skipping {len(planned) - position} analyses")
+                    metrics.inc("ranking_analyses_skipped_total", len(planned) - position)
+                    record_event("ranking_skips", len(planned) - position)
+                    break
+                trial_data = discovered_by_id[trial_id]
+                logger.debug(f"Analyzing trial {trial_id} using Agent...")            
+                analyzer_input_json = f'{{"patient_profile": {profile_json}, "trial": {trial_data.model_dump_json()}}}'
+                logger.debug(f"Analyzing trial {trial_id} with input: {analyzer_input_json}")
+                analyzer_agent_response: RunResponse = await _run_agent(self.trial_analyzer_agent.arun(analyzer_input_json, session_id=ctx.session_id))
+                _record_agent_run(self.trial_analyzer_agent.name, analyzer_agent_response)
+
+                if analyzer_agent_response and isinstance(analyzer_agent_response.content, str):
+                    # agno could not parse the agent's answer; repair it here rather than drop the trial
+                    try:
+                        repaired_obj, repaired = trial_analysis_parser.parse_with_repair_flag(analyzer_agent_response.content)
+                        if repaired and repaired_obj.match_data:
+                            repaired_obj.match_data.flags.append(REPAIRED_OUTPUT_FLAG)
+                        analyzer_agent_response.content = repaired_obj
+                    except ValidationError as e:
+                        logger.warning(f"Unrecoverable TrialAnalyzerAgent output for trial {trial_id}: {e.error_count()} validation errors")
+                if analyzer_agent_response and isinstance(analyzer_agent_response.content, TrialAnalysisResponse):
+                    analysis_result_obj = analyzer_agent_response.content
+
+                    if analysis_result_obj.status == "success" and analysis_result_obj.match_data:
+                        logger.info(f"Potential match from Agent: Trial {trial_id} for patient {patient_id}")
+                        # match_data should be a TrialMatch object because TrialAnalysisResponse has match_data: Optional[TrialMatch]
+                        ranker.push(analysis_result_obj.match_data)
+                        analyses_to_store.append((trial_id, analysis_result_obj.match_data, analysis_result_obj.llm_analysis))
+                    elif analysis_result_obj.status == "error":
+                        logger.warning(f"Error from TrialAnalyzerAgent for trial {trial_id}: {analysis_result_obj.message or analysis_result_obj.reason}")
+                    else: # no_match or other
+                        logger.debug(f"No match from Agent for trial {trial_id}: {analysis_result_obj.reason}")
+                        analyses_to_store.append((trial_id, None, analysis_result_obj.llm_analysis))
+                else:
+                    logger.error(f"Trial Analyzer Agent for trial {trial_id} did not return valid TrialAnalysisResponse. Content: {analyzer_agent_response.content if analyzer_agent_response else 'None'}")
+        except (asyncio.CancelledError, CircuitOpenError) as interrupted:
+            # The caller went away (e.g. client disconnect) or the LLM circuit opened. Keep what was
+            # already paid for; the per-pair results are also in the analysis cache for the next request.
+            reason = "cancelled" if isinstance(interrupted, asyncio.CancelledError) else "interrupted by the open LLM circuit"
+            logger.info(f"Workflow for {patient_id} {reason} after {len(analyses_to_store)} of {len(discovered_trials_list)} analyses; saving partial results")
+            await self._store_analyses(patient_id, analyses_to_store)
+            raise
+
+        # 4. Compile Final Results
+        mark_stage("compile")
+        potential_matches_models = ranker.results()
+        logger.info(f"Step 4: Compiling final results. Keeping top {len(potential_matches_models)} of {ranker.seen} potential matches from agent analyses.")
+        await self._store_analyses(patient_id, analyses_to_store)
+
+        if use_cache:
+            await self._add_cached_data(ctx, "final_matches", potential_matches_models)
+
+        return potential_matches_models, RunEvent.workflow_completed